@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+# Example runs:
+# python benchmark.py --sizes 1000 10000 50000 --output bench/results.jsonl
+# python benchmark.py --sizes 1000 10000 --compare bench/results.jsonl
+# python benchmark.py --sizes 1000 10000 --shingles char:3 word:2 word:2+char:5
+# python benchmark.py --card-formats card_data/refined-cards-2025-01-01.json
+
+import cardsim as cs
+import filesim_helper as fsh
+from instrumentation import peak_rss
+
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import argparse
+import tracemalloc
+import subprocess
+import contextlib
+import numpy as np
+from math import log
+
+# Clauses the synthetic oracle texts are built from, so unrelated cards still share many shingles like real ones
+CLAUSES = [
+    "Flying", "Trample", "Haste", "Vigilance", "Deathtouch", "Lifelink", "Reach", "First strike", "Flash", "Hexproof",
+    "When ~ enters the battlefield, draw a card.",
+    "When ~ enters the battlefield, target opponent discards a card.",
+    "When ~ dies, create a 1/1 green Saproling creature token.",
+    "{T}: Add {G}.", "{T}: Add one mana of any color.", "{1}, {T}, Sacrifice ~: Draw a card.",
+    "Destroy target creature.", "Destroy target artifact or enchantment.", "Counter target spell.",
+    "Return target creature to its owner's hand.", "Target creature gets +{N}/+{N} until end of turn.",
+    "~ deals {N} damage to any target.", "You gain {N} life.", "Each opponent loses {N} life.",
+    "Search your library for a basic land card, put it onto the battlefield tapped, then shuffle.",
+    "Creatures you control get +1/+1.", "Whenever you cast a noncreature spell, put a +1/+1 counter on ~.",
+    "At the beginning of your upkeep, scry {N}.", "Exile target card from a graveyard.",
+    "Return target creature card from your graveyard to your hand.", "Draw {N} cards, then discard a card.",
+    "Enchant creature", "Enchanted creature can't attack or block.", "Equip {N}", "Equipped creature gets +{N}/+0.",
+    "Sacrifice a creature: ~ gets +2/+2 until end of turn.", "Tap target creature. It doesn't untap during its controller's next untap step.",
+    "Whenever another creature enters the battlefield under your control, you gain 1 life.",
+]
+WORDS = ("target creature artifact enchantment land player opponent graveyard library hand battlefield token counter "
+         "spell card damage life mana untap tap sacrifice exile return destroy draw discard create each another").split()
+LEXICON_SIZE = 5000
+
+STAGES = ["shingles", "binary_matrix", "minhash", "sim_vote", "verify", "strongly_connected"]
+
+
+def synthetic_cards(n:int, duplicate_fraction:float = 0.3, max_cluster:int = 8, edits:int = 2,
+                    seed:int = 0) -> tuple[list, np.array]:
+    """
+    Generate cleaned cards with random oracle texts, where a fraction of the cards are planted as clusters of
+    near-duplicates of the same text with a few words changed.
+
+    Parameters:
+    - n (int): Number of cards
+    - duplicate_fraction (float): Fraction of the cards that belong to a cluster of near-duplicates (default: 0.3)
+    - max_cluster (int): Largest cluster size, cluster sizes are uniform between 2 and max_cluster (default: 8)
+    - edits (int): Maximum number of words replaced in each near-duplicate (default: 2)
+    - seed (int): Seed of the corpus, the same seed always gives the same corpus (default: 0)
+
+    Returns:
+    - tuple: List of card dictionaries, and the planted cluster of each card (np.array)
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Made up words, real card texts have far more distinct words than CLAUSES and WORDS
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    lexicon = WORDS + ["".join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(LEXICON_SIZE)]
+
+    # A few common clauses and a run of random words, so unrelated cards are rarely near-duplicates by chance
+    def random_text() -> str:
+        clauses = rng.choice(len(CLAUSES), size=rng.integers(1, 4), replace=False)
+        words = [lexicon[w] for w in rng.integers(len(lexicon), size=rng.integers(6, 16))]
+        return " ".join([CLAUSES[c].replace("{N}", str(rng.integers(1, 6))) for c in clauses] + words)
+
+    cards = []
+    clusters = np.empty(n, dtype=np.int64)
+    cluster = 0
+    while len(cards) < n:
+        size = 1
+        if rng.random() < duplicate_fraction:
+            size = min(int(rng.integers(2, max_cluster+1)), n - len(cards))
+        base = random_text().split(" ")
+
+        for _ in range(size):
+            words = list(base)
+            for _ in range(rng.integers(0, edits+1) if size > 1 else 0):
+                words[rng.integers(len(words))] = lexicon[rng.integers(len(lexicon))]
+            i = len(cards)
+            cards.append({
+                "oracle_id": f"{seed:08x}-0000-0000-0000-{i:012x}",
+                "name": f"Synthetic Card {i}",
+                "oracle_text": " ".join(words),
+            })
+            clusters[i] = cluster
+        cluster += 1
+
+    return cards, clusters
+
+
+def measure(stage:str, func, results:dict, memory:bool, items=None):
+    """
+    Run one pipeline stage, recording its wall time, CPU time and optionally its peak traced memory. With memory
+    profiling the stage is run a second time under tracemalloc so the tracing doesn't slow down the timed run.
+
+    Parameters:
+    - stage (str): Name of the stage
+    - func (function): Function running the stage
+    - results (dict): Dictionary the stage's measurements are added to
+    - memory (bool): Measure the stage's peak memory
+    - items (function|None): Function counting the items the stage produced from its result (default: None)
+
+    Returns:
+    - The result of func
+    """
+
+    with contextlib.redirect_stdout(None):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func()
+        record = {"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+
+        if memory:
+            tracemalloc.start()
+            func()
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    if items is not None:
+        record["items"] = items(result)
+    results[stage] = record
+    return result
+
+
+def pair_quality(clusters:np.array, components:dict) -> dict:
+    """
+    Compare the groups found with the planted clusters, counting the pairs of cards grouped together by both.
+
+    Parameters:
+    - clusters (np.array): Planted cluster of each card
+    - components (dict): Groups found by strongly_connected
+
+    Returns:
+    - dict: Pair precision and recall of the groups found
+    """
+
+    found = np.empty(len(clusters), dtype=np.int64)
+    for group, members in enumerate(components.values()):
+        found[members] = group
+
+    def pairs(labels:np.array) -> int:
+        counts = np.unique(labels, return_counts=True)[1]
+        return int((counts * (counts-1) // 2).sum())
+
+    both = pairs(clusters * len(clusters) + found)
+    found_pairs, planted_pairs = pairs(found), pairs(clusters)
+    return {
+        "precision": both / found_pairs if found_pairs else 1.0,
+        "recall": both / planted_pairs if planted_pairs else 1.0,
+    }
+
+
+def run_benchmark(n:int, num_minhashes:int = 144, blocks:int = 24, rows_per_block:int = 6, votes:int = 6,
+                  min_jaccard:float | None = None, seed:int = 0, workers:int = 1, memory:bool = True,
+                  shingles:str = fsh.DEFAULT_SHINGLES) -> dict:
+    """
+    Time every stage of the similarity pipeline on a synthetic corpus.
+
+    Parameters:
+    - n (int): Number of synthetic cards
+    - num_minhashes (int): The number of minhash steps to perform (default: 144)
+    - blocks (int): Number of blocks (default: 24)
+    - rows_per_block (int): Number of rows per block (default: 6)
+    - votes (int): Number of votes required to create an edge (default: 6)
+    - min_jaccard (float|None): Also time verifying the edges at this Jaccard similarity (default: None)
+    - seed (int): Seed of the corpus and the minhash hashing functions (default: 0)
+    - workers (int): Number of processes and threads used by each step (default: 1)
+    - memory (bool): Measure each stage's peak memory (default: True)
+    - shingles (str): Shingling strategy like "char:3" or "word:2+char:5" (default: fsh.DEFAULT_SHINGLES)
+
+    Returns:
+    - dict: Benchmark record with the measurements of each stage
+    """
+
+    cards, clusters = synthetic_cards(n, seed=seed)
+    stages = {}
+
+    vocab, (indptr, inds) = measure("shingles", lambda: cs.imp_shins(cards, minVal=4, workers=workers, shingles=shingles), stages, memory,
+                                    lambda r: len(r[0]))
+    measure("binary_matrix", lambda: cs.generate_shingle_bin_matrix(vocab, cards, check=False, shingles=shingles), stages, memory,
+            lambda r: len(r[1]))
+    shingle_sets = (indptr, vocab[inds])
+    mat = measure("minhash", lambda: cs.minhash(shingle_sets, num_minhashes, seed, workers=workers), stages, memory)
+    edges = measure("sim_vote", lambda: cs.sim_vote(mat, votes, blocks, rows_per_block, workers), stages, memory, len)
+    if min_jaccard is not None:
+        edges = measure("verify", lambda: cs.verify_edges(edges, shingle_sets, min_jaccard)[0], stages, memory, len)
+    components = measure("strongly_connected", lambda: cs.strongly_connected(edges, n), stages, memory, len)
+
+    return {
+        "size": n,
+        "params": {"num_minhashes": num_minhashes, "blocks": blocks, "rows_per_block": rows_per_block, "votes": votes,
+                   "min_jaccard": min_jaccard, "seed": seed, "workers": workers,
+                   "shingles": fsh.format_shingle_strategy(shingles)},
+        "stages": stages,
+        "quality": pair_quality(clusters, components),
+        "max_rss": peak_rss(),     # Bytes on every platform, None where it can't be measured
+    }
+
+
+def format_benchmark(cards_file:str, repeat:int = 3) -> list:
+    """
+    Time saving and loading a refined cards file in every format of cardsim.CARD_FORMATS, against reading the
+    JSON into a list of dictionaries like get_custom_cards used to. Every format is checked to load the same cards.
+
+    Parameters:
+    - cards_file (str): Refined cards file in any of the formats
+    - repeat (int): Number of loads of each format, the fastest is kept (default: 3)
+
+    Returns:
+    - list: {"format", "bytes", "save", "load", "matches"} of each format, times in seconds
+    """
+
+    with contextlib.redirect_stdout(None):
+        cards = cs.load_cards(cards_file).tolist()
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_file = os.path.join(tmp_dir, "cards.json")
+        cs.save_dict(cards, json_file)
+        def load_dicts():
+            with open(json_file, "r") as fd:
+                return json.loads(fd.read())
+        results.append({"format": "json (list of dicts)", "bytes": os.path.getsize(json_file), "save": None,
+                        "load": min(timed(load_dicts)[1] for _ in range(repeat)), "matches": load_dicts() == cards})
+
+        for format, ext in cs.CARD_FORMATS.items():
+            fname = os.path.join(tmp_dir, f"cards{ext}")
+            _, save_time = timed(lambda: cs.save_dict(cards, fname, format))
+            loads = [timed(lambda: cs.load_cards(fname)) for _ in range(repeat)]
+            results.append({"format": format, "bytes": os.path.getsize(fname), "save": save_time,
+                            "load": min(seconds for _, seconds in loads), "matches": loads[0][0].tolist() == cards})
+    return results
+
+
+def timed(func) -> tuple:
+    # Result of func and the wall time it took
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def print_formats(results:list) -> None:
+    print(f"\n{'format':>20} {'size':>10} {'save':>8} {'load':>8} {'exact':>6}")
+    for r in results:
+        save = f"{r['save']:.3f}s" if r["save"] is not None else "-"
+        print(f"{r['format']:>20} {r['bytes'] / (1 << 20):>8.1f}MB {save:>8} {r['load']:>7.3f}s {str(r['matches']):>6}")
+
+
+def environment() -> dict:
+    """
+    Describe the commit and interpreter the benchmark ran on.
+
+    Returns:
+    - dict: Commit hash (None outside a git checkout), Python and NumPy versions, platform and date
+    """
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def print_results(records:list) -> None:
+    """
+    Print the wall time of each stage for every corpus size and shingling strategy, and how fast each stage grows
+    between sizes of the same strategy as the exponent e of time ~ size^e.
+
+    Parameters:
+    - records (list): Benchmark records from run_benchmark, grouped by strategy in increasing size
+    """
+
+    stages = [s for s in STAGES if any(s in r["stages"] for r in records)]
+    print(f"\n{'shingles':>14} {'size':>8} " + " ".join(f"{s:>18}" for s in stages) + f" {'vocab':>8} {'precision':>9} {'recall':>6}")
+    prev = None
+    for r in records:
+        if prev and prev["params"].get("shingles") != r["params"].get("shingles"):
+            prev = None
+        cells = []
+        for s in stages:
+            cell = f"{r['stages'][s]['wall']:.3f}s" if s in r["stages"] else "-"
+            if prev and s in r["stages"] and s in prev["stages"] and prev["stages"][s]["wall"] > 0 and r["size"] != prev["size"]:
+                exponent = log(r["stages"][s]["wall"] / prev["stages"][s]["wall"]) / log(r["size"] / prev["size"])
+                cell += f" (^{exponent:.2f})"
+            cells.append(f"{cell:>18}")
+        print(f"{r['params'].get('shingles', '-'):>14} {r['size']:>8} " + " ".join(cells) +
+              f" {r['stages']['shingles'].get('items', 0):>8} {r['quality']['precision']:>9.3f} {r['quality']['recall']:>6.3f}")
+        prev = r
+
+
+def compare_results(records:list, fname:str, tolerance:float) -> bool:
+    """
+    Compare the wall times with the latest earlier records of the same size and parameters.
+
+    Parameters:
+    - records (list): Benchmark records from run_benchmark
+    - fname (str): JSON-lines file of earlier benchmark records
+    - tolerance (float): Ratio of the new over the old time above which a stage counts as a regression
+
+    Returns:
+    - bool: True if any stage regressed
+    """
+
+    baseline = {}
+    with open(fname, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                old = json.loads(line)
+                baseline[(old["size"], json.dumps(old["params"], sort_keys=True))] = old
+
+    regressed = False
+    for r in records:
+        old = baseline.get((r["size"], json.dumps(r["params"], sort_keys=True)))
+        if old is None:
+            print(f"No earlier record of size {r['size']} with the same parameters in '{fname}'.")
+            continue
+
+        print(f"\nSize {r['size']} against commit {old['environment']['commit']}:")
+        for s, new in r["stages"].items():
+            if s not in old["stages"]:
+                continue
+            ratio = new["wall"] / max(old["stages"][s]["wall"], 1e-9)
+            slower = ratio > tolerance
+            regressed |= slower
+            print(f"  {s:>18}: {old['stages'][s]['wall']:.3f}s -> {new['wall']:.3f}s ({ratio:.2f}x){'  REGRESSION' if slower else ''}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the similarity pipeline on synthetic cards.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Corpus sizes to run (default: 1000 10000 50000)")
+    parser.add_argument("--num-minhashes", type=int, default=144)
+    parser.add_argument("--blocks", type=int, default=24)
+    parser.add_argument("--rows-per-block", type=int, default=6)
+    parser.add_argument("--votes", type=int, default=6)
+    parser.add_argument("--min-jaccard", type=float, default=None, help="Also benchmark verifying the edges at this Jaccard similarity")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--shingles", nargs="+", default=[fsh.DEFAULT_SHINGLES], type=fsh.format_shingle_strategy,
+                        help=f"Shingling strategies to compare, like 'char:3', 'word:2' or 'word:2+char:5' (default: {fsh.DEFAULT_SHINGLES})")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the second, memory profiled, run of each stage")
+    parser.add_argument("--output", help="JSON-lines file the results are appended to")
+    parser.add_argument("--compare", help="JSON-lines file of earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="Slowdown ratio reported as a regression (default: 1.2)")
+    parser.add_argument("--card-formats", metavar="CARDS_FILE", help="Only compare saving and loading a refined cards file in each format")
+    args = parser.parse_args()
+
+    if args.card_formats:
+        print_formats(format_benchmark(args.card_formats))
+        sys.exit()
+
+    if args.num_minhashes != args.blocks * args.rows_per_block:
+        print("Error: num-minhashes should be equal to blocks*rows-per-block.", file=sys.stderr)
+        sys.exit(1)
+
+    env = environment()
+    records = []
+    for shingles in args.shingles:
+        for n in sorted(args.sizes):
+            print(f"Benchmarking {n} cards with {shingles} shingles...", file=sys.stderr)
+            record = run_benchmark(n, args.num_minhashes, args.blocks, args.rows_per_block, args.votes, args.min_jaccard,
+                                   args.seed, args.workers, not args.no_memory, shingles)
+            record["environment"] = env
+            records.append(record)
+
+    print_results(records)
+
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        print(f"\nAppended {len(records)} records to '{args.output}'.")
+
+    if args.compare and compare_results(records, args.compare, args.tolerance):
+        sys.exit(1)
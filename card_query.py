@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+
+# Example runs:
+# python card_query.py build .\oracle-cards-*.json
+# python card_query.py query --name "Llanowar Elves" -k 20
+# python card_query.py query --text "Add {G}." -k 20
+# python card_query.py deck my-deck.txt -k 10
+
+import cardsim as cs
+import filesim_helper as fsh
+from card_store import StringTable
+
+import os
+import re
+import sys
+import json
+import mmap
+import bisect
+import struct
+import argparse
+import numpy as np
+
+DEFAULT_INDEX = os.path.join("card_data", "similarity-index.bin")
+
+# Index file layout: magic, format version, header length, JSON header, then each array section aligned to SECTION_ALIGN
+INDEX_MAGIC = b"MTGSIMIX"
+INDEX_VERSION = 2
+INDEX_PREFIX = struct.Struct("<8sII")
+SECTION_ALIGN = 64
+
+# Decklist lines: an optional count like "1" or "1x", the card name, then an optional set code and collector number
+DECK_LINE = re.compile(r"^(?:\d+x?\s+)?(.+?)(?:\s+\([A-Za-z0-9]+\)(?:\s+\S+)?)?(?:\s+\*[A-Z]\*)?$")
+DECK_SECTIONS = {"deck", "commander", "companion", "sideboard", "maybeboard", "mainboard"}
+
+
+def write_index(fname:str, meta:dict, sections:dict) -> None:
+    """
+    Write arrays to an index file, replacing it once the whole file is written.
+
+    Parameters:
+    - fname (str): Index file
+    - meta (dict): Values saved in the JSON header
+    - sections (dict): Arrays to save, {key= Section name, value= np.array}
+    """
+
+    # Lay the sections out after the header, the header's length depends on the offsets so they're recomputed until it fits
+    header_len = 0
+    while True:
+        offset = INDEX_PREFIX.size + header_len
+        layout = {}
+        for name, arr in sections.items():
+            offset += -offset % SECTION_ALIGN
+            layout[name] = {"offset": offset, "dtype": arr.dtype.str, "shape": list(arr.shape)}
+            offset += arr.nbytes
+        header = json.dumps({"meta": meta, "sections": layout}).encode("utf-8")
+        if len(header) <= header_len:
+            break
+        header_len = len(header) + 64
+
+    tmp_file = f"{fname}.tmp"
+    with open(tmp_file, "wb") as fd:
+        fd.write(INDEX_PREFIX.pack(INDEX_MAGIC, INDEX_VERSION, header_len))
+        fd.write(header.ljust(header_len))
+        for name, arr in sections.items():
+            fd.write(b"\0" * (layout[name]["offset"] - fd.tell()))
+            fd.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmp_file, fname)
+
+def read_index(fname:str) -> tuple[dict, dict]:
+    """
+    Memory-map an index file written by write_index. The arrays are read-only views of the mapped file, so processes
+    opening the same file share one copy of it in the page cache.
+
+    Parameters:
+    - fname (str): Index file
+
+    Returns:
+    - tuple: Header values (dict), and the arrays (dict) {key= Section name, value= np.array}
+    """
+
+    with open(fname, "rb") as fd:
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_len = INDEX_PREFIX.unpack_from(buf)
+    if magic != INDEX_MAGIC:
+        raise ValueError(f"\"{fname}\" is not a similarity index file.")
+    if version != INDEX_VERSION:
+        raise ValueError(f"\"{fname}\" is index version {version}, only version {INDEX_VERSION} can be read.")
+
+    header = json.loads(bytes(buf[INDEX_PREFIX.size:INDEX_PREFIX.size+header_len]))
+    sections = {}
+    for name, section in header["sections"].items():
+        dtype = np.dtype(section["dtype"])
+        count = int(np.prod(section["shape"], dtype=np.int64))
+        sections[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=section["offset"]).reshape(section["shape"])
+    return header["meta"], sections
+
+
+class SimilarityIndex:
+    """
+    Minhash signatures of a card pool and the LSH band buckets needed to find a card's most similar cards without
+    comparing it to every other card.
+    """
+
+    def __init__(self, names:StringTable, oracle_ids:StringTable, name_order:np.array, vocab:np.array, coeffs:np.array,
+                 signatures:np.array, bucket_keys:np.array, bucket_members:np.array, blocks:int, rows_per_block:int,
+                 shingles:str = fsh.DEFAULT_SHINGLES):
+        self.names = names                      # Card names, in card ID order
+        self.oracle_ids = oracle_ids            # Card oracle IDs, in card ID order
+        self.name_order = name_order            # Card IDs sorted by lowercase name, then card ID
+        self.vocab = vocab                      # Sorted important shingle codes
+        self.coeffs = coeffs                    # Minhash hashing function coefficients, size 2 by num_minhashes
+        self.signatures = signatures            # Minhash signatures, size n by num_minhashes
+        self.bucket_keys = bucket_keys          # Sorted band keys of each block, from cardsim.bucket_tables
+        self.bucket_members = bucket_members    # Card ID of each band key
+        self.blocks = blocks
+        self.rows_per_block = rows_per_block
+        self.shingles = shingles                # Shingling strategy the vocabulary was made with
+        self.name_ids = None                    # {key= Card name and lowercase card name, value= Card ID}, built on first use
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def build(cls, cards:list, num_minhashes:int = 144, blocks:int = 24, rows_per_block:int = 6, seed:int | None = None,
+              workers:int = 1, shingles:str = fsh.DEFAULT_SHINGLES) -> "SimilarityIndex":
+        """
+        Minhash a list of card dictionaries and bucket their signatures.
+
+        Parameters:
+        - cards (list): List of card dictionaries
+        - num_minhashes (int): The number of minhash steps to perform (default: 144)
+        - blocks (int): Number of blocks (default: 24)
+        - rows_per_block (int): Number of rows per block (default: 6)
+        - seed (int|None): Seed for the minhash hashing functions (default: None)
+        - workers (int): Number of processes used to shingle and minhash the cards (default: 1)
+        - shingles (str): Shingling strategy like "char:3" or "word:2+char:5", saved in the index (default: fsh.DEFAULT_SHINGLES)
+
+        Returns:
+        - SimilarityIndex: The index of the cards
+        """
+
+        if blocks * rows_per_block != num_minhashes:
+            raise ValueError(f"blocks*rows_per_block should be equal to num_minhashes, you had {blocks} blocks and "
+                             f"{rows_per_block} rows per block for {num_minhashes} minhashes.")
+
+        shingles = fsh.format_shingle_strategy(shingles)
+        coeffs = np.stack(cs.minhash_coefficients(num_minhashes, seed))
+        vocab, (indptr, inds) = cs.imp_shins(cards, minVal=4, workers=workers, shingles=shingles)
+        mat = cs.minhash((indptr, vocab[inds]), num_minhashes, coeffs=coeffs, workers=workers)
+        bucket_keys, bucket_members = cs.bucket_tables(*cs.band_keys(mat, blocks, rows_per_block))
+
+        names = [card["name"] for card in cards]
+        name_order = np.array(sorted(range(len(names)), key=lambda i: (names[i].lower(), i)), dtype=np.int64)
+        oracle_ids = [card.get("oracle_id") or "" for card in cards]
+        return cls(StringTable.from_list(names), StringTable.from_list(oracle_ids), name_order, vocab, coeffs,
+                   np.ascontiguousarray(mat.T), bucket_keys, bucket_members, blocks, rows_per_block, shingles)
+
+    def save(self, fname:str) -> None:
+        """Save the index to a versioned index file, see write_index"""
+
+        meta = {"blocks": self.blocks, "rows_per_block": self.rows_per_block, "num_minhashes": len(self.coeffs[0]),
+                "n_cards": len(self), "shingles": self.shingles, "shingle_bits": fsh.SHINGLE_BITS}
+        write_index(fname, meta, {
+            "vocab": self.vocab,
+            "coeffs": self.coeffs,
+            "signatures": self.signatures,
+            "bucket_keys": self.bucket_keys,
+            "bucket_members": self.bucket_members,
+            "name_offsets": self.names.offsets,
+            "names": self.names.blob,
+            "name_order": self.name_order,
+            "oracle_id_offsets": self.oracle_ids.offsets,
+            "oracle_ids": self.oracle_ids.blob,
+        })
+
+    @classmethod
+    def load(cls, fname:str) -> "SimilarityIndex":
+        """Memory-map an index saved with save, nothing is parsed or copied until it's used"""
+
+        meta, sections = read_index(fname)
+        if meta.get("shingle_bits") != fsh.SHINGLE_BITS:
+            raise ValueError(f"\"{fname}\" has {meta.get('shingle_bits')} bit shingle codes, rebuild it to use {fsh.SHINGLE_BITS} bit codes.")
+        return cls(StringTable(sections["name_offsets"], sections["names"]),
+                   StringTable(sections["oracle_id_offsets"], sections["oracle_ids"]), sections["name_order"],
+                   sections["vocab"], sections["coeffs"], sections["signatures"], sections["bucket_keys"],
+                   sections["bucket_members"], meta["blocks"], meta["rows_per_block"], meta["shingles"])
+
+    def card_id(self, name:str) -> int | None:
+        """Card ID of a card name, ignoring case if there's no exact match. None if the card isn't in the index."""
+
+        # Binary search the names sorted by lowercase name, only decoding the names that are compared
+        lower_names = LowerNames(self.names, self.name_order)
+        lo = bisect.bisect_left(lower_names, name.lower())
+        hi = bisect.bisect_right(lower_names, name.lower(), lo=lo)
+        matches = [int(card_id) for card_id in self.name_order[lo:hi]]
+        for card_id in matches:
+            if self.names[card_id] == name:
+                return card_id
+        return matches[0] if matches else None
+
+    def resolve_names(self, names:list) -> np.array:
+        """
+        Card IDs of many card names at once through a hash table of every name, built the first time it's needed.
+        Names are matched exactly first, then ignoring case, then like card_id.
+
+        Parameters:
+        - names (list): Card names
+
+        Returns:
+        - np.array: Card ID of each name, -1 for names that aren't in the index
+        """
+
+        if self.name_ids is None:
+            all_names = self.names.tolist()
+            self.name_ids = {name.lower(): card_id for card_id, name in reversed(list(enumerate(all_names)))}
+            self.name_ids.update({name: card_id for card_id, name in reversed(list(enumerate(all_names)))})
+
+        card_ids = np.full(len(names), -1, dtype=np.int64)
+        for i, name in enumerate(names):
+            card_id = self.name_ids.get(name, self.name_ids.get(name.lower()))
+            if card_id is None:
+                card_id = self.card_id(name)
+            card_ids[i] = -1 if card_id is None else card_id
+        return card_ids
+
+    def text_signature(self, text:str) -> np.array:
+        """
+        Minhash signature of some oracle text, using the index's shingling strategy, important shingles and hashing functions.
+
+        Parameters:
+        - text (str): Oracle text, using ~ in place of the card's own name
+
+        Returns:
+        - np.array: Signature of length num_minhashes, all 0s if the text has no important shingles
+        """
+
+        text = fsh.REMINDER_TEXT.sub('', text)
+        ptr, codes = fsh.shingle_texts([text], self.shingles)
+        codes = codes[np.isin(codes, self.vocab, assume_unique=True)]
+        return cs.minhash((np.array([0, len(codes)]), codes), len(self.coeffs[0]), coeffs=self.coeffs)[:, 0]
+
+    def candidates(self, signature:np.array) -> np.array:
+        """
+        Card IDs of every card sharing at least one band bucket with a signature.
+
+        Parameters:
+        - signature (np.array): Signature of length num_minhashes
+
+        Returns:
+        - np.array: Sorted card IDs
+        """
+
+        keys, valid = cs.band_keys(signature[:, None], self.blocks, self.rows_per_block)
+        if not valid.all():
+            return np.empty(0, dtype=np.int64)
+
+        found = []
+        for b in range(self.blocks):
+            lo = np.searchsorted(self.bucket_keys[b], keys[b, 0], side="left")
+            hi = np.searchsorted(self.bucket_keys[b], keys[b, 0], side="right")
+            found.append(self.bucket_members[b, lo:hi])
+        return np.unique(np.concatenate(found))
+
+    def rank(self, signature:np.array, card_ids:np.array, k:int) -> list:
+        """
+        Rank cards by their estimated Jaccard similarity to a signature, the fraction of equal minhash values.
+
+        Parameters:
+        - signature (np.array): Signature of length num_minhashes
+        - card_ids (np.array): Card IDs to rank
+        - k (int): Number of cards to return
+
+        Returns:
+        - list: Up to k (card ID, similarity) tuples, most similar first
+        """
+
+        if len(card_ids) == 0:
+            return []
+        scores = np.mean(self.signatures[card_ids] == signature, axis=1)
+        # Highest score first, ties broken by card ID
+        order = np.lexsort((card_ids, -scores))[:k]
+        return [(int(card_ids[i]), float(scores[i])) for i in order]
+
+    def batch_candidates(self, signatures:np.array) -> tuple[np.array, np.array]:
+        """
+        Every (query, card) pair sharing at least one band bucket, for many signatures at once.
+
+        Parameters:
+        - signatures (np.array): Signatures of size m by num_minhashes
+
+        Returns:
+        - tuple: Query row (np.array) and card ID (np.array) of each pair, sorted by query row then card ID
+        """
+
+        m = len(signatures)
+        keys, valid = cs.band_keys(np.ascontiguousarray(signatures.T), self.blocks, self.rows_per_block)
+        usable = valid.all(axis=0)
+
+        codes = []
+        for b in range(self.blocks):
+            lo = np.searchsorted(self.bucket_keys[b], keys[b], side="left")
+            hi = np.searchsorted(self.bucket_keys[b], keys[b], side="right")
+            counts = np.where(usable, hi - lo, 0)
+
+            # Expand each query's bucket range [lo, hi) into positions in the table
+            rows = np.repeat(np.arange(m), counts)
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            members = self.bucket_members[b, starts + np.arange(len(rows))]
+            codes.append(rows * len(self) + members)
+
+        codes = np.unique(np.concatenate(codes)) if codes else np.empty(0, dtype=np.int64)
+        return np.divmod(codes, len(self))
+
+    def batch_query(self, names:list, k:int = 20, exclude_deck:bool = True, exhaustive:bool = False,
+                    chunk_size:int = 1 << 16) -> dict:
+        """
+        Find the k most similar cards to every card of a decklist in one pass. The names are resolved together,
+        the band bucket candidates of all the cards are gathered at once and scored with vectorized signature
+        comparisons. Like query, cards with fewer than k candidates get fewer results unless exhaustive is set.
+
+        Parameters:
+        - names (list): Card names, names of the same card are only queried once
+        - k (int): Number of cards to return for each card (default: 20)
+        - exclude_deck (bool): Don't suggest cards that are already in the deck (default: True)
+        - exhaustive (bool): Compare with every card instead of only the band bucket candidates (default: False)
+        - chunk_size (int): Maximum number of pairs compared at once (default: 2^16)
+
+        Returns:
+        - dict: {"results": {key= Card name in the index, value= Up to k (card ID, similarity) tuples, most similar first},
+                 "missing": Names not in the index,
+                 "suggestions": Every suggested card once, as (card ID, best similarity, names it was suggested for),
+                                most similar first}
+        """
+
+        names = list(dict.fromkeys(names))
+        card_ids = self.resolve_names(names)
+        missing = [name for name, card_id in zip(names, card_ids) if card_id < 0]
+
+        # Names resolving to the same card, like different capitalisations, are queried once
+        deck = np.array(list(dict.fromkeys(card_ids[card_ids >= 0].tolist())), dtype=np.int64)
+        found = [self.names[card_id] for card_id in deck.tolist()]
+        signatures = self.signatures[deck]
+
+        # Candidates of every deck card, without the card itself or the rest of the deck
+        rows, cands = self.batch_candidates(signatures)
+        keep = ~np.isin(cands, deck) if exclude_deck else cands != deck[rows]
+        rows, cands = rows[keep], cands[keep]
+
+        scores = np.empty(len(rows))
+        for start in range(0, len(rows), chunk_size):
+            stop = start + chunk_size
+            scores[start:stop] = np.mean(signatures[rows[start:stop]] == self.signatures[cands[start:stop]], axis=1)
+
+        # Keep the k best of each deck card: highest score first, ties broken by card ID
+        order = np.lexsort((cands, -scores, rows))
+        rows, cands, scores = rows[order], cands[order], scores[order]
+        first = np.searchsorted(rows, np.arange(len(deck)))
+        rank = np.arange(len(rows)) - first[rows]
+        top = rank < k
+
+        results = {name: [] for name in found}
+        for row, card_id, score in zip(rows[top].tolist(), cands[top].tolist(), scores[top].tolist()):
+            results[found[row]].append((card_id, score))
+
+        if exhaustive:
+            everything = np.arange(len(self))
+            for row, name in enumerate(found):
+                others = everything[~np.isin(everything, deck)] if exclude_deck else everything[everything != deck[row]]
+                results[name] = self.rank(signatures[row], others, k)
+
+        # Each suggested card once, with its best score across the deck
+        suggestions = {}
+        for name, ranked in results.items():
+            for card_id, score in ranked:
+                best, for_names = suggestions.get(card_id, (0.0, []))
+                suggestions[card_id] = (max(best, score), for_names + [name])
+        suggestions = sorted(((card_id, score, for_names) for card_id, (score, for_names) in suggestions.items()),
+                             key=lambda s: (-s[1], s[0]))
+
+        return {"results": results, "missing": missing, "suggestions": suggestions}
+
+    def query(self, name:str | None = None, text:str | None = None, k:int = 20, exhaustive:bool = False) -> list:
+        """
+        Find the k cards most similar to a card in the index or to some oracle text. Only cards sharing a band bucket
+        with it are compared, so fewer than k cards are returned when there are fewer candidates. Setting exhaustive
+        compares every card instead, which is O(n) in the size of the index.
+
+        Parameters:
+        - name (str|None): Name of a card in the index (default: None)
+        - text (str|None): Oracle text to use when name is None (default: None)
+        - k (int): Number of cards to return (default: 20)
+        - exhaustive (bool): Compare with every card instead of only the band bucket candidates (default: False)
+
+        Returns:
+        - list: Up to k (card ID, similarity) tuples, most similar first. A card isn't returned for its own name.
+        """
+
+        exclude = None
+        if name is not None:
+            exclude = self.card_id(name)
+            if exclude is None:
+                raise KeyError(f"'{name}' is not a card in the index.")
+            signature = self.signatures[exclude]
+        elif text is not None:
+            signature = self.text_signature(text)
+        else:
+            raise ValueError("A card name or oracle text is needed to query the index.")
+
+        card_ids = self.candidates(signature)
+        if exclude is not None:
+            card_ids = card_ids[card_ids != exclude]
+        if exhaustive:
+            card_ids = np.arange(len(self))
+            if exclude is not None:
+                card_ids = card_ids[card_ids != exclude]
+        return self.rank(signature, card_ids, k)
+
+
+def read_decklist(fname:str) -> list:
+    """
+    Card names of a decklist file with one card per line, like "1 Llanowar Elves" or "1x Sol Ring (C21) 263".
+    Empty lines, comments starting with # or // and section headers like "Sideboard" are skipped.
+
+    Parameters:
+    - fname (str): Decklist file
+
+    Returns:
+    - list: Card names in file order
+    """
+
+    names = []
+    with open(fname, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(("#", "//")) or line.rstrip(":").lower() in DECK_SECTIONS:
+                continue
+            names.append(DECK_LINE.match(line).group(1))
+    return names
+
+
+class LowerNames:
+    """Lowercase card names in name_order order, decoded when they're accessed"""
+
+    def __init__(self, names:StringTable, name_order:np.array):
+        self.names = names
+        self.name_order = name_order
+
+    def __len__(self) -> int:
+        return len(self.name_order)
+
+    def __getitem__(self, i:int) -> str:
+        return self.names[self.name_order[i]].lower()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the cards most similar to a card or some oracle text.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Build the similarity index of a card pool")
+    build_parser.add_argument("oracle_cards_file", nargs="?", default=None,
+                              help="oracle-cards JSON file, automatically retrieved if not given")
+    build_parser.add_argument("--index", default=DEFAULT_INDEX, help=f"Index file to write (default: {DEFAULT_INDEX})")
+    build_parser.add_argument("--num-minhashes", type=int, default=144)
+    build_parser.add_argument("--blocks", type=int, default=24)
+    build_parser.add_argument("--rows-per-block", type=int, default=6)
+    build_parser.add_argument("--seed", type=int, default=None)
+    build_parser.add_argument("--workers", type=int, default=1)
+    build_parser.add_argument("--shingles", default=fsh.DEFAULT_SHINGLES, type=fsh.format_shingle_strategy,
+                              help=f"Shingling strategy like 'char:3', 'word:2' or 'word:2+char:5' (default: {fsh.DEFAULT_SHINGLES})")
+
+    query_parser = subparsers.add_parser("query", help="Find the most similar cards")
+    target = query_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--name", help="Name of a card in the index")
+    target.add_argument("--text", help="Oracle text, using ~ for the card's own name")
+    query_parser.add_argument("-k", type=int, default=20, help="Number of cards to return (default: 20)")
+    query_parser.add_argument("--index", default=DEFAULT_INDEX, help=f"Index file to read (default: {DEFAULT_INDEX})")
+    query_parser.add_argument("--exhaustive", action="store_true", help="Compare with every card in the index")
+
+    deck_parser = subparsers.add_parser("deck", help="Find the most similar cards to every card of a decklist")
+    deck_parser.add_argument("decklist", help="Decklist file with one card per line, like '1 Llanowar Elves'")
+    deck_parser.add_argument("-k", type=int, default=10, help="Number of cards to return for each card (default: 10)")
+    deck_parser.add_argument("--index", default=DEFAULT_INDEX, help=f"Index file to read (default: {DEFAULT_INDEX})")
+    deck_parser.add_argument("--include-deck", action="store_true", help="Also suggest cards that are already in the deck")
+    deck_parser.add_argument("--exhaustive", action="store_true", help="Compare with every card in the index")
+    deck_parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        cards = cs.get_card_list(args.oracle_cards_file, workers=args.workers)
+        index = SimilarityIndex.build(cards, args.num_minhashes, args.blocks, args.rows_per_block, args.seed, args.workers,
+                                      args.shingles)
+        index.save(args.index)
+        print(f"Saved the index of {len(index)} cards to '{args.index}'")
+    elif args.command == "deck":
+        if not os.path.isfile(args.index):
+            print(f"\"{args.index}\" is not a file or cannot be found. Run '{sys.argv[0]} build' first.", file=sys.stderr)
+            sys.exit()
+        index = SimilarityIndex.load(args.index)
+        batch = index.batch_query(read_decklist(args.decklist), k=args.k, exclude_deck=not args.include_deck,
+                                  exhaustive=args.exhaustive)
+
+        if args.json:
+            print(json.dumps({
+                "results": {name: [{"name": index.names[card_id], "similarity": score} for card_id, score in ranked]
+                            for name, ranked in batch["results"].items()},
+                "missing": batch["missing"],
+                "suggestions": [{"name": index.names[card_id], "similarity": score, "for": for_names}
+                                for card_id, score, for_names in batch["suggestions"]],
+            }, indent=2))
+        else:
+            for name, ranked in batch["results"].items():
+                print(f"\n{name}:")
+                for rank, (card_id, score) in enumerate(ranked, start=1):
+                    print(f"{rank:>3}. {score:.3f}  {index.names[card_id]}")
+            print(f"\n{len(batch['suggestions'])} different cards suggested for {len(batch['results'])} cards.")
+            if batch["missing"]:
+                print(f"Not in the index: {', '.join(batch['missing'])}", file=sys.stderr)
+    else:
+        if not os.path.isfile(args.index):
+            print(f"\"{args.index}\" is not a file or cannot be found. Run '{sys.argv[0]} build' first.", file=sys.stderr)
+            sys.exit()
+        index = SimilarityIndex.load(args.index)
+        try:
+            results = index.query(name=args.name, text=args.text, k=args.k, exhaustive=args.exhaustive)
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            sys.exit()
+        for rank, (card_id, score) in enumerate(results, start=1):
+            print(f"{rank:>3}. {score:.3f}  {index.names[card_id]}")
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# In-memory search index over the custom card list, answering the same patterns as the GUI's search widget.
+# Example:
+#   index = SearchIndex(cards)
+#   index.matches([{"parameter": "oracle_text", "value": "draw a card", "logic_op": "and"},
+#                  {"parameter": "colors", "value": "G", "logic_op": "not"}])
+
+from card_store import CardStore, COLOR_BITS
+import filesim_helper as fsh
+
+import operator
+import numpy as np
+
+TEXT_FIELDS = ("name", "oracle_text", "type_line")
+COLOR_FIELDS = ("colors", "color_identity")
+
+
+def compare(comparison_op:str, a:int, b:int) -> bool:
+    comparison_ops = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        ">=": operator.ge,
+        "<=": operator.le,
+        ">": operator.gt,
+        "<": operator.lt,
+    }
+    if not comparison_ops.get(comparison_op):
+        raise ValueError(f"Invalid operator: '{comparison_op}'")
+    return comparison_ops[comparison_op](a, b)
+
+# Parse color-based search terms, returns a list of color abbreviations
+def parse_colors(color_pattern : str) -> list:
+    colors = {"white":"W", "blue":"U", "red":"R", "black":"B", "green":"G", "colorless":"C"}
+    search_colors = set()
+    split_pattern = color_pattern.split()
+
+    # Parse colors for searching
+    for search_color in split_pattern:
+        # Turn "red white" into {"R", "W"}
+        if search_color.lower() in colors.keys():
+            search_colors.add(colors[search_color.lower()])
+        # Turn "UBG" into {"U", "B", "G"}
+        else:
+            for char in search_color:
+                if char in "WUBRGC":
+                    search_colors.add(char)
+
+
+    # Colorless can only be searched with an empty color list
+    if "C" in search_colors:
+        return []
+
+    return list(search_colors)
+
+
+class TextPostings:
+    """
+    Trigram postings of one text field: for every trigram, the sorted indices of the cards whose lowercased text
+    contains it. A substring query is answered by intersecting the postings of its trigrams, then checking the
+    remaining cards' text.
+    """
+
+    def __init__(self, texts:list):
+        self.texts = texts      # Lowercased text of each card
+
+        # Each card's distinct trigrams, packed into integers, then sorted by trigram then card
+        ptr, codes = fsh.kshingle_codes(texts, 3)
+        card_ids = np.repeat(np.arange(len(texts), dtype=np.int32), np.diff(ptr))
+        order = np.lexsort((card_ids, codes))
+        codes, self.cards = codes[order], card_ids[order]
+
+        # Postings of trigram i are cards[indptr[i]:indptr[i+1]]
+        self.trigrams, starts = np.unique(codes, return_index=True)
+        self.indptr = np.append(starts, len(codes))
+
+    def postings(self, code:int) -> np.array:
+        i = np.searchsorted(self.trigrams, code)
+        if i == len(self.trigrams) or self.trigrams[i] != code:
+            return self.cards[:0]
+        return self.cards[self.indptr[i]:self.indptr[i+1]]
+
+    def search(self, query:str) -> np.array:
+        """
+        Cards whose text contains the query, ignoring case.
+
+        Parameters:
+        - query (str): Substring to look for
+
+        Returns:
+        - np.array: Boolean mask of the matching cards
+        """
+
+        query = query.lower()
+        mask = np.zeros(len(self.texts), dtype=bool)
+
+        # Too short to have a trigram
+        if len(query) < 3:
+            mask[[i for i, text in enumerate(self.texts) if query in text]] = True
+            return mask
+
+        # Intersect the postings of the query's trigrams, shortest first
+        lists = sorted((self.postings(code) for code in fsh.kshingle_codes([query], 3)[1].tolist()), key=len)
+        candidates = lists[0]
+        for postings in lists[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, postings, assume_unique=True)
+
+        # Having all the trigrams doesn't mean they're in the same order
+        if len(query) > 3:
+            candidates = [i for i in candidates.tolist() if query in self.texts[i]]
+        mask[candidates] = True
+        return mask
+
+
+class SearchIndex:
+    """
+    Search index of a card list, built once. Each search pattern is answered with a boolean mask over the cards,
+    and the patterns are combined in order: "and" intersects, "or" unions and "not" removes the pattern's cards.
+    """
+
+    def __init__(self, cards:list | CardStore):
+        self.cards = cards
+
+        # A card store already has its fields as columns
+        if isinstance(cards, CardStore):
+            self.text = {field: TextPostings([(text or "").lower() for text in cards.column(field)]) for field in TEXT_FIELDS}
+            self.color_bits = {field: cards.color_bits(field) for field in COLOR_FIELDS}
+            cmc = np.array([int(value or 0) for value in cards.column("cmc", default=0)], dtype=np.int64)
+            sim_ids = cards.column("similarity_id")
+        else:
+            self.text = {field: TextPostings([(card.get(field) or "").lower() for card in cards]) for field in TEXT_FIELDS}
+            self.color_bits = {field: np.array([sum(COLOR_BITS.get(c, 0) for c in card.get(field) or []) for card in cards], dtype=np.uint8)
+                               for field in COLOR_FIELDS}
+            cmc = np.array([int(card.get("cmc") or 0) for card in cards], dtype=np.int64)
+            sim_ids = [card.get("similarity_id") for card in cards]
+
+        # Cards sorted by mana value, compared as integers like the widget does
+        self.cmc_order = np.argsort(cmc, kind="stable")
+        self.cmc_sorted = cmc[self.cmc_order]
+
+        self.similarity_groups = {}     # {key= Similarity ID, value= Indices of its cards}
+        for i, sim_id in enumerate(sim_ids):
+            self.similarity_groups.setdefault(sim_id, []).append(i)
+
+    def pattern_mask(self, pattern:dict) -> np.array:
+        """
+        Cards matching a single search pattern.
+
+        Parameters:
+        - pattern (dict): {"parameter": Card key, "value": Search value, "compare_op": Optional comparison operator}
+
+        Returns:
+        - np.array: Boolean mask of the matching cards
+        """
+
+        param, value = pattern["parameter"], pattern["value"]
+        mask = np.zeros(len(self.cards), dtype=bool)
+
+        # Patterns that have a comparison operator
+        if pattern.get("compare_op"):
+            if param != "cmc":
+                raise ValueError(f"Comparisons aren't supported on '{param}'")
+            op, value = pattern["compare_op"], int(value)
+            compare(op, 0, 0)       # Check the operator
+            left = np.searchsorted(self.cmc_sorted, value, side="left")
+            right = np.searchsorted(self.cmc_sorted, value, side="right")
+            lo, hi = {"==": (left, right), "!=": (left, right), ">=": (left, None), "<=": (0, right),
+                      ">": (right, None), "<": (0, left)}[op]
+            mask[self.cmc_order[lo:hi]] = True
+            return ~mask if op == "!=" else mask
+
+        if not isinstance(value, str) and param != "similarity_id":
+            raise ValueError(f"The value of a '{param}' pattern must be a string")
+
+        # Color fields, every searched color or exactly colorless
+        if param in COLOR_FIELDS:
+            wanted = sum(COLOR_BITS[c] for c in parse_colors(value))
+            bits = self.color_bits[param]
+            return (bits & wanted) == wanted if wanted else bits == 0
+
+        if param == "similarity_id":
+            mask[self.similarity_groups.get(int(value), [])] = True
+            return mask
+
+        if param in TEXT_FIELDS:
+            return self.text[param].search(value)
+
+        raise ValueError(f"Unknown search parameter '{param}'")
+
+    def search(self, patterns:list) -> np.array:
+        """
+        Combine the patterns in order, starting from every card for "not" and no card for the rest.
+
+        Parameters:
+        - patterns (list): List of pattern dictionaries with a "logic_op" of "and", "or" or "not"
+
+        Returns:
+        - np.array: Indices of the matching cards in ascending order, every card if there are no patterns
+        """
+
+        result = None
+        for pattern in patterns:
+            op = pattern.get("logic_op", "and")
+            if op not in ("and", "or", "not"):
+                raise ValueError(f"Invalid logic operator: '{op}'")
+            mask = self.pattern_mask(pattern)
+            if result is None:
+                result = ~mask if op == "not" else mask
+            elif op == "and":
+                result &= mask
+            elif op == "or":
+                result |= mask
+            else:
+                result &= ~mask
+
+        if result is None:
+            return np.arange(len(self.cards))
+        return np.flatnonzero(result)
+
+    def matches(self, patterns:list) -> list:
+        return [self.cards[i] for i in self.search(patterns).tolist()]
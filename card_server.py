@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# Local JSON HTTP service keeping the card list, search index and similarity index loaded.
+# Example run:
+# python card_server.py --port 8765
+# curl "http://127.0.0.1:8765/group?name=Llanowar%20Elves"
+# curl "http://127.0.0.1:8765/similar?name=Llanowar%20Elves&k=10"
+# curl "http://127.0.0.1:8765/search?oracle_text=draw%20a%20card&colors=G&cmc=%3C%3D3&not.type_line=creature"
+# curl -X POST -d '{"names": ["Llanowar Elves", "Sol Ring"], "k": 5}' http://127.0.0.1:8765/deck
+
+from card_query import SimilarityIndex, DEFAULT_INDEX
+from card_search import SearchIndex
+from cardsim import load_cards, CARD_FORMATS
+
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PORT = 8765
+MAX_BODY = 1 << 20
+SEARCH_LIMIT = 100      # Default and largest number of cards a search returns
+COMPARE_OPS = ("==", "!=", ">=", "<=", ">", "<")
+LOGIC_OPS = ("and", "or", "not")
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+
+def latest_cards_file(dir:str) -> str | None:
+    # Newest refined-cards-<date> file written by get_custom_cards, preferring npz then jsonl then json for the same date
+    preference = {ext: i for i, ext in enumerate(CARD_FORMATS.values())}
+    files = [fname for ext in CARD_FORMATS.values() for fname in glob.glob(os.path.join(dir, f"refined-cards-*{ext}"))
+             if ".tmp" not in os.path.basename(fname)]      # Skip files still being written
+    files.sort(key=lambda fname: (os.path.splitext(os.path.basename(fname))[0], preference[os.path.splitext(fname)[1]]))
+    return files[-1] if files else None
+
+
+class ServerState:
+    """Everything a request needs, loaded together so a reload can replace it in one assignment."""
+
+    def __init__(self, cards_file:str, index_file:str):
+        self.cards = load_cards(cards_file)
+        self.search = SearchIndex(self.cards)
+        self.by_name = {}       # {key= Lowercased name, value= Card index}
+        for i, name in enumerate(self.cards.column("name", default="")):
+            self.by_name.setdefault(name.lower(), i)
+
+        self.index = SimilarityIndex.load(index_file) if os.path.isfile(index_file) else None
+        self.sources = {fname: os.path.getmtime(fname) for fname in (cards_file, index_file) if os.path.isfile(fname)}
+        self.loaded_at = time.time()
+
+    def card(self, name:str) -> dict:
+        i = self.by_name.get(name.lower())
+        if i is None:
+            raise HTTPError(404, f"'{name}' is not a card in the card list.")
+        return self.cards[i]
+
+
+# Request handlers, run on the server's threads. Each takes the state, the query parameters and the JSON body.
+
+def handle_health(state:ServerState, params:dict, body) -> dict:
+    return {
+        "cards": len(state.cards),
+        "indexed_cards": len(state.index) if state.index else 0,
+        "groups": len(state.search.similarity_groups),
+        "loaded_at": state.loaded_at,
+        "sources": state.sources,
+    }
+
+def handle_group(state:ServerState, params:dict, body) -> dict:
+    if "name" in params:
+        sim_id = state.card(params["name"]).get("similarity_id")
+    elif "id" in params:
+        sim_id = int(params["id"])
+    else:
+        raise HTTPError(400, "A card name or similarity id is needed.")
+    members = state.search.similarity_groups.get(sim_id)
+    if members is None:
+        raise HTTPError(404, f"There is no group with similarity id {sim_id}.")
+    return {"similarity_id": sim_id, "cards": [state.cards[i] for i in members]}
+
+def handle_similar(state:ServerState, params:dict, body) -> dict:
+    if state.index is None:
+        raise HTTPError(503, "No similarity index is loaded, build it with 'card_query.py build'.")
+    k = int(params.get("k", 20))
+    try:
+        results = state.index.query(name=params.get("name"), text=params.get("text"), k=k,
+                                    exhaustive=params.get("exhaustive", "false").lower() in ("1", "true", "yes"))
+    except KeyError as e:
+        raise HTTPError(404, e.args[0])
+
+    similar = []
+    for card_id, score in results:
+        name = state.index.names[card_id]
+        i = state.by_name.get(name.lower())
+        similar.append({"name": name, "similarity": score, "card": state.cards[i] if i is not None else None})
+    return {"similar": similar}
+
+def handle_deck(state:ServerState, params:dict, body) -> dict:
+    if state.index is None:
+        raise HTTPError(503, "No similarity index is loaded, build it with 'card_query.py build'.")
+    if not isinstance(body, dict) or not isinstance(body.get("names"), list):
+        raise HTTPError(400, "The body needs a list of card names, like {\"names\": [\"Llanowar Elves\"]}.")
+    batch = state.index.batch_query([str(name) for name in body["names"]], k=int(body.get("k", 20)),
+                                    exclude_deck=bool(body.get("exclude_deck", True)),
+                                    exhaustive=bool(body.get("exhaustive", False)))
+    names = state.index.names
+    return {
+        "results": {name: [{"name": names[card_id], "similarity": score} for card_id, score in ranked]
+                    for name, ranked in batch["results"].items()},
+        "missing": batch["missing"],
+        "suggestions": [{"name": names[card_id], "similarity": score, "for": for_names}
+                        for card_id, score, for_names in batch["suggestions"]],
+    }
+
+def search_patterns(params:list) -> list:
+    # Query parameters to search patterns: field=value, or.field=value and not.field=value, cmc values can start with an operator
+    patterns = []
+    for key, value in params:
+        if key in ("limit", "offset"):
+            continue
+        logic_op, _, field = key.rpartition(".")
+        pattern = {"parameter": field, "value": value, "logic_op": logic_op or "and"}
+        if field == "cmc":
+            op = next((op for op in COMPARE_OPS if value.startswith(op)), "==")
+            pattern["compare_op"] = op
+            pattern["value"] = value[len(op):] if value.startswith(op) else value
+        patterns.append(pattern)
+    return patterns
+
+def check_patterns(patterns) -> list:
+    # Search patterns of a POST body, with the keys and value types the search index expects
+    if not isinstance(patterns, list):
+        raise HTTPError(400, "\"patterns\" must be a list of search patterns.")
+    for pattern in patterns:
+        if not isinstance(pattern, dict) or not isinstance(pattern.get("parameter"), str):
+            raise HTTPError(400, f"Invalid search pattern {pattern!r}, it needs a \"parameter\" string.")
+        unknown = pattern.keys() - {"parameter", "value", "logic_op", "compare_op"}
+        if unknown:
+            raise HTTPError(400, f"Unknown search pattern keys: {', '.join(sorted(unknown))}")
+        # Numbers are fine where the value is read as one, everything else is matched as text
+        numeric = pattern.get("compare_op") or pattern["parameter"] == "similarity_id"
+        value = pattern.get("value")
+        if not (isinstance(value, str) or numeric and type(value) is int):
+            raise HTTPError(400, f"Invalid value {value!r} for the search parameter '{pattern['parameter']}'.")
+        if pattern.get("logic_op", "and") not in LOGIC_OPS:
+            raise HTTPError(400, f"Invalid logic operator {pattern['logic_op']!r}, expected one of {', '.join(LOGIC_OPS)}.")
+        if not isinstance(pattern.get("compare_op"), (str, type(None))):
+            raise HTTPError(400, "\"compare_op\" must be a string.")
+    return patterns
+
+def handle_search(state:ServerState, params:dict, body) -> dict:
+    if body is not None and not isinstance(body, dict):
+        raise HTTPError(400, "The body must be a JSON object, like {\"patterns\": [...]}.")
+    patterns = check_patterns(body.get("patterns", [])) if body is not None else search_patterns(params["_pairs"])
+    matches = state.search.search(patterns)
+    offset, limit = int(params.get("offset", 0)), int(params.get("limit", SEARCH_LIMIT))
+    if offset < 0 or limit < 0:
+        raise HTTPError(400, "offset and limit can't be negative.")
+    limit = min(limit, SEARCH_LIMIT)
+    return {"total": len(matches), "cards": [state.cards[i] for i in matches[offset:offset+limit].tolist()]}
+
+ROUTES = {
+    ("GET", "/health"): handle_health,
+    ("GET", "/group"): handle_group,
+    ("GET", "/similar"): handle_similar,
+    ("GET", "/search"): handle_search,
+    ("POST", "/search"): handle_search,
+    ("POST", "/deck"): handle_deck,
+}
+
+
+class CardServer:
+    """
+    asyncio HTTP/1.1 server answering JSON requests from a preloaded ServerState. Handlers run on a thread pool so
+    the event loop keeps accepting requests, NumPy releases the GIL for the heavy parts of the queries. The state is
+    reloaded in the background when the card list or index files change, or on POST /reload, and replaced atomically:
+    requests in progress finish with the state they started with.
+    """
+
+    def __init__(self, dir:str = "card_data", index_file:str = DEFAULT_INDEX, workers:int = 4, watch_interval:float = 60):
+        self.dir = dir
+        self.index_file = index_file
+        self.watch_interval = watch_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.state = None
+        self.reload_lock = None
+
+    def load(self) -> ServerState:
+        cards_file = latest_cards_file(self.dir)
+        if cards_file is None:
+            raise FileNotFoundError(f"No refined-cards-* file in '{self.dir}', run gui.py or get_custom_cards first.")
+        return ServerState(cards_file, self.index_file)
+
+    def changed(self) -> bool:
+        cards_file = latest_cards_file(self.dir)
+        current = {fname: os.path.getmtime(fname) for fname in (cards_file, self.index_file) if fname and os.path.isfile(fname)}
+        return current != self.state.sources
+
+    async def reload(self) -> ServerState:
+        async with self.reload_lock:
+            state = await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+            self.state = state      # Atomic swap, later requests see the new state
+            print(f"Loaded {len(state.cards)} cards and {len(state.index) if state.index else 0} indexed cards", file=sys.stderr)
+            return state
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                if self.changed():
+                    await self.reload()
+            except (OSError, ValueError) as e:
+                print(f"Reload failed, still serving the previous data: {e}", file=sys.stderr)
+
+    async def respond(self, method:str, target:str, body:bytes) -> tuple[int, bytes]:
+        url = urlsplit(target)
+        pairs = parse_qsl(url.query)
+        params = dict(pairs)
+        params["_pairs"] = pairs
+
+        try:
+            if (method, url.path) == ("POST", "/reload"):
+                state = await self.reload()
+                return 200, json.dumps({"cards": len(state.cards), "loaded_at": state.loaded_at}).encode()
+
+            handler = ROUTES.get((method, url.path))
+            if handler is None:
+                status = 405 if any(path == url.path for _, path in ROUTES) else 404
+                raise HTTPError(status, f"No route for {method} {url.path}")
+            data = json.loads(body) if body else None
+
+            # Serialise on the thread too, large responses take a while. Cards are CardViews, dumped as dictionaries
+            state = self.state
+            run = lambda: json.dumps(handler(state, params, data), default=dict).encode()
+            return 200, await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        except HTTPError as e:
+            status, message = e.status, str(e)
+        except (ValueError, TypeError, KeyError) as e:
+            status, message = 400, str(e)
+        except OSError as e:
+            status, message = 500, str(e)
+        except Exception as e:
+            # Anything else is a bug, but the client still gets an answer
+            print(f"Error answering {method} {target}: {e!r}", file=sys.stderr)
+            status, message = 500, f"Internal error: {e!r}"
+        return status, json.dumps({"error": message}).encode()
+
+    async def handle_connection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, payload = 413, json.dumps({"error": "Request body too large"}).encode()
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.respond(method, target, body)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+                writer.write(f"{version} {status} {STATUS_TEXT[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host:str, port:int) -> None:
+        self.reload_lock = asyncio.Lock()
+        await self.reload()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port}", file=sys.stderr)
+        async with server:
+            if self.watch_interval > 0:
+                asyncio.get_running_loop().create_task(self.watch())
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve card groups, similar cards and searches over HTTP.")
+    parser.add_argument("--dir", default="card_data", help="Directory of the refined-cards-* files (default: card_data)")
+    parser.add_argument("--index", default=DEFAULT_INDEX, help=f"Similarity index file (default: {DEFAULT_INDEX})")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=4, help="Threads answering requests (default: 4)")
+    parser.add_argument("--watch", type=float, default=60, help="Seconds between checks for new data files, 0 to disable (default: 60)")
+    args = parser.parse_args()
+
+    server = CardServer(args.dir, args.index, args.workers, args.watch)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        sys.exit()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+# Compact columnar store of a card list. Numbers are kept in typed arrays, repeated strings like set names once in a
+# table, colours as bitmasks, and every card is a lightweight view that only builds the values it's asked for.
+# Example:
+#   store = CardStore.from_cards(fsh.iter_json_array("card_data/refined-cards-2025-01-01.json"))
+#   store[0]["name"], store.column("cmc"), store.color_bits("colors")
+#   store.save("card_data/refined-cards-2025-01-01.npz"), CardStore.load("card_data/refined-cards-2025-01-01.npz")
+
+import os
+import json
+import numpy as np
+from collections.abc import Mapping
+
+COLOR_BITS = {color: 1 << i for i, color in enumerate("WUBRG")}
+
+# How each field of the refined cards is stored, other fields are stored as JSON text
+FIELD_KINDS = {
+    "card_id": "int", "similarity_id": "int", "cmc": "float", "multifaced": "bool",
+    "colors": "colors", "color_identity": "colors",
+    "set_name": "interned", "rarity": "interned", "artist": "interned", "type_line": "interned",
+    "released_at": "interned", "mana_cost": "interned",
+    "name": "text", "oracle_text": "text", "flavor_text": "text", "uri": "text", "scryfall_uri": "text",
+    "collector_number": "text", "oracle_id": "text",
+}
+NUMBER_TYPES = {"int": (int, np.int64), "float": (float, np.float64), "bool": (bool, np.bool_)}
+
+# State of a field in each card
+MISSING, NULL, PRESENT = 0, 1, 2
+# Version of the files written by CardStore.save
+CARD_STORE_VERSION = 1
+
+LIST_SEP = "\x1f"       # Separates the values of a colour list in its table entry
+_ABSENT = object()      # Placeholder for a field a card doesn't have while the columns are built
+
+
+class StringTable:
+    """Read-only list of strings stored as one UTF-8 blob and the offset of each string in it."""
+
+    def __init__(self, offsets:np.array, blob:np.array):
+        self.offsets = offsets      # Length n+1, string i is blob[offsets[i]:offsets[i+1]]
+        self.blob = blob            # uint8 array of the encoded strings
+
+    @classmethod
+    def from_list(cls, strings:list) -> "StringTable":
+        blob = "".join(strings).encode("utf-8")
+        offsets = np.zeros(len(strings)+1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, strings), dtype=np.int64, count=len(strings)), out=offsets[1:])
+        if offsets[-1] != len(blob):
+            # Some strings aren't ASCII, their lengths in characters aren't their lengths in bytes
+            encoded = [s.encode("utf-8") for s in strings]
+            np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(strings)), out=offsets[1:])
+        return cls(offsets, np.frombuffer(blob, dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i:int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode("utf-8")
+
+    def tolist(self) -> list:
+        return [self[i] for i in range(len(self))]
+
+
+def column_kind(field:str, values:list) -> str:
+    # The field's usual kind if every value fits it exactly, JSON text otherwise
+    kind = FIELD_KINDS.get(field, "json")
+    present = [v for v in values if v is not _ABSENT and v is not None]
+    if kind in NUMBER_TYPES:
+        fits = all(type(v) is NUMBER_TYPES[kind][0] for v in present)
+        if kind == "int":
+            fits = fits and all(-1 << 63 <= v < 1 << 63 for v in present)
+    elif kind == "colors":
+        fits = all(type(v) is list and all(type(c) is str and LIST_SEP not in c for c in v) for v in present)
+    elif kind in ("interned", "text"):
+        fits = all(type(v) is str for v in present)
+    else:
+        fits = True
+    return kind if fits else "json"
+
+
+def encode_column(kind:str, values:list) -> dict:
+    """
+    Store one field of every card as arrays.
+
+    Parameters:
+    - kind (str): "int", "float", "bool", "interned", "colors", "text" or "json"
+    - values (list): The field's value in each card, _ABSENT where a card doesn't have it
+
+    Returns:
+    - dict: The column's arrays, always with a "state" array of MISSING, NULL or PRESENT for each card
+    """
+
+    state = np.array([MISSING if v is _ABSENT else NULL if v is None else PRESENT for v in values], dtype=np.int8)
+    present = [v for v in values if v is not _ABSENT and v is not None]
+    column = {"state": state}
+
+    if kind in NUMBER_TYPES:
+        column["values"] = np.zeros(len(values), dtype=NUMBER_TYPES[kind][1])
+        column["values"][state == PRESENT] = present
+    elif kind in ("interned", "colors"):
+        # Each distinct value once, cards point to it
+        keys = [LIST_SEP.join(v) if kind == "colors" else v for v in present]
+        table = {}
+        codes = np.full(len(values), -1, dtype=np.int32)
+        codes[state == PRESENT] = [table.setdefault(key, len(table)) for key in keys]
+        column["codes"] = codes
+        column["table"] = StringTable.from_list(list(table))
+        if kind == "colors":
+            column["bits"] = np.array([sum(COLOR_BITS.get(c, 0) for c in key.split(LIST_SEP) if c) for key in table], dtype=np.uint8)
+    else:
+        strings = present if kind == "text" else [json.dumps(v) for v in present]
+        column["strings"] = StringTable.from_list(strings)
+        column["rows"] = np.full(len(values), -1, dtype=np.int64)       # Position of each card's string in strings
+        column["rows"][state == PRESENT] = np.arange(len(strings))
+    return column
+
+
+class CardStore:
+    """
+    Columnar, read-only list of card dictionaries. store[i] is a CardView of card i that reads its values from the
+    columns when they're used, and compares equal to the dictionary it was made from.
+    """
+
+    def __init__(self, n:int, fields:list, kinds:dict, columns:dict):
+        self.n = n
+        self.fields = fields        # Field names in the order cards had them
+        self.kinds = kinds          # {key= Field name, value= Kind of column}
+        self.columns = columns      # {key= Field name, value= Dictionary of the column's arrays, see encode_column}
+
+    @classmethod
+    def from_cards(cls, cards) -> "CardStore":
+        """
+        Build the store from card dictionaries, which can come straight from a parser like fsh.iter_json_array.
+        The cards' values are buffered in a list per field, not as dictionaries, then encoded into columns. A list of
+        cards is read one field at a time instead, which is faster.
+
+        Parameters:
+        - cards (iterable): Card dictionaries
+
+        Returns:
+        - CardStore: The cards' store
+        """
+
+        if isinstance(cards, list):
+            fields = {}
+            for card in cards:
+                if not card.keys() <= fields.keys():
+                    fields.update(dict.fromkeys(card))
+            values = {field: [card.get(field, _ABSENT) for card in cards] for field in fields}
+            return cls.from_values(len(cards), values)
+
+        values = {}     # {key= Field name, value= Its value in each card so far}
+        n = 0
+        for card in cards:
+            if not card.keys() <= values.keys():
+                for key in card:
+                    values.setdefault(key, [_ABSENT] * n)
+            for key, column in values.items():
+                column.append(card.get(key, _ABSENT))
+            n += 1
+        return cls.from_values(n, values)
+
+    @classmethod
+    def from_values(cls, n:int, values:dict) -> "CardStore":
+        # Encode every field's values, {key= Field name, value= Its value in each of the n cards, _ABSENT if missing}
+        kinds = {field: column_kind(field, column) for field, column in values.items()}
+        columns = {field: encode_column(kinds[field], column) for field, column in values.items()}
+        return cls(n, list(values), kinds, columns)
+
+    def save(self, fname:str) -> None:
+        """
+        Save the store's columns to an uncompressed .npz file, replacing it once the whole file is written. Column
+        arrays are saved as "f/name", string tables as "f/name/offsets" and "f/name/blob", where f is the field's
+        position in fields.
+
+        Parameters:
+        - fname (str): .npz file
+        """
+
+        arrays = {}
+        for f, field in enumerate(self.fields):
+            for name, arr in self.columns[field].items():
+                if isinstance(arr, StringTable):
+                    arrays[f"{f}/{name}/offsets"] = arr.offsets
+                    arrays[f"{f}/{name}/blob"] = arr.blob
+                else:
+                    arrays[f"{f}/{name}"] = arr
+        meta = {"n": self.n, "fields": self.fields, "kinds": self.kinds}
+
+        tmp_file = f"{fname}.tmp.npz"
+        np.savez(tmp_file, version=CARD_STORE_VERSION, meta=json.dumps(meta), **arrays)
+        os.replace(tmp_file, fname)
+
+    @classmethod
+    def load(cls, fname:str) -> "CardStore":
+        """
+        Load a store saved with save. Only the arrays are read, no card is built.
+
+        Parameters:
+        - fname (str): .npz file
+
+        Returns:
+        - CardStore: The saved store
+        """
+
+        with np.load(fname, allow_pickle=False) as data:
+            if "version" not in data or int(data["version"]) != CARD_STORE_VERSION:
+                raise ValueError(f"\"{fname}\" is not a card store file of version {CARD_STORE_VERSION}.")
+            meta = json.loads(str(data["meta"]))
+
+            columns = {field: {} for field in meta["fields"]}
+            for key in data.files:
+                f, _, name = key.partition("/")
+                if not name:
+                    continue
+                field = meta["fields"][int(f)]
+                name, _, part = name.partition("/")
+                if part:
+                    columns[field].setdefault(name, [None, None])[part == "blob"] = data[key]
+                else:
+                    columns[field][name] = data[key]
+
+        # Pair up the string tables' offsets and blobs
+        for column in columns.values():
+            for name, arr in column.items():
+                if isinstance(arr, list):
+                    column[name] = StringTable(*arr)
+        return cls(meta["n"], meta["fields"], meta["kinds"], columns)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [CardView(self, j) for j in range(*i.indices(self.n))]
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError("card index out of range")
+        return CardView(self, i)
+
+    def __iter__(self):
+        return (CardView(self, i) for i in range(self.n))
+
+    def value(self, field:str, i:int):
+        """Value of a field in card i, raises KeyError if the card doesn't have it"""
+
+        column = self.columns.get(field)
+        state = column["state"][i] if column is not None else MISSING
+        if state == MISSING:
+            raise KeyError(field)
+        if state == NULL:
+            return None
+
+        kind = self.kinds[field]
+        if kind in NUMBER_TYPES:
+            return column["values"][i].item()
+        if kind == "interned":
+            return column["table"][column["codes"][i]]
+        if kind == "colors":
+            key = column["table"][column["codes"][i]]
+            return key.split(LIST_SEP) if key else []
+        text = column["strings"][column["rows"][i]]
+        return text if kind == "text" else json.loads(text)
+
+    def has(self, field:str, i:int) -> bool:
+        column = self.columns.get(field)
+        return column is not None and column["state"][i] != MISSING
+
+    def column(self, field:str, default=None) -> list:
+        """Every card's value of a field, default where a card doesn't have the field or its value is None"""
+
+        column = self.columns.get(field)
+        if column is None:
+            return [default] * self.n
+        present = (column["state"] == PRESENT).tolist()
+        if self.kinds[field] in NUMBER_TYPES:
+            return [value if p else default for value, p in zip(column["values"].tolist(), present)]
+        return [self.value(field, i) if p else default for i, p in enumerate(present)]
+
+    def array(self, field:str) -> np.array:
+        """Values of a number field, 0 where a card doesn't have the field or its value is None"""
+
+        if self.kinds.get(field) not in NUMBER_TYPES:
+            raise ValueError(f"'{field}' isn't a number field.")
+        return self.columns[field]["values"]
+
+    def color_bits(self, field:str) -> np.array:
+        """Bitmask of each card's colours in a colour field, see COLOR_BITS. Cards without the field have none."""
+
+        column = self.columns.get(field)
+        if column is None or self.kinds[field] != "colors" or len(column["bits"]) == 0:
+            return np.zeros(self.n, dtype=np.uint8)
+        codes = column["codes"]
+        return np.where(codes >= 0, column["bits"][np.maximum(codes, 0)], 0).astype(np.uint8)
+
+    def tolist(self) -> list:
+        return [view.to_dict() for view in self]
+
+
+class CardView(Mapping):
+    """One card of a CardStore, read like a dictionary."""
+
+    __slots__ = ("store", "i")
+
+    def __init__(self, store:CardStore, i:int):
+        self.store = store
+        self.i = i
+
+    def __getitem__(self, field:str):
+        return self.store.value(field, self.i)
+
+    def __contains__(self, field) -> bool:
+        return self.store.has(field, self.i)
+
+    def __iter__(self):
+        return (field for field in self.store.fields if self.store.has(field, self.i))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"CardView({self.to_dict()!r})"
+
+    def to_dict(self) -> dict:
+        return {field: self.store.value(field, self.i) for field in self}
@@ -1,21 +1,27 @@
 #!/usr/bin/env python3
 
 # Example run:
-# python cardsim.py .\oracle-cards-*.json 144 24 6
+# python cardsim.py .\oracle-cards-*.json 144 24 6 6
 #                   oracle-cards-file num-minhashes blocks rows-per-block votes
 
 import filesim_helper as fsh
+from card_store import CardStore
 from oracle_fetcher import get_oracle_json, delete_old_jsons
+from instrumentation import Instrumentation, JsonLinesSink, PrometheusSink, stage
 
 import os
 import sys
+import hashlib
 import numpy as np
-from sympy import primerange
-from random import choice, randrange
+from math import comb
+from functools import partial
+from time import perf_counter
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from json import dumps, loads
 
 
-def get_card_list(raw_json_file: str | None = None, dir: str | None = 'card_data') -> list:
+def get_card_list(raw_json_file: str | None = None, dir: str | None = 'card_data', workers: int = 1) -> list:
     """
     Retrieve card JSON and preprocess the oracle text of all the cards. If raw_json_file is None,
     the card data will be retrieved from the Scryfall API and preprocessed instead.
@@ -23,6 +29,7 @@ def get_card_list(raw_json_file: str | None = None, dir: str | None = 'card_data
     Parameters:
     - raw_json_file (str|None): File path to a JSON file of card data (default: None)
     - dir (str|None): Directory to store oracle-cards JSON files (default: 'card_data')
+    - workers (int): Number of processes used to preprocess the cards (default: 1)
 
     Returns:
     - list: List of preprocessed card dictionaries
@@ -31,11 +38,14 @@ def get_card_list(raw_json_file: str | None = None, dir: str | None = 'card_data
     if raw_json_file == None:
         raw_json_file = get_oracle_json(dir)
     
-    return fsh.clean_cards(raw_json_file)
+    return fsh.clean_cards(raw_json_file, workers)
 
-def card_similarity(cards:list, num_minhashes:int, blocks:int, rows_per_block:int, votes:int, max_rows:int) -> dict:
+def card_similarity(cards:list, num_minhashes:int, blocks:int, rows_per_block:int, votes:int, *, seed:int | None = None,
+                    cache_dir:str | None = None, workers:int = 1, min_jaccard:float | None = None,
+                    instrument:Instrumentation | None = None, shingles:str = fsh.DEFAULT_SHINGLES) -> dict:
     """
     Calculate card similarity for a given list of card dictionaries using the given criteria for determining similar groups of cards.
+    Everything after votes is keyword-only, so calls passing the old max_rows argument fail instead of setting the seed.
 
     Parameters:
     - cards (list): List of card dictionaries
@@ -43,221 +53,1151 @@ def card_similarity(cards:list, num_minhashes:int, blocks:int, rows_per_block:in
     - blocks (int): Number of blocks
     - rows_per_block (int): Number of rows per block
     - votes (int): Minimum number of votes needed to create an edge between cards
-    - max_rows (int): Maximum number of rows to consider before stopping
+    - seed (int|None): Seed for the minhash hashing functions, use the same seed for reproducible runs (default: None)
+    - cache_dir (str|None): Directory of the signature cache, only new or edited cards are minhashed when given (default: None)
+    - workers (int): Number of processes and threads used by each step, results are the same for any number (default: 1)
+    - min_jaccard (float|None): Drop edges between cards whose exact Jaccard similarity is below this value (default: None)
+    - instrument (Instrumentation|None): Records the time, memory and item counts of each stage (default: None)
+    - shingles (str): Shingling strategy like "char:3", "word:2" or "word:2+char:5" (default: fsh.DEFAULT_SHINGLES)
 
     Returns:
     - dict: Dictionary of all the strongly connected components of the graph. {key= Similarity ID, value= [List of Card IDs]}
     """
 
-    imp_shingles = imp_shins(cards, minVal=4)                   # Find all the important shingles that appear atleast minVal times
-    mat = generate_shingle_bin_matrix(imp_shingles, cards)      # Apply the characteristic function to all files to make a matrix - each card will have a binary representation for each of the important shingles
-    mat = minhash(mat, num_minhashes, max_rows)                 # Minhash the matrix
-    sim_mat = sim_vote(mat, votes, blocks, rows_per_block)      # Obtain the adjacency matrix of similar documents
+    mat, shingle_sets = card_signatures(cards, num_minhashes, seed, cache_dir, workers, instrument, shingles)  # Minhash the cards' important shingles
+    with stage(instrument, "sim_vote") as stats:
+        edges = sim_vote(mat, votes, blocks, rows_per_block, workers, stats)    # Obtain the edge list of similar documents
+        stats["edges"] = len(edges)
+    if min_jaccard is not None:
+        with stage(instrument, "verify") as stats:
+            edges, stats["removed_edges"] = verify_edges(edges, shingle_sets, min_jaccard)      # Remove false positive edges
+            print(f"Verification removed {stats['removed_edges']} of {len(edges) + stats['removed_edges']} edges below a Jaccard similarity of {min_jaccard}")
 
     # Find the strongly connected components:
-    components = strongly_connected(sim_mat)
+    with stage(instrument, "components") as stats:
+        components = strongly_connected(edges, len(cards))
+        stats["components"] = len(components)
     return components
 
-def generate_shingle_bin(imp_shingles:dict, card:dict) -> np.array:
+def card_signatures(cards:list, num_minhashes:int, seed:int | None = None, cache_dir:str | None = None,
+                    workers:int = 1, instrument:Instrumentation | None = None,
+                    shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[np.array, tuple[np.array, np.array]]:
     """
-    Characteristic function to determine the card's binary value based on the important shingles.
+    Find the cards' important shingles and minhash them, reusing the signature cache if there is one.
 
     Parameters:
-    - imp_shingles (dict): Dictionary of important shingles and their indices {key=shingle, value=index}
-    - card (dict): Single card dictionary
+    - cards (list): List of card dictionaries
+    - num_minhashes (int): The number of minhash steps to perform
+    - seed (int|None): Seed for the minhash hashing functions (default: None)
+    - cache_dir (str|None): Directory of the signature cache (default: None)
+    - workers (int): Number of processes used to shingle and minhash the cards (default: 1)
+    - instrument (Instrumentation|None): Records the time, memory and item counts of each stage (default: None)
+    - shingles (str): Shingling strategy (default: fsh.DEFAULT_SHINGLES)
 
     Returns:
-    - np.array: Array of 1s and 0s of length n, where n is the length of important shingles
+    - tuple: Minhash matrix (np.array), and the column pointers and shingle codes of every card's important shingles (tuple)
     """
 
-    n = len(imp_shingles)
-    
-    # Error check - empty important shingles dict
-    if(n == 0):
-        print("Error: Shingle dictionary is empty.", file=sys.stderr)
+    if cache_dir:
+        with stage(instrument, "signatures") as stats:
+            mat, shingle_sets = cached_minhash(cards, num_minhashes, seed, cache_dir, minVal=4, workers=workers,
+                                                      shingles=shingles)     # Reuse the signatures of unchanged cards
+            if instrument:
+                stats["shingles"] = len(np.unique(shingle_sets[1]))
+            stats["nonzeros"] = len(shingle_sets[1])
+            stats["cards"] = len(cards)
+        return mat, shingle_sets
+
+    with stage(instrument, "shingles") as stats:
+        vocab, (indptr, inds) = imp_shins(cards, minVal=4, workers=workers, shingles=shingles)    # Find all the important shingles that appear atleast minVal times, and the ones each card contains
+        stats["shingles"] = len(vocab)
+        stats["nonzeros"] = len(inds)
+    shingle_sets = (indptr, vocab[inds])
+    with stage(instrument, "minhash") as stats:
+        mat = minhash(shingle_sets, num_minhashes, seed, workers=workers)
+        stats["cards"] = len(cards)
+    return mat, shingle_sets
+
+def check_shingle_vocab(vocab:np.array) -> None:
+    """
+    Error check the important shingles vocabulary before it is used by the characteristic function.
+
+    Parameters:
+    - vocab (np.array): Sorted array of the important shingles' codes, a shingle's index is its position in vocab
+    """
+
+    # Error check - empty important shingles vocabulary
+    if(len(vocab) == 0):
+        print("Error: Shingle vocabulary is empty.", file=sys.stderr)
         sys.exit()
     # Error check - 
-    shtype = type(list(imp_shingles.keys())[0])
-    if(shtype != tuple):
-        print(f"Type Error: Shingles dictionary keys in type '{shtype}' when they should be of type 'tuple'.", file=sys.stderr)
+    if(not np.issubdtype(vocab.dtype, np.integer)):
+        print(f"Type Error: Shingle vocabulary in type '{vocab.dtype}' when it should be an integer type.", file=sys.stderr)
         sys.exit()
 
-    # Open shingles of given file
-    words = card["oracle_text"]
-    shins = fsh.kshingles(words, k=3)
+def shingle_codes(card_list:list, batch_size:int = 4096, workers:int = 1,
+                  shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[np.array, np.array]:
+    """
+    Shingle the oracle text of every card once, a batch of cards at a time.
+
+    Parameters:
+    - card_list (list): List of card dictionaries
+    - batch_size (int): Number of cards to shingle at once (default: 4096)
+    - workers (int): Number of processes shingling batches at the same time (default: 1)
+    - shingles (str): Shingling strategy, see fsh.shingle_texts (default: fsh.DEFAULT_SHINGLES)
+
+    Returns:
+    - tuple: Column pointers (np.array) of length m+1 and shingle codes (np.array), where m is length of card_list
+    """
+
+    shingle_batch = partial(fsh.shingle_texts, strategy=shingles)
+    texts = [[card["oracle_text"] for card in card_list[start:start+batch_size]] for start in range(0, len(card_list), batch_size)]
+    if workers > 1 and len(texts) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(shingle_batch, texts))
+    else:
+        results = list(map(shingle_batch, texts))
+
+    counts, batches = [], []
+    for ptr, codes in results:
+        counts.append(np.diff(ptr))
+        batches.append(codes)
+
+    indptr = np.zeros(len(card_list)+1, dtype=np.int64)
+    if batches:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+        return indptr, np.concatenate(batches)
+    return indptr, np.empty(0, dtype=np.int64)
+
+def filter_shingle_sets(indptr:np.array, inds:np.array, keep:np.array) -> tuple[np.array, np.array]:
+    """
+    Keep only some of the entries of each card's shingle set.
+
+    Parameters:
+    - indptr (np.array): Column pointers of the shingle sets
+    - inds (np.array): Shingle indices of the shingle sets
+    - keep (np.array): Boolean array the same length as inds of the entries to keep
+
+    Returns:
+    - tuple: Column pointers (np.array) and shingle indices (np.array) of the kept entries
+    """
+
+    n = len(indptr) - 1
+    card_ids = np.repeat(np.arange(n), np.diff(indptr))[keep]
+    new_indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(card_ids, minlength=n), out=new_indptr[1:])
+    return new_indptr, inds[keep]
 
-    # The output array, 1 = shingle in file, 0 = not
-    shin_bin = np.zeros(n, dtype=np.uint8)
+def generate_shingle_bin(vocab:np.array, card:dict, check:bool = True) -> np.array:
+    """
+    Characteristic function to determine the card's shingle set based on the important shingles.
 
-    for shin in shins:
-        ind = imp_shingles.get(shin)
-        if(ind != None):
-            shin_bin[ind] = 1
+    Parameters:
+    - vocab (np.array): Sorted array of the important shingles' codes, from imp_shins
+    - card (dict): Single card dictionary
+    - check (bool): Error check the important shingles vocabulary first (default: True)
 
-    return shin_bin
+    Returns:
+    - np.array: Sorted array of the indices of the important shingles found in the card
+    """
+
+    indptr, indices = generate_shingle_bin_matrix(vocab, [card], check=check)
+    return indices
 
-def generate_shingle_bin_matrix(imp_shingles:dict, card_list:list) -> np.array:
+def generate_shingle_bin_matrix(vocab:np.array, card_list:list, check:bool = True,
+                                shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[np.array, np.array]:
     """
-    Characteristic function to determine all cards' binary values based on the important shingles.
+    Characteristic function to determine all cards' shingle sets based on the important shingles. The sets are
+    stored in a sparse compressed column layout, card i's important shingle indices are 
+    indices[indptr[i]:indptr[i+1]] in ascending order.
 
     Parameters:
-    - imp_shingles (dict): Dictionary of important shingles and their indices {key=shingle, value=index}
+    - vocab (np.array): Sorted array of the important shingles' codes, from imp_shins
     - card_list (list): List of card dictionaries.
+    - check (bool): Error check the important shingles vocabulary first (default: True)
+    - shingles (str): Shingling strategy the vocabulary was made with (default: fsh.DEFAULT_SHINGLES)
 
     Returns:
-    - np.array: Matrix of 1s and 0s of size n by m, where n is the length of important shingles and m is length of card_list
+    - tuple: Column pointers (np.array) of length m+1 and shingle indices (np.array), where m is length of card_list
     """
 
-    # Build base matrix
-    n = len(imp_shingles)
-    mat = np.zeros((n,len(card_list)), dtype=np.uint8)
+    if check:
+        check_shingle_vocab(vocab)
+
+    indptr, codes = shingle_codes(card_list, shingles=shingles)
+
+    # Look up each shingle in the vocabulary, only keeping the important ones
+    inds = np.minimum(np.searchsorted(vocab, codes), len(vocab)-1)
+    found = vocab[inds] == codes if len(vocab) else np.zeros(len(codes), dtype=bool)
 
-    # Loop through all files in given directory
-    for i, card in enumerate(card_list):
-        mat[:,i] = generate_shingle_bin(imp_shingles, card)
+    return filter_shingle_sets(indptr, inds.astype(np.int32), found)
 
-    return mat
+# Mersenne prime 2^31 - 1 used as the modulus of the minhash hashing functions
+MINHASH_PRIME = (1 << 31) - 1
 
-def randfun(a:int,b:int,n:int):
-    """Function to create hashing functions for minhash"""
-    return lambda x: (a*x+b) % n
+def minhash_coefficients(num_minhashes:int, seed:int | None = None) -> tuple[np.array, np.array]:
+    """
+    Create the coefficients of the universal hashing functions h(x) = (a*x+b) mod p used by minhash.
+
+    Parameters:
+    - num_minhashes (int): Number of hashing functions
+    - seed (int|None): Seed for the random number generator, use the same seed for reproducible runs (default: None)
 
-def minhash(mat:np.array, num_minhashes:int, max_rows:int) -> np.array:
+    Returns:
+    - tuple: Multipliers a (np.array) and offsets b (np.array), each of length num_minhashes
     """
-    Minhashing function
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, size=num_minhashes, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=num_minhashes, dtype=np.uint64)
+    return a, b
+
+def minhash(shingle_sets:tuple[np.array, np.array], num_minhashes:int, seed:int | None = None,
+            coeffs:tuple[np.array, np.array] | None = None, chunk_size:int = 1 << 20, workers:int = 1) -> np.array:
+    """
+    Minhashing function. Every hashing function is applied to every shingle of every file at once, a file's
+    value is 1 + the smallest hash of its shingles, or 0 if the file has no shingles.
 
     Parameters:
-    - mat (np.array): Matrix of all files' characteristic values
+    - shingle_sets (tuple): Column pointers and shingle indices of all files, from generate_shingle_bin_matrix
     - num_minhashes (int): Number of times to run minhash
-    - max_rows (int): Maximum number of rows to consider before stopping
+    - seed (int|None): Seed used to create the hashing functions when coeffs is None (default: None)
+    - coeffs (tuple|None): Hashing function coefficients from minhash_coefficients (default: None)
+    - chunk_size (int): Maximum number of hashes to hold in memory at once, per process (default: 2^20)
+    - workers (int): Number of processes minhashing chunks of files at the same time (default: 1)
 
     Returns:
     - np.array: The resulting matrix after running minhash num_minhashes number of times
     """
 
-    n_shingles = mat.shape[0]   # number of shingles
-    n_files = mat.shape[1]      # number of files
+    indptr, indices = shingle_sets
+    n_files = len(indptr) - 1   # number of files
+
+    a, b = coeffs if coeffs is not None else minhash_coefficients(num_minhashes, seed)
+    if workers > 1 and n_files > 1:
+        return parallel_minhash(shingle_sets, num_minhashes, (a, b), chunk_size, workers)
+
+    a = np.asarray(a, dtype=np.uint64)[:num_minhashes, None]
+    b = np.asarray(b, dtype=np.uint64)[:num_minhashes, None]
+
+    minhash_mat = np.zeros((num_minhashes, n_files), dtype=np.uint32)
+
+    # Only files with at least one shingle can get a nonzero value
+    nonempty = np.flatnonzero(np.diff(indptr))
+    if len(nonempty) == 0:
+        return minhash_mat
+    starts = indptr[nonempty] - indptr[0]
+
+    # Shingles are vocabulary indices or fsh.SHINGLE_BITS bit codes, below 2^31 so they don't need reducing first
+    # (only the code 2^31-1 hashes like 0). a*x+b then stays below 2^62 since a, b, and x are all below 2^31
+    x = np.asarray(indices[indptr[0]:indptr[-1]], dtype=np.uint64)
+    if x.max() > MINHASH_PRIME:
+        raise ValueError(f"Shingle indices must be below 2^31 to be minhashed, not {int(x.max())}.")
+
+    # Hash in groups of functions so at most chunk_size hashes are held in memory
+    step = max(1, chunk_size // len(x))
+    low, shift, prime = np.uint64(MINHASH_PRIME), np.uint64(31), np.uint32(MINHASH_PRIME)
+    for k in range(0, num_minhashes, step):
+        products = a[k:k+step] * x
+        products += b[k:k+step]
+        # (a*x+b) % MINHASH_PRIME without a division: 2^31 = 1 mod 2^31-1, so adding the bits above 2^31 to the ones
+        # below gives the same remainder in under 2^32, then subtracting the prime at most twice (a wrapped uint32
+        # subtraction is larger than the value it started from, so the minimum keeps whichever is reduced)
+        hashes = (products >> shift).astype(np.uint32)
+        hashes += (products & low).astype(np.uint32)
+        del products
+        for _ in range(2):
+            np.minimum(hashes, hashes - prime, out=hashes)
+        minhash_mat[k:k+step, nonempty] = np.minimum.reduceat(hashes, starts, axis=1) + 1
+
+    return minhash_mat
 
-    # List of odd primes from 2 to n_shingles, used for hashing functions
-    oddprimes = np.array(list(primerange(2, n_shingles)))
+def minhash_worker(shm_name:str, shape:tuple, start:int, shingle_sets:tuple[np.array, np.array], coeffs:tuple[np.array, np.array],
+                   chunk_size:int) -> None:
+    """Minhash a chunk of files, writing their columns of the shared memory minhash matrix starting at column start"""
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        minhash_mat = np.ndarray(shape, dtype=np.uint32, buffer=shm.buf)
+        chunk_mat = minhash(shingle_sets, shape[0], coeffs=coeffs, chunk_size=chunk_size)
+        minhash_mat[:, start:start+chunk_mat.shape[1]] = chunk_mat
+        del minhash_mat
+    finally:
+        shm.close()
+
+def parallel_minhash(shingle_sets:tuple[np.array, np.array], num_minhashes:int, coeffs:tuple[np.array, np.array],
+                     chunk_size:int, workers:int) -> np.array:
+    """
+    Minhash chunks of files in separate processes. The workers write their signatures straight into a shared memory
+    minhash matrix, so the results are the same as minhash without being sent back between processes.
 
-    minhash_mat = np.empty((num_minhashes, n_files), dtype=np.uint32)
+    Parameters:
+    - shingle_sets (tuple): Column pointers and shingle indices of all files
+    - num_minhashes (int): Number of times to run minhash
+    - coeffs (tuple): Hashing function coefficients from minhash_coefficients
+    - chunk_size (int): Maximum number of hashes to hold in memory at once, per process
+    - workers (int): Number of processes
 
-    for k in range(num_minhashes):
-        arr = np.empty((max_rows-1, n_files), dtype=np.uint32)
-        # Generate hash function using the prime numbers
-        fun = randfun(choice(oddprimes),randrange(n_shingles), n_shingles)
-        # Use minhash on up to max_rows rows
-        for i in range(max_rows-1):
-            j = fun(i)      # Permuted index
-            arr[i,:] = mat[j,:]
+    Returns:
+    - np.array: The resulting matrix after running minhash num_minhashes number of times
+    """
 
-        arr = np.vstack((np.zeros(n_files), arr))
-        minhash_mat[k,:] = np.argmax(arr, axis=0)
+    indptr, indices = shingle_sets
+    n_files = len(indptr) - 1
+    shape = (num_minhashes, n_files)
+    bounds = np.linspace(0, n_files, min(n_files, 4 * workers) + 1).astype(np.int64)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(num_minhashes * n_files * 4, 1))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                chunk = (indptr[lo:hi+1] - indptr[lo], np.asarray(indices[indptr[lo]:indptr[hi]]))
+                futures.append(executor.submit(minhash_worker, shm.name, shape, int(lo), chunk, coeffs, chunk_size))
+            for future in futures:
+                future.result()
+        minhash_mat = np.ndarray(shape, dtype=np.uint32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
 
     return minhash_mat
 
-# Given a minhash matrix construct an adjacency matrix of the cards
+# Odd 64-bit constant used to mix the rows of a band into a single key
+BAND_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def band_keys(hashmat:np.array, blocks:int, rows_per_block:int) -> tuple[np.array, np.array]:
+    """
+    Hash each block (band) of rows of the minhash matrix into a single 64-bit key per file.
+
+    Parameters:
+    - hashmat (np.array): Minhash matrix with blocks*rows_per_block rows
+    - blocks (int): Number of blocks
+    - rows_per_block (int): Number of rows per block
+
+    Returns:
+    - tuple: Keys (np.array) of size blocks by n, and a boolean array of the same size that is False 
+             where the file's block contains a 0 and should not be counted
+    """
+
+    n_files = hashmat.shape[1]
+    hashmat = np.reshape(hashmat, (blocks, rows_per_block, n_files))
+
+    keys = np.zeros((blocks, n_files), dtype=np.uint64)
+    for r in range(rows_per_block):
+        keys = (keys ^ hashmat[:, r, :].astype(np.uint64)) * BAND_MIX
+        keys ^= keys >> np.uint64(29)
+
+    # Don't count files that have no similarity
+    valid = np.all(hashmat != 0, axis=1)
+    return keys, valid
+
+def bucket_pairs(keys:np.array, valid:np.array) -> np.array:
+    """
+    Find every pair of files that fall in the same bucket of a single block.
+
+    Parameters:
+    - keys (np.array): The block's key for each file
+    - valid (np.array): Boolean array of the files that can be counted
+
+    Returns:
+    - np.array: Array of size m by 2 of the file index pairs (i, j) with i < j
+    """
+
+    # Sort the files by key, files in the same bucket end up next to each other in ascending order
+    cols = np.flatnonzero(valid)
+    members = cols[np.argsort(keys[cols], kind="stable")]
+    _, starts, sizes = np.unique(keys[members], return_index=True, return_counts=True)
+    keep = sizes > 1
+    starts, sizes = starts[keep], sizes[keep]
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # Position of every member of a shared bucket, and how many members come after it in its bucket
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    pos = np.repeat(starts, sizes) + offsets
+    after = np.repeat(sizes, sizes) - offsets - 1
+
+    # Pair each member with every member after it
+    firsts = np.repeat(pos, after)
+    seconds = firsts + 1 + np.arange(after.sum()) - np.repeat(np.cumsum(after) - after, after)
+    return np.column_stack((members[firsts], members[seconds]))
+
+def candidate_pairs(hashmat:np.array, blocks:int, rows_per_block:int, workers:int = 1) -> tuple[np.array, np.array]:
+    """
+    Count the votes of every pair of files that share a bucket in at least one block.
+
+    Parameters:
+    - hashmat (np.array): Minhash matrix with blocks*rows_per_block rows
+    - blocks (int): Number of blocks
+    - rows_per_block (int): Number of rows per block
+    - workers (int): Number of threads bucketing blocks at the same time (default: 1)
+
+    Returns:
+    - tuple: Array of size m by 2 of candidate pairs (i, j) with i < j (np.array), and their number of votes (np.array)
+    """
+
+    n_files = hashmat.shape[1]
+    keys, valid = band_keys(hashmat, blocks, rows_per_block)
+
+    # Encode each pair as a single integer so the votes can be counted with np.unique
+    def block_codes(b:int) -> np.array:
+        pairs = bucket_pairs(keys[b], valid[b])
+        return pairs[:,0] * n_files + pairs[:,1]
+
+    # NumPy releases the GIL while sorting, so the blocks can be bucketed by threads sharing the keys
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            codes = list(executor.map(block_codes, range(blocks)))
+    else:
+        codes = list(map(block_codes, range(blocks)))
+    codes, counts = np.unique(np.concatenate(codes), return_counts=True)
+
+    pairs = np.column_stack(np.divmod(codes, n_files))
+    return pairs, counts
+
+# Given a minhash matrix construct an edge list of the cards
 #  with edges where there is a vote value of at least reqVotes
-def sim_vote(hashmat:np.array, reqVotes:int, blocks:int, rows_per_block:int) -> np.array:
+#  The number of candidate pairs is added to stats if it's given
+def sim_vote(hashmat:np.array, reqVotes:int, blocks:int, rows_per_block:int, workers:int = 1, stats:dict | None = None) -> np.array:
     # Error check for incorrect combinations of number of blocks and number of rows in blocks
     if (blocks*rows_per_block != hashmat.shape[0]):
         print(f"Error: sim_vote(4), blocks*rows_per_block should be equal to hashmat rows.\n"
               f" You had {blocks} blocks and {rows_per_block} rows per block. Hash matrix had {hashmat.shape[0]} rows",
                file=sys.stderr)
         sys.exit()
-    
-    n_files = hashmat.shape[1]
-    adjmat = np.zeros((n_files, n_files))
-    hashmat = np.reshape(hashmat, (blocks, rows_per_block, n_files))
 
-    # Loop through the block indices
-    for b_ind in range(blocks):
-        sim_dict = {}
-        # Loop through each column of the block adding the cols to a dictionary with tuple keys
-        for col in range(n_files):
-            key = tuple(hashmat[b_ind, :, col])
-            if (0 in key):
-                # Don't count files that have no similarity
-                continue
-            if (sim_dict.get(key) != None):
-                # Add a vote for an edge on each other vertex with a matching tuple
-                for x in sim_dict[key]:
-                    adjmat[x,col] += 1
-                sim_dict[key].append(col)
-            else:
-                # Create a key, value pair with ind in a list
-                sim_dict[key] = [col]
-
-    #Only return the adjmat where the value >= reqVotes
-    adjmat = adjmat >= reqVotes             # Convert matrix to Trues and Falses
-    return adjmat.astype(np.uint8)          # Convert to 0s and 1s and return it
-
-# Create the undirected version of the graph
-def make_undir(adjmat:np.array) -> np.array:
-    adjmat = np.add(adjmat, adjmat.T)
-    inds = np.nonzero(adjmat)
-    undir_adjmat = np.zeros(adjmat.shape, dtype=np.uint8)
-    undir_adjmat[inds] = 1
-    
-    return undir_adjmat
-
-# Given an adjacency matrix, returns a list of all strongly connected components as dictionary, num : list
-def strongly_connected(adjmat:np.array) -> dict:
-    adjmat = make_undir(adjmat)
-    n = adjmat.shape[0]
-    visited = np.zeros(n)
-    comps = {}
-    compNum = -1
-    for i in range(n):
-        if not visited[i]:
-            compNum += 1
-            if comps.get(compNum) != None:
-                comps[compNum].append(i)
-            else:
-                comps[compNum]= [i]
-            q = [i]
-            visited[i] = 1
-            while(len(q)):
-                w = q.pop(0)
-                nbrs = np.nonzero(adjmat[w])[0] # neighbors of w
-                for k in nbrs:
-                    if not visited[k]:
-                        comps[compNum].append(k)
-                        visited[k] = 1
-                        q.insert(len(q), k)
-    return comps
-
-
-def imp_shins(card_list:list, minVal:int = 4) -> dict:
-    """
-    Create the important shingles dictionary based off the frequency of each shingle. Keeps only the shingles 
-    that appear at least minVal number of times.
+    pairs, counts = candidate_pairs(hashmat, blocks, rows_per_block, workers)
+    if stats is not None:
+        stats["candidate_pairs"] = len(pairs)
+
+    #Only return the pairs where the value >= reqVotes
+    return pairs[counts >= reqVotes]
+
+def jaccard(pairs:np.array, shingle_sets:tuple[np.array, np.array]) -> np.array:
+    """
+    Exact Jaccard similarity of pairs of files, found by sorting the shingles of both files of every pair together.
+
+    Parameters:
+    - pairs (np.array): Array of size m by 2 of file index pairs
+    - shingle_sets (tuple): Column pointers and shingle indices or codes of all files, each file's shingles are unique
+
+    Returns:
+    - np.array: Jaccard similarity of each pair, 0 for two empty files
+    """
+
+    indptr, data = shingle_sets
+    lens = np.diff(indptr)
+    sizes = lens[pairs[:,0]] + lens[pairs[:,1]]
+
+    # Every shingle of both files, tagged with its pair's number
+    _, firsts = gather_shingle_sets(indptr, data, pairs[:,0])
+    _, seconds = gather_shingle_sets(indptr, data, pairs[:,1])
+    pair_nums = np.concatenate((np.repeat(np.arange(len(pairs)), lens[pairs[:,0]]), np.repeat(np.arange(len(pairs)), lens[pairs[:,1]])))
+    shins = np.concatenate((firsts, seconds))
+
+    # A shingle in both files of a pair is next to its copy once sorted
+    order = np.lexsort((shins, pair_nums))
+    pair_nums, shins = pair_nums[order], shins[order]
+    same = (pair_nums[1:] == pair_nums[:-1]) & (shins[1:] == shins[:-1])
+    inter = np.bincount(pair_nums[1:][same], minlength=len(pairs))
+
+    union = sizes - inter
+    return np.divide(inter, union, out=np.zeros(len(pairs)), where=union > 0)
+
+def verify_edges(edges:np.array, shingle_sets:tuple[np.array, np.array], min_jaccard:float,
+                 chunk_size:int = 1 << 22) -> tuple[np.array, int]:
+    """
+    Remove the edges between files whose exact Jaccard similarity is below min_jaccard. Only the given edges are 
+    compared, a chunk of edges at a time.
+
+    Parameters:
+    - edges (np.array): Array of size m by 2 of file index pairs, from sim_vote
+    - shingle_sets (tuple): Column pointers and shingle indices or codes of all files
+    - min_jaccard (float): Minimum Jaccard similarity of the edges to keep
+    - chunk_size (int): Maximum number of shingles to compare at once (default: 2^22)
+
+    Returns:
+    - tuple: Edges that were kept (np.array), and the number of edges removed (int)
+    """
+
+    lens = np.diff(shingle_sets[0])
+    sizes = np.cumsum(lens[edges[:,0]] + lens[edges[:,1]])
+
+    keep = np.zeros(len(edges), dtype=bool)
+    start = 0
+    while start < len(edges):
+        # Take as many edges as fit in chunk_size shingles, at least one
+        offset = sizes[start-1] if start else 0
+        stop = max(int(np.searchsorted(sizes, offset + chunk_size, side="right")), start+1)
+        keep[start:stop] = jaccard(edges[start:stop], shingle_sets) >= min_jaccard
+        start = stop
+
+    return edges[keep], len(edges) - int(keep.sum())
+
+class DisjointSet:
+    """Union-find structure over the vertices 0 to n-1 using path compression and union by rank."""
+
+    def __init__(self, n:int):
+        self.parent = list(range(n))
+        self.rank = [0] * n
+
+    def find(self, x:int) -> int:
+        # Find the root, then point every vertex on the path directly at it
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x:int, y:int) -> None:
+        x, y = self.find(x), self.find(y)
+        if x == y:
+            return
+        # Attach the shorter tree under the taller one
+        if self.rank[x] < self.rank[y]:
+            x, y = y, x
+        self.parent[y] = x
+        if self.rank[x] == self.rank[y]:
+            self.rank[x] += 1
+
+    def components(self) -> dict:
+        """
+        Group the vertices by their set. Components are numbered in order of their smallest vertex and
+        each component's vertices are in ascending order.
+
+        Returns:
+        - dict: {key= Component number, value= [List of vertices]}
+        """
+
+        comps = {}
+        comp_nums = {}      # root : component number
+        for v in range(len(self.parent)):
+            root = self.find(v)
+            if root not in comp_nums:
+                comp_nums[root] = len(comp_nums)
+                comps[comp_nums[root]] = []
+            comps[comp_nums[root]].append(v)
+        return comps
+
+# Given an edge list of n vertices, returns a list of all strongly connected components as dictionary, num : list
+def strongly_connected(edges:np.array, n:int) -> dict:
+    dsu = DisjointSet(n)
+    for i, j in edges.tolist():
+        dsu.union(i, j)
+    return dsu.components()
+
+
+def imp_shins(card_list:list, minVal:int = 4, workers:int = 1,
+              shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[np.array, tuple[np.array, np.array]]:
+    """
+    Create the important shingles vocabulary based off the frequency of each shingle. Keeps only the shingles 
+    that appear in at least minVal cards. Every card is shingled once, and the cards' shingle sets are 
+    returned alongside the vocabulary.
 
     Parameters:
     - card_list (list): List of card dictionaries
     - minVal (int): The minimum number of appearances a shingle must have to be deemed 'important'.
+    - workers (int): Number of processes used to shingle the cards (default: 1)
+    - shingles (str): Shingling strategy, see fsh.shingle_texts (default: fsh.DEFAULT_SHINGLES)
+
+    Returns:
+    - tuple: Sorted important shingle codes (np.array), and the column pointers and shingle indices of every
+             card's important shingles (tuple), the same layout as generate_shingle_bin_matrix
+    """
+
+    indptr, codes = shingle_codes(card_list, workers=workers, shingles=shingles)
+
+    # Count how many cards each shingle appears in
+    shins, inverse, shin_freq = np.unique(codes, return_inverse=True, return_counts=True)
+    important = shin_freq >= minVal
+    vocab = shins[important]
+
+    # Renumber the important shingles and drop the rest from each card
+    new_inds = (np.cumsum(important) - 1).astype(np.int32)
+    shingle_sets = filter_shingle_sets(indptr, new_inds[inverse], important[inverse])
+
+    print(len(vocab), 'shingles')
+    return vocab, shingle_sets
+
+def gather_shingle_sets(indptr:np.array, data:np.array, rows:np.array) -> tuple[np.array, np.array]:
+    """
+    Select the shingle sets of some of the cards, in the given order.
+
+    Parameters:
+    - indptr (np.array): Column pointers of the shingle sets
+    - data (np.array): Shingle indices or codes of the shingle sets
+    - rows (np.array): Indices of the cards to select
+
+    Returns:
+    - tuple: Column pointers (np.array) and shingle data (np.array) of the selected cards
+    """
+
+    lens = indptr[rows+1] - indptr[rows]
+    new_indptr = np.zeros(len(rows)+1, dtype=np.int64)
+    np.cumsum(lens, out=new_indptr[1:])
+    inds = np.repeat(indptr[rows] - new_indptr[:-1], lens) + np.arange(new_indptr[-1])
+    return new_indptr, np.asarray(data[inds])
+
+def set_fingerprints(indptr:np.array, codes:np.array) -> np.array:
+    """
+    Order independent 64-bit fingerprint of each card's set of shingle codes.
+
+    Parameters:
+    - indptr (np.array): Column pointers of the shingle sets
+    - codes (np.array): Shingle codes of the shingle sets
+
+    Returns:
+    - np.array: Fingerprint of each card's shingle set
+    """
+
+    mixed = codes.astype(np.uint64) * BAND_MIX
+    mixed ^= mixed >> np.uint64(31)
+    mixed *= BAND_MIX
+
+    # Sum each card's mixed codes (mod 2^64) using the running total, then add the set size
+    totals = np.zeros(len(mixed)+1, dtype=np.uint64)
+    np.cumsum(mixed, out=totals[1:])
+    return totals[indptr[1:]] - totals[indptr[:-1]] + np.diff(indptr).astype(np.uint64)
+
+def text_hash(text:str) -> int:
+    """64-bit hash of a card's oracle text, used to tell if the card was edited"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+# Version of the files written by save_signature_cache
+SIGNATURE_CACHE_VERSION = 2
+
+def load_signature_cache(cache_dir:str, params:dict, seed:int | None = None) -> dict | None:
+    """
+    Load the signature cache, arrays are memory-mapped instead of read into memory.
+
+    Parameters:
+    - cache_dir (str): Directory of the signature cache
+    - params (dict): Shingling and minhash parameters the cache must have been made with
+    - seed (int|None): Seed the cache's hashing functions must have been made with, None accepts any seed (default: None)
+
+    Returns:
+    - dict|None: The cache's index and arrays, None if there is no usable cache
+    """
+
+    index_file = os.path.join(cache_dir, "index.json")
+    if not os.path.isfile(index_file):
+        return None
+
+    with open(index_file, "r") as fd:
+        index = loads(fd.read())
+
+    # Signatures made with other parameters can't be reused
+    if index.get("version") != SIGNATURE_CACHE_VERSION or index.get("params") != params:
+        return None
+    if seed is not None and index.get("seed") != seed:
+        return None
+
+    cache = {"oracle_ids": index["oracle_ids"], "seed": index.get("seed")}
+    for name in ("coeffs", "text_hashes", "fingerprints", "shingle_ptr", "shingles", "signatures"):
+        cache[name] = np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")
+    return cache
+
+def save_signature_cache(cache_dir:str, params:dict, seed:int | None, oracle_ids:list, arrays:dict) -> None:
+    """
+    Save the signature cache, replacing any previous cache in the directory.
+
+    Parameters:
+    - cache_dir (str): Directory of the signature cache
+    - params (dict): Shingling and minhash parameters the cache was made with
+    - seed (int|None): Seed the hashing functions were made with
+    - oracle_ids (list): Oracle ID of each cached card
+    - arrays (dict): The coeffs, text_hashes, fingerprints, shingle_ptr, shingles and signatures arrays
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Remove the old index first so a partially written cache is never loaded
+    index_file = os.path.join(cache_dir, "index.json")
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+
+    for name, arr in arrays.items():
+        tmp_file = os.path.join(cache_dir, f"{name}.tmp.npy")
+        np.save(tmp_file, arr)
+        os.replace(tmp_file, os.path.join(cache_dir, f"{name}.npy"))
+
+    index = {"version": SIGNATURE_CACHE_VERSION, "params": params, "seed": seed, "oracle_ids": oracle_ids}
+    save_dict(index, index_file)
+
+def cached_minhash(cards:list, num_minhashes:int, seed:int | None, cache_dir:str, minVal:int = 4,
+                   workers:int = 1, shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[np.array, tuple[np.array, np.array]]:
+    """
+    Minhash the cards' important shingles, reusing the signatures in the signature cache. Cards are looked up by their
+    oracle ID, only cards with new or edited oracle text are shingled again, and only cards whose set of important 
+    shingles changed are minhashed again. The cache is then updated with the current cards.
+
+    Parameters:
+    - cards (list): List of card dictionaries
+    - num_minhashes (int): Number of times to run minhash
+    - seed (int|None): Seed for the minhash hashing functions, None reuses the cache's hashing functions
+    - cache_dir (str): Directory of the signature cache
+    - minVal (int): The minimum number of appearances a shingle must have to be deemed 'important'
+    - workers (int): Number of processes used to shingle and minhash the cards (default: 1)
+    - shingles (str): Shingling strategy, a cache made with another strategy isn't reused (default: fsh.DEFAULT_SHINGLES)
+
+    Returns:
+    - tuple: Minhash matrix of the cards (np.array), and the column pointers and shingle codes of every card's important shingles (tuple)
+    """
+
+    params = {"shingles": fsh.format_shingle_strategy(shingles), "shingle_bits": fsh.SHINGLE_BITS, "min_val": minVal,
+              "num_minhashes": num_minhashes}
+    cache = load_signature_cache(cache_dir, params, seed)
+
+    n = len(cards)
+    oracle_ids = [card.get("oracle_id") for card in cards]
+    text_hashes = np.fromiter((text_hash(card["oracle_text"]) for card in cards), dtype=np.uint64, count=n)
+
+    # Row of each card in the cache, -1 if it's new or its text changed
+    rows = np.full(n, -1, dtype=np.int64)
+    if cache:
+        coeffs = np.array(cache["coeffs"])
+        seed = cache["seed"]
+        cached_rows = {oid: row for row, oid in enumerate(cache["oracle_ids"])}
+        for i, oid in enumerate(oracle_ids):
+            row = cached_rows.get(oid, -1)
+            if oid is not None and row >= 0 and cache["text_hashes"][row] == text_hashes[i]:
+                rows[i] = row
+    else:
+        coeffs = np.stack(minhash_coefficients(num_minhashes, seed))
+
+    # Shingle the new and edited cards, the rest reuse their cached shingle codes
+    hit = np.flatnonzero(rows >= 0)
+    miss = np.flatnonzero(rows < 0)
+    miss_ptr, miss_codes = shingle_codes([cards[i] for i in miss], workers=workers, shingles=shingles)
+    if len(hit):
+        hit_ptr, hit_codes = gather_shingle_sets(cache["shingle_ptr"], cache["shingles"], rows[hit])
+    else:
+        hit_ptr, hit_codes = np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    # Put all the cards' shingle codes back in card order
+    order = np.argsort(np.concatenate((hit, miss)), kind="stable")
+    both_ptr = np.concatenate((hit_ptr[:-1], miss_ptr[:-1] + hit_ptr[-1], [hit_ptr[-1] + miss_ptr[-1]]))
+    indptr, codes = gather_shingle_sets(both_ptr, np.concatenate((hit_codes, miss_codes)), order)
+
+    # Find the important shingles the same way as imp_shins
+    shins, inverse, shin_freq = np.unique(codes, return_inverse=True, return_counts=True)
+    important = shin_freq >= minVal
+    print(important.sum(), 'shingles')
+    imp_indptr, imp_codes = filter_shingle_sets(indptr, codes, important[inverse])
+    fingerprints = set_fingerprints(imp_indptr, imp_codes)
+
+    # Signatures can be reused when the card's important shingles haven't changed
+    mat = np.empty((num_minhashes, n), dtype=np.uint32)
+    reuse = np.zeros(n, dtype=bool)
+    reuse[hit] = cache["fingerprints"][rows[hit]] == fingerprints[hit] if len(hit) else False
+    mat[:, reuse] = cache["signatures"][rows[reuse]].T if reuse.any() else 0
+
+    redo = np.flatnonzero(~reuse)
+    mat[:, redo] = minhash(gather_shingle_sets(imp_indptr, imp_codes, redo), num_minhashes, coeffs=coeffs, workers=workers)
+    print(f"Reused {reuse.sum()} signatures, minhashed {len(redo)} cards")
+
+    # Only cards with an oracle ID can be found in the cache, close the memory-mapped cache before it's replaced
+    cache = None
+    keep = np.flatnonzero([oid is not None for oid in oracle_ids])
+    keep_ptr, keep_codes = gather_shingle_sets(indptr, codes, keep)
+    save_signature_cache(cache_dir, params, seed, [oracle_ids[i] for i in keep], {
+        "coeffs": coeffs,
+        "text_hashes": text_hashes[keep],
+        "fingerprints": fingerprints[keep],
+        "shingle_ptr": keep_ptr,
+        "shingles": keep_codes,
+        "signatures": np.ascontiguousarray(mat[:, keep].T),
+    })
+
+    return mat, (imp_indptr, imp_codes)
+
+def bucket_tables(keys:np.array, valid:np.array) -> tuple[np.array, np.array]:
+    """
+    Sort each block's bucket keys so the files in a bucket can be found with a binary search. A file is either 
+    valid in every block or in none, since only files without shingles have 0s in their minhash values.
+
+    Parameters:
+    - keys (np.array): Keys of size blocks by n, from band_keys
+    - valid (np.array): Boolean array of size blocks by n of the files that can be counted, from band_keys
+
+    Returns:
+    - tuple: Sorted keys (np.array) and the file index of each key (np.array), both of size blocks by the number of valid files
+    """
+
+    cols = np.flatnonzero(valid.all(axis=0))
+    order = np.argsort(keys[:, cols], axis=1, kind="stable")
+    return np.take_along_axis(keys[:, cols], order, axis=1), cols[order]
+
+def bucket_matches(table_keys:np.array, table_members:np.array, keys:np.array, files:np.array) -> np.array:
+    """
+    Find every file in a block's bucket table that shares a bucket with one of the given files.
+
+    Parameters:
+    - table_keys (np.array): The block's sorted keys, from bucket_tables
+    - table_members (np.array): The file index of each of the block's keys, from bucket_tables
+    - keys (np.array): The block's key for each of the given files
+    - files (np.array): File index of each of the given files
+
+    Returns:
+    - np.array: Array of size m by 2 of the file index pairs (i, j) with i < j
+    """
+
+    lo = np.searchsorted(table_keys, keys, side="left")
+    counts = np.searchsorted(table_keys, keys, side="right") - lo
+
+    firsts = np.repeat(files, counts)
+    seconds = table_members[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+    return np.column_stack((np.minimum(firsts, seconds), np.maximum(firsts, seconds)))
+
+# Version of the files written by save_similarity_state
+SIMILARITY_STATE_VERSION = 2
+
+def load_similarity_state(fname:str, params:dict) -> dict | None:
+    """
+    Load the similarity state saved by update_similarity.
+
+    Parameters:
+    - fname (str): Similarity state file
+    - params (dict): Minhash and voting parameters the state must have been made with
+
+    Returns:
+    - dict|None: The state's arrays, None if there is no usable state
+    """
+
+    if not os.path.isfile(fname):
+        return None
+
+    with np.load(fname, allow_pickle=False) as npz:
+        state = {name: npz[name] for name in npz.files}
+
+    if int(state["version"]) != SIMILARITY_STATE_VERSION or loads(str(state["params"])) != params:
+        return None
+    return state
+
+def save_similarity_state(fname:str, params:dict, state:dict) -> None:
+    """
+    Save the similarity state used by the next update_similarity call.
+
+    Parameters:
+    - fname (str): Similarity state file
+    - params (dict): Minhash and voting parameters the state was made with
+    - state (dict): The oracle_ids, signatures, bucket_keys, bucket_members, edges and similarity_ids arrays
+    """
+
+    tmp_file = f"{fname}.tmp.npz"
+    np.savez(tmp_file, version=SIMILARITY_STATE_VERSION, params=dumps(params), **state)
+    os.replace(tmp_file, fname)
+
+def assign_similarity_ids(components:list, old_ids:np.array, next_id:int) -> dict:
+    """
+    Give each recomputed component a similarity ID. The component holding the most cards of an old group keeps that
+    group's ID, and any component left over gets a new ID.
+
+    Parameters:
+    - components (list): Lists of card indices of each recomputed component
+    - old_ids (np.array): Previous similarity ID of each card, -1 for new cards
+    - next_id (int): The first unused similarity ID
+
+    Returns:
+    - dict: {key= Similarity ID, value= [List of Card IDs]}
+    """
+
+    # (number of shared cards, component number, old ID) for every old group each component overlaps
+    overlaps = []
+    for num, comp in enumerate(components):
+        ids, counts = np.unique(old_ids[comp], return_counts=True)
+        overlaps.extend((int(count), num, int(old_id)) for old_id, count in zip(ids, counts) if old_id >= 0)
+    overlaps.sort(key=lambda x: (-x[0], x[1], x[2]))
+
+    comp_ids = [None] * len(components)
+    claimed = set()
+    for _, num, old_id in overlaps:
+        if comp_ids[num] is None and old_id not in claimed:
+            comp_ids[num] = old_id
+            claimed.add(old_id)
+
+    new_comps = {}
+    for num, comp in enumerate(components):
+        if comp_ids[num] is None:
+            comp_ids[num] = next_id
+            next_id += 1
+        new_comps[comp_ids[num]] = comp
+    return new_comps
+
+def update_similarity(cards:list, state_file:str, num_minhashes:int, blocks:int, rows_per_block:int, votes:int,
+                      seed:int | None = None, cache_dir:str | None = None, workers:int = 1,
+                      min_jaccard:float | None = None, instrument:Instrumentation | None = None,
+                      shingles:str = fsh.DEFAULT_SHINGLES) -> dict:
+    """
+    Calculate card similarity by updating the previous run's results saved in state_file. Cards are matched to the
+    previous run by their oracle ID, only the band buckets of new or changed cards are recomputed, and only the groups
+    they touch are rebuilt. Every other group keeps its similarity ID, and so does a rebuilt group holding the most
+    cards of an old group. The state file is then updated with the results.
+    Without a usable state file every card counts as new.
+
+    Parameters:
+    - cards (list): List of card dictionaries
+    - state_file (str): File the previous run's similarity state was saved to
+    - num_minhashes (int): The number of minhash steps to perform
+    - blocks (int): Number of blocks
+    - rows_per_block (int): Number of rows per block
+    - votes (int): Minimum number of votes needed to create an edge between cards
+    - seed (int|None): Seed for the minhash hashing functions, use the same seed for reproducible runs (default: None)
+    - cache_dir (str|None): Directory of the signature cache (default: None)
+    - workers (int): Number of processes used to shingle and minhash the cards (default: 1)
+    - min_jaccard (float|None): Drop new edges between cards whose exact Jaccard similarity is below this value (default: None)
+    - instrument (Instrumentation|None): Records the time, memory and item counts of each stage (default: None)
+    - shingles (str): Shingling strategy, a state made with another strategy isn't reused (default: fsh.DEFAULT_SHINGLES)
+
+    Returns:
+    - dict: Dictionary of all the strongly connected components of the graph. {key= Similarity ID, value= [List of Card IDs]}
+    """
+
+    if (blocks*rows_per_block != num_minhashes):
+        print(f"Error: update_similarity, blocks*rows_per_block should be equal to num_minhashes.\n"
+              f" You had {blocks} blocks and {rows_per_block} rows per block for {num_minhashes} minhashes",
+               file=sys.stderr)
+        sys.exit()
+
+    mat, shingle_sets = card_signatures(cards, num_minhashes, seed, cache_dir, workers, instrument, shingles)
+
+    n = len(cards)
+    oracle_ids = np.array([card.get("oracle_id") or "" for card in cards])
+    params = {"num_minhashes": num_minhashes, "blocks": blocks, "rows_per_block": rows_per_block, "votes": votes,
+              "min_jaccard": min_jaccard, "shingles": fsh.format_shingle_strategy(shingles), "shingle_bits": fsh.SHINGLE_BITS}
+    state = load_similarity_state(state_file, params)
+    if state is None:
+        state = {
+            "oracle_ids": np.empty(0, dtype=str),
+            "signatures": np.empty((num_minhashes, 0), dtype=np.uint32),
+            "bucket_keys": np.empty((blocks, 0), dtype=np.uint64),
+            "bucket_members": np.empty((blocks, 0), dtype=np.int64),
+            "edges": np.empty((0, 2), dtype=np.int64),
+            "similarity_ids": np.empty(0, dtype=np.int64),
+        }
+
+    # Match cards to the previous run, cards are unchanged if their signatures are the same. A card's signature can
+    # change without its text changing, when an edit elsewhere adds or removes an important shingle
+    old_rows = {oid: row for row, oid in enumerate(state["oracle_ids"].tolist()) if oid}
+    new_to_old = np.array([old_rows.get(oid, -1) for oid in oracle_ids.tolist()], dtype=np.int64)
+    found = np.flatnonzero(new_to_old >= 0)
+    # Every matched card remembers its group, so a rebuilt group with the same cards gets its ID back
+    old_ids = np.full(n, -1, dtype=np.int64)
+    old_ids[found] = state["similarity_ids"][new_to_old[found]]
+    same = np.all(state["signatures"][:, new_to_old[found]] == mat[:, found], axis=0)
+    new_to_old[found[~same]] = -1
+    old_to_new = np.full(len(state["oracle_ids"]), -1, dtype=np.int64)
+    old_to_new[new_to_old[new_to_old >= 0]] = np.flatnonzero(new_to_old >= 0)
+    changed = np.flatnonzero(new_to_old < 0)
+    print(f"{n - len(changed)} unchanged cards, {len(changed)} new or changed cards, {int((old_to_new < 0).sum())} removed or changed cards")
+
+    with stage(instrument, "sim_vote") as stats:
+        # Drop the removed and changed cards from the bucket tables, they keep the same order in each block
+        kept = old_to_new[state["bucket_members"]] >= 0
+        table_keys = state["bucket_keys"][kept].reshape(blocks, -1)
+        table_members = old_to_new[state["bucket_members"][kept]].reshape(blocks, -1)
+
+        # Vote on the pairs with at least one changed card, by looking the changed cards up in the tables
+        keys, valid = band_keys(mat[:, changed], blocks, rows_per_block)
+        changed_valid = valid.all(axis=0)
+        keys, files = keys[:, changed_valid], changed[changed_valid]
+        codes = []
+        for b in range(blocks):
+            for pairs in (bucket_matches(table_keys[b], table_members[b], keys[b], files),
+                          files[bucket_pairs(keys[b], np.ones(len(files), dtype=bool))]):
+                codes.append(pairs[:,0] * n + pairs[:,1])
+        codes, counts = np.unique(np.concatenate(codes), return_counts=True)
+        new_edges = np.column_stack(np.divmod(codes[counts >= votes], n))
+        stats["candidate_pairs"] = len(codes)
+        stats["edges"] = len(new_edges)
+
+    if min_jaccard is not None:
+        with stage(instrument, "verify") as stats:
+            new_edges, stats["removed_edges"] = verify_edges(new_edges, shingle_sets, min_jaccard)
+            print(f"Verification removed {stats['removed_edges']} of {len(new_edges) + stats['removed_edges']} new edges below a Jaccard similarity of {min_jaccard}")
+
+    # Edges between unchanged cards still have the same votes
+    old_edges = old_to_new[state["edges"]]
+    old_edges = old_edges[np.all(old_edges >= 0, axis=1)]
+    edges = np.concatenate((old_edges, new_edges)).astype(np.int64)
+
+    # Insert the changed cards into the bucket tables
+    new_keys = np.empty((blocks, table_keys.shape[1] + len(files)), dtype=np.uint64)
+    new_members = np.empty(new_keys.shape, dtype=np.int64)
+    for b in range(blocks):
+        order = np.argsort(keys[b], kind="stable")
+        pos = np.searchsorted(table_keys[b], keys[b][order])
+        new_keys[b] = np.insert(table_keys[b], pos, keys[b][order])
+        new_members[b] = np.insert(table_members[b], pos, files[order])
+
+    # Groups that lost a card or gained an edge to a changed card have to be rebuilt
+    touched = np.concatenate((state["similarity_ids"][old_to_new < 0], old_ids[new_edges.ravel()]))
+    affected = np.isin(old_ids, touched) | (old_ids < 0)
+
+    with stage(instrument, "components") as stats:
+        # Find the components of the affected cards, every edge of an affected card stays within them
+        nodes = np.flatnonzero(affected)
+        local = np.full(n, -1, dtype=np.int64)
+        local[nodes] = np.arange(len(nodes))
+        sub_edges = local[edges[affected[edges[:,0]]]]
+        rebuilt = [nodes[comp].tolist() for comp in strongly_connected(sub_edges, len(nodes)).values()]
+        next_id = int(state["similarity_ids"].max()) + 1 if len(state["similarity_ids"]) else 0
+        rebuilt = assign_similarity_ids(rebuilt, old_ids, next_id)
+
+        # Put the unaffected groups back together and number the cards' groups
+        similarity_ids = old_ids.copy()
+        for sim_id, comp in rebuilt.items():
+            similarity_ids[comp] = sim_id
+        order = np.argsort(similarity_ids, kind="stable")
+        ids, starts = np.unique(similarity_ids[order], return_index=True)
+        components = {int(sim_id): comp.tolist() for sim_id, comp in zip(ids, np.split(order, starts[1:]))}
+        stats["components"] = len(components)
+        stats["rebuilt_components"] = len(rebuilt)
+        print(f"Rebuilt {len(rebuilt)} of {len(components)} groups")
+
+    save_similarity_state(state_file, params, {
+        "oracle_ids": oracle_ids,
+        "signatures": mat,
+        "bucket_keys": new_keys,
+        "bucket_members": new_members,
+        "edges": edges,
+        "similarity_ids": similarity_ids,
+    })
+
+    return components
+
+SWEEP_BLOCKS = (12, 16, 24, 32, 48)
+SWEEP_ROWS = (3, 4, 5, 6, 8)
+SWEEP_VOTES = (1, 2, 3, 4, 6, 8)
+
+def vote_probability(similarity:np.array, blocks:int, rows_per_block:int, votes:int) -> np.array:
+    """
+    Probability that two files with the given Jaccard similarity get at least votes votes, when each of the blocks 
+    is a vote that both files' rows_per_block minhashes are equal.
+
+    Parameters:
+    - similarity (np.array): Jaccard similarities
+    - blocks (int): Number of blocks
+    - rows_per_block (int): Number of rows per block
+    - votes (int): Number of votes required
+
+    Returns:
+    - np.array: Probability of each similarity becoming an edge
+    """
+
+    p = np.asarray(similarity, dtype=np.float64) ** rows_per_block
+    return sum(comb(blocks, k) * p**k * (1-p)**(blocks-k) for k in range(votes, blocks+1))
+
+def vote_threshold(blocks:int, rows_per_block:int, votes:int) -> float:
+    """
+    Jaccard similarity at which two files are as likely as not to become an edge.
+
+    Parameters:
+    - blocks (int): Number of blocks
+    - rows_per_block (int): Number of rows per block
+    - votes (int): Number of votes required
+
+    Returns:
+    - float: Similarity threshold, to three decimals
+    """
+
+    grid = np.linspace(0, 1, 1001)
+    return float(grid[np.argmax(vote_probability(grid, blocks, rows_per_block, votes) >= 0.5)])
+
+def sweep_parameters(cards:list, target:float, block_options:tuple = SWEEP_BLOCKS, row_options:tuple = SWEEP_ROWS,
+                     vote_options:tuple = SWEEP_VOTES, recall:float = 0.9, tolerance:float = 0.1, seed:int | None = None,
+                     workers:int = 1, shingles:str = fsh.DEFAULT_SHINGLES) -> tuple[list, dict | None]:
+    """
+    Evaluate many combinations of blocks, rows per block and votes with the same minhashes. The signatures are 
+    computed once for the largest combination, and every combination uses the first blocks*rows_per_block rows.
+
+    A combination meets the target if pairs with a Jaccard similarity of target become edges with probability at 
+    least recall, and its threshold is no more than tolerance below target so it doesn't join much less similar cards.
+
+    Parameters:
+    - cards (list): List of card dictionaries
+    - target (float): Jaccard similarity the groups should be formed at
+    - block_options (tuple): Numbers of blocks to try (default: SWEEP_BLOCKS)
+    - row_options (tuple): Numbers of rows per block to try (default: SWEEP_ROWS)
+    - vote_options (tuple): Numbers of votes to try, the ones above the number of blocks are skipped (default: SWEEP_VOTES)
+    - recall (float): Minimum probability of finding pairs at the target similarity (default: 0.9)
+    - tolerance (float): How far below target the threshold may be (default: 0.1)
+    - seed (int|None): Seed for the minhash hashing functions (default: None)
+    - workers (int): Number of processes and threads used by each step (default: 1)
+    - shingles (str): Shingling strategy (default: fsh.DEFAULT_SHINGLES)
 
     Returns:
-    - dict: Important shingles dictionary
-    """
-
-    shin_freq = dict()      # Shingle Frequency
-    # Loop through the files retrieving all of our shingles
-    for card in card_list:
-        words = card["oracle_text"]
-        for shin in fsh.kshingles(words, k=3):
-            fsh.add_to_dict(shin, shin_freq)
-
-    ordered_shin = dict()
-    i = 0
-    for k in sorted(shin_freq.keys()):
-        if(shin_freq[k] >= minVal):
-            fsh.add_to_dict(k, ordered_shin, i)
-            i += 1
- 
-    print(len(ordered_shin), 'shingles')
-    return ordered_shin
+    - tuple: A dictionary of results per combination (list), and the one with the fewest minhashes then candidate 
+             pairs that meets the target (dict|None)
+    """
+
+    n = len(cards)
+    max_hashes = max(block_options) * max(row_options)
+    mat, _ = card_signatures(cards, max_hashes, seed, workers=workers, shingles=shingles)
+
+    results = []
+    for blocks in block_options:
+        for rows_per_block in row_options:
+            num_minhashes = blocks * rows_per_block
+            start = perf_counter()
+            pairs, counts = candidate_pairs(mat[:num_minhashes], blocks, rows_per_block, workers)
+            candidate_time = perf_counter() - start
+
+            for votes in vote_options:
+                if votes > blocks:
+                    continue
+                start = perf_counter()
+                components = strongly_connected(pairs[counts >= votes], n)
+                sizes = np.array([len(members) for members in components.values()])
+                threshold = vote_threshold(blocks, rows_per_block, votes)
+                found = float(vote_probability(target, blocks, rows_per_block, votes))
+
+                results.append({
+                    "num_minhashes": num_minhashes,
+                    "blocks": blocks,
+                    "rows_per_block": rows_per_block,
+                    "votes": votes,
+                    "candidate_pairs": len(pairs),
+                    "edges": int((counts >= votes).sum()),
+                    "groups": int((sizes >= 2).sum()),
+                    "largest_group": int(sizes.max()) if n else 0,
+                    "mean_group_size": float(sizes[sizes >= 2].mean()) if (sizes >= 2).any() else 0.0,
+                    "median_group_size": float(np.median(sizes[sizes >= 2])) if (sizes >= 2).any() else 0.0,
+                    "threshold": threshold,
+                    "target_probability": found,
+                    "meets_target": found >= recall and threshold >= target - tolerance,
+                    "seconds": candidate_time + perf_counter() - start,
+                })
+
+    meeting = [r for r in results if r["meets_target"]]
+    best = min(meeting, key=lambda r: (r["num_minhashes"], r["candidate_pairs"], r["seconds"])) if meeting else None
+    return results, best
+
+def print_sweep(results:list, best:dict | None, target:float) -> None:
+    """
+    Print the results of sweep_parameters as a table, and the recommended combination.
+
+    Parameters:
+    - results (list): Results of sweep_parameters
+    - best (dict|None): Recommended combination of sweep_parameters
+    - target (float): Jaccard similarity the sweep targeted
+    """
+
+    print(f"\n{'hashes':>6} {'blocks':>6} {'rows':>4} {'votes':>5} {'threshold':>9} {'P(target)':>9} {'candidates':>10} "
+          f"{'edges':>8} {'groups':>6} {'largest':>7} {'mean':>6} {'median':>6} {'seconds':>7}")
+    for r in results:
+        print(f"{r['num_minhashes']:>6} {r['blocks']:>6} {r['rows_per_block']:>4} {r['votes']:>5} {r['threshold']:>9.3f} "
+              f"{r['target_probability']:>9.3f} {r['candidate_pairs']:>10} {r['edges']:>8} {r['groups']:>6} "
+              f"{r['largest_group']:>7} {r['mean_group_size']:>6.2f} {r['median_group_size']:>6.1f} {r['seconds']:>7.3f}"
+              f"{' *' if r['meets_target'] else ''}")
+
+    if best is None:
+        print(f"\nNo combination meets a target similarity of {target}, try more blocks or a lower recall.")
+    else:
+        print(f"\nRecommended for a target similarity of {target}: {best['num_minhashes']} minhashes, {best['blocks']} blocks, "
+              f"{best['rows_per_block']} rows per block, {best['votes']} votes (threshold {best['threshold']:.3f}).")
 
 def gen_custom_data(cards:list, components:dict) -> list:
     """
@@ -273,46 +1213,105 @@ def gen_custom_data(cards:list, components:dict) -> list:
 
     new_cards = []
 
-    useful_keys = ["name","released_at","uri","scryfall_uri","image_uris","mana_cost","cmc","type_line","oracle_text","colors","color_identity","set_name","collector_number","rarity","flavor_text","artist","multifaced",]
-    all_lens = [0] * len(components)
     for comp_id in components.keys():
-        comp_len = len(components[comp_id])
-        all_lens[int(comp_id)] = comp_len
-
         # Reunite the cards with their names (they were reduced to indices after generating their characteristic binary representation)
         for card_id in components[comp_id]:
             new_card = {"card_id": int(card_id), "similarity_id": int(comp_id)}     # Must be cast to int, otherwise they can't be saved in json bc they're np.int64
-            for card_key in useful_keys:
+            for card_key in fsh.USEFUL_KEYS:
                 new_card[card_key] = cards[card_id].get(card_key)
             new_cards.append(new_card)
     
     return new_cards
 
-def save_dict(d:dict, fname:str):
-    with open(fname, "w") as fd:
-        json_obj = dumps(d, indent=2)
-        fd.write(json_obj)
+# File formats of the refined cards, {key= Format, value= File extension}
+CARD_FORMATS = {"json": ".json", "jsonl": ".jsonl", "npz": ".npz"}
+
+def file_format(fname:str) -> str:
+    # Format of a file from its extension, JSON for anything unknown
+    ext = os.path.splitext(fname)[1].lower()
+    return next((format for format, format_ext in CARD_FORMATS.items() if format_ext == ext), "json")
+
+def save_dict(d:dict | list | CardStore, fname:str, format:str | None = None):
+    """
+    Save results to a file. JSON is written indented in one go, JSON Lines one list item per line as they're
+    encoded, and npz as a CardStore's typed columns and string tables, see CardStore.save.
+
+    Parameters:
+    - d (dict|list|CardStore): Results to save, only lists of dictionaries and card stores can be saved as jsonl or npz
+    - fname (str): File to write
+    - format (str|None): "json", "jsonl" or "npz", None picks it from fname's extension (default: None)
+    """
+
+    format = format or file_format(fname)
+    if format not in CARD_FORMATS:
+        raise ValueError(f"Unknown format '{format}', expected one of {', '.join(CARD_FORMATS)}.")
+    if format != "json" and isinstance(d, dict):
+        raise ValueError(f"Only lists of dictionaries can be saved as {format}.")
+
+    if format == "npz":
+        store = d if isinstance(d, CardStore) else CardStore.from_cards(d)
+        store.save(fname)
+    elif format == "jsonl":
+        with open(fname, "w") as fd:
+            for item in d:
+                fd.write(dumps(item, default=dict) + "\n")
+    else:
+        with open(fname, "w") as fd:
+            json_obj = dumps(d.tolist() if isinstance(d, CardStore) else d, indent=2)
+            fd.write(json_obj)
+
+def load_cards(fname:str) -> CardStore:
+    """
+    Load a card list saved with save_dict in any of the CARD_FORMATS, the format is picked from the file's extension.
+    npz is the fastest to load by far, JSON is parsed whole then encoded into the store's columns.
+
+    Parameters:
+    - fname (str): json, jsonl or npz file
 
-# Returns the custom card data, either by generating it first or reusing a file from that day
-def get_custom_cards(dir:str | None = 'card_data') -> list:
+    Returns:
+    - CardStore: The saved cards
+    """
+
+    format = file_format(fname)
+    if format == "npz":
+        return CardStore.load(fname)
+    if format == "jsonl":
+        with open(fname, "r") as fd:
+            return CardStore.from_cards([loads(line) for line in fd if line.strip()])
+    with open(fname, "r") as fd:
+        return CardStore.from_cards(loads(fd.read()))
+
+# Returns the custom card data as a CardStore, either by generating it first or reusing a file from that day
+#  format is the file format of the card data, one of CARD_FORMATS, npz loads in a fraction of the time of JSON
+def get_custom_cards(dir:str | None = 'card_data', workers:int = 1, instrument:Instrumentation | None = None,
+                     format:str = "npz") -> CardStore:
     import datetime
+    if format not in CARD_FORMATS:
+        raise ValueError(f"Unknown format '{format}', expected one of {', '.join(CARD_FORMATS)}.")
     current_date = datetime.datetime.now().date()
-    output_file = os.path.join(dir, f"refined-cards-{current_date}.json")
+    ext = CARD_FORMATS[format]
+    output_file = os.path.join(dir, f"refined-cards-{current_date}{ext}")
 
     # Create the data file if it doesn't exist for the day
     if not os.path.isfile(output_file):
         print("Processing card data for a new list...")
-        all_cards = get_card_list(dir=dir)
-        components = card_similarity(all_cards, num_minhashes=144, blocks=24, rows_per_block=6, votes=6, max_rows=500)
-        cards = gen_custom_data(all_cards, components)
-        save_dict(cards, output_file)
-        delete_old_jsons(dir=dir, pathname='refined-cards-*.json', excluded_jsons=[f"refined-cards-{current_date}.json"])
+        with stage(instrument, "load_cards") as stats:
+            all_cards = get_card_list(dir=dir, workers=workers)
+            stats["cards"] = len(all_cards)
+        components = update_similarity(all_cards, os.path.join(dir, "similarity-state.npz"), num_minhashes=144, blocks=24,
+                                       rows_per_block=6, votes=6, cache_dir=os.path.join(dir, "signature-cache"), workers=workers,
+                                       instrument=instrument)
+        with stage(instrument, "save_cards") as stats:
+            cards = gen_custom_data(all_cards, components)
+            cards = CardStore.from_cards(cards)
+            save_dict(cards, output_file, format)
+            stats["cards"] = len(cards)
+        delete_old_jsons(dir=dir, pathname=f'refined-cards-*{ext}', excluded_jsons=[f"refined-cards-{current_date}{ext}"])
     # Reuse a file generated that day
     else:
         print("Loading pre-made card data file")
-        with open(output_file, "r") as fd:
-            cards = loads(fd.read())
-            print(len(cards), type(cards))
+        cards = load_cards(output_file)
+        print(len(cards), type(cards))
 
     return cards
 
@@ -324,37 +1323,85 @@ if __name__ == "__main__":
     blocks = 24
     rows_per_block = 6
     votes = 6
-    max_rows = 500
+    workers = 1
 
     if("-h" in sys.argv or "--help" in sys.argv):
-        print(f"Usage: {sys.argv[0]} [oracle-cards-file] [num-minhashes] [blocks] [rows-per-block]", file=sys.stderr)
+        print(f"Usage: {sys.argv[0]} [--workers N] [--min-jaccard J] [--sweep TARGET] [--metrics FILE] [--shingles STRATEGY] [oracle-cards-file] [num-minhashes] [blocks] [rows-per-block] [votes]", file=sys.stderr)
         print("'oracle-cards-file' will be automatically retrieved if not found locally.", file=sys.stderr)
         print(f"'num-minhashes' defaults to {num_minhashes}. It must be the result of blocks*rows_per_block.", file=sys.stderr)
         print(f"'blocks' defaults to {blocks}.", file=sys.stderr)
         print(f"'rows_per_block' defaults to {rows_per_block}.", file=sys.stderr)
         print(f"'votes' defaults to {votes}.", file=sys.stderr)
-        print(f"'max_rows' defaults to {max_rows}.", file=sys.stderr)
+        print(f"'--workers' is the number of processes to run the steps on, it defaults to {workers}.", file=sys.stderr)
+        print("'--min-jaccard' removes edges between cards with a lower exact Jaccard similarity, off by default.", file=sys.stderr)
+        print("'--metrics' records the time, memory and item counts of each stage, in the Prometheus text format if FILE ends in .prom and as JSON lines otherwise.", file=sys.stderr)
+        print(f"'--shingles' picks the shingles, character or word k-grams like 'char:3', 'word:2' or 'word:2+char:5', it defaults to '{fsh.DEFAULT_SHINGLES}'.", file=sys.stderr)
+        print("'--sweep' evaluates many blocks/rows/votes combinations and recommends the cheapest one for a target Jaccard similarity.", file=sys.stderr)
         sys.exit()
 
+    # Remove the optional flags before reading the positional arguments
+    args = sys.argv[1:]
+    if "--workers" in args:
+        i = args.index("--workers")
+        workers = int(args[i+1])
+        del args[i:i+2]
+    min_jaccard = None
+    if "--min-jaccard" in args:
+        i = args.index("--min-jaccard")
+        min_jaccard = float(args[i+1])
+        del args[i:i+2]
+    sweep_target = None
+    if "--sweep" in args:
+        i = args.index("--sweep")
+        sweep_target = float(args[i+1])
+        del args[i:i+2]
+    instrument = None
+    if "--metrics" in args:
+        i = args.index("--metrics")
+        sink = PrometheusSink(args[i+1]) if args[i+1].endswith(".prom") else JsonLinesSink(args[i+1])
+        instrument = Instrumentation(sink)
+        del args[i:i+2]
+    shingles = fsh.DEFAULT_SHINGLES
+    if "--shingles" in args:
+        i = args.index("--shingles")
+        shingles = args[i+1]
+        del args[i:i+2]
+        try:
+            shingles = fsh.format_shingle_strategy(shingles)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit()
+
     fname = None
-    if len(sys.argv) > 1:
-        fname = sys.argv[1]
+    if len(args) > 0:
+        fname = args[0]
         if(not os.path.isfile(fname)):
             print(f"\"{fname}\" is not a file or cannot be found.", file=sys.stderr)
             sys.exit()
-    if(len(sys.argv) > 2):
-        num_minhashes = int(sys.argv[2])
-    if(len(sys.argv) > 3):
-        blocks = int(sys.argv[3])
-    if(len(sys.argv) > 4):
-        rows_per_block = int(sys.argv[4])
+    if(len(args) > 1):
+        num_minhashes = int(args[1])
+    if(len(args) > 2):
+        blocks = int(args[2])
+    if(len(args) > 3):
+        rows_per_block = int(args[3])
+    if(len(args) > 4):
+        votes = int(args[4])
 
     from statistics import median
 
     # Calculate card similarity
-    all_cards = get_card_list(fname)                             # Get card list
+    with stage(instrument, "load_cards") as stats:
+        all_cards = get_card_list(fname, workers=workers)            # Get card list
+        stats["cards"] = len(all_cards)
+
+    if sweep_target is not None:
+        results, best = sweep_parameters(all_cards, sweep_target, workers=workers, shingles=shingles)
+        print_sweep(results, best, sweep_target)
+        sys.exit()
+
     card_names = [entry["name"] for entry in all_cards]     # Get all the card names for later
-    components = card_similarity(all_cards, num_minhashes, blocks, rows_per_block, votes, max_rows)
+    components = card_similarity(all_cards, num_minhashes, blocks, rows_per_block, votes, workers=workers, min_jaccard=min_jaccard,
+                                 instrument=instrument, shingles=shingles)
 
     # Collect some data about the components
     n = len(all_cards)
@@ -379,7 +1426,10 @@ if __name__ == "__main__":
     print(f"Average group size: {n/len(components):.2f}")
     print(f"Median group size: {median(all_lens)}")
 
+    # The groups with the parameters that produced them
+    params = {"num_minhashes": num_minhashes, "blocks": blocks, "rows_per_block": rows_per_block, "votes": votes,
+              "min_jaccard": min_jaccard, "shingles": fsh.format_shingle_strategy(shingles), "shingle_bits": fsh.SHINGLE_BITS}
     new_file = "card_data/card-similarity.json"
     print(f"\nSaving to '{new_file}'...")
-    save_dict(components, new_file)
+    save_dict({"params": params, "groups": components}, new_file)
     print("Saved.")
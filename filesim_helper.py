@@ -1,14 +1,217 @@
+import re
 from re import sub
 import os
 import sys
 import json
+import hashlib
+import numpy as np
+from collections import deque
+from itertools import batched
+from concurrent.futures import ProcessPoolExecutor
 
 # Return the set of tuples from a given word list
 def kshingles(data:list, k:int = 3) -> set:
-    shingles = {tuple(data[i:i+k]) for i in range(len(data)-k-1)}   # set comprehension
+    shingles = {tuple(data[i:i+k]) for i in range(len(data)-k+1)}   # set comprehension
     return shingles
 
 
+# Number of bits used for each character when packing a shingle into an integer code
+CODE_BITS = 21
+
+def kshingle_codes(texts:list, k:int = 3) -> tuple[np.array, np.array]:
+    """
+    Shingle a batch of texts at once, packing the characters' code points of each k-shingle into a single integer.
+    Integer codes sort in the same order as the tuples made by kshingles, and each text keeps the same shingles.
+    Unlike shingle_texts the codes are exact, card_search uses them as its trigram postings keys.
+
+    Parameters:
+    - texts (list): List of strings
+    - k (int): Number of characters in each shingle (default: 3)
+
+    Returns:
+    - tuple: Pointers (np.array) of length len(texts)+1 and shingle codes (np.array), text i's unique shingles in
+             ascending order are codes[ptr[i]:ptr[i+1]]
+    """
+
+    if k * CODE_BITS > 63:
+        raise ValueError(f"Shingles of {k} characters can't be packed into 64 bits.")
+
+    # Code points of every text, one after another
+    lens = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    chars = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+
+    # Pack each run of k characters, shingle s starts at character s
+    n_starts = max(len(chars) - k + 1, 0)
+    codes = np.zeros(n_starts, dtype=np.int64)
+    for i in range(k):
+        codes = (codes << CODE_BITS) | chars[i:i+n_starts]
+
+    # Only keep the shingles that start and end in the same text
+    text_ids, codes = shingles_within(codes, lens, k)
+    return unique_per_text(text_ids, codes, len(texts))
+
+
+def shingles_within(codes:np.array, lens:np.array, k:int) -> tuple[np.array, np.array]:
+    """
+    Drop the k-grams of a stream of joined texts that run from one text into the next.
+
+    Parameters:
+    - codes (np.array): Code of the k-gram starting at each position of the stream
+    - lens (np.array): Length of each text in the stream
+    - k (int): Number of positions in each k-gram
+
+    Returns:
+    - tuple: Text (np.array) and code (np.array) of each k-gram that's inside a text
+    """
+
+    n = len(codes)
+    text_ids = np.repeat(np.arange(len(lens)), lens)[:n]
+    offsets = np.arange(n) - np.repeat(np.cumsum(lens) - lens, lens)[:n]
+    keep = offsets <= (lens - k)[text_ids]
+    return text_ids[keep], codes[keep]
+
+
+def unique_per_text(text_ids:np.array, codes:np.array, n_texts:int) -> tuple[np.array, np.array]:
+    """
+    Sort each text's shingle codes and remove its duplicates.
+
+    Parameters:
+    - text_ids (np.array): Text of each shingle
+    - codes (np.array): Code of each shingle
+    - n_texts (int): Number of texts
+
+    Returns:
+    - tuple: Pointers (np.array) of length n_texts+1 and shingle codes (np.array), text i's unique shingles in
+             ascending order are codes[ptr[i]:ptr[i+1]]
+    """
+
+    # Sort by text, then code, and remove each text's duplicate shingles
+    order = np.lexsort((codes, text_ids))
+    text_ids, codes = text_ids[order], codes[order]
+    unique = np.ones(len(codes), dtype=bool)
+    unique[1:] = (codes[1:] != codes[:-1]) | (text_ids[1:] != text_ids[:-1])
+    text_ids, codes = text_ids[unique], codes[unique]
+
+    ptr = np.zeros(n_texts+1, dtype=np.int64)
+    np.cumsum(np.bincount(text_ids, minlength=n_texts), out=ptr[1:])
+    return ptr, codes
+
+
+# Shingling strategies are written like "char:3", "word:2" or "word:2+char:5", a "+" combines several kinds of shingles
+DEFAULT_SHINGLES = "char:3"
+SHINGLE_KINDS = ("char", "word")
+# Shingles are hashed to codes of this many bits, so the vocabulary is bounded whatever the strategy. 31 bits keeps
+# the codes below cardsim.MINHASH_PRIME, so they're minhashed without merging codes that differ by the prime
+SHINGLE_BITS = 31
+
+# Words of normalised oracle text: mana and other symbols, power/toughness changes like +1/+1, and words
+WORD_TOKENS = re.compile(r"\{[^}]*\}|[+\-]?[\dx*]+/[+\-]?[\dx*]+|[\w'~]+")
+
+HASH_MULT = np.uint64(0x100000001B3)
+HASH_MIX1 = np.uint64(0xFF51AFD7ED558CCD)
+HASH_MIX2 = np.uint64(0xC4CEB9FE1A85EC53)
+
+def parse_shingle_strategy(strategy:str) -> list:
+    """
+    Parse a shingling strategy like "word:2+char:5".
+
+    Parameters:
+    - strategy (str): Kinds of shingles joined by "+", each written kind:k
+
+    Returns:
+    - list: (kind, k) tuples in the order they were written, with repeats removed
+    """
+
+    parts = []
+    for part in strategy.replace(" ", "").lower().split("+"):
+        kind, _, k = part.partition(":")
+        if kind not in SHINGLE_KINDS or not k.isdigit() or int(k) < 1:
+            raise ValueError(f"Invalid shingling strategy '{strategy}', expected kinds like 'char:3' or 'word:2' joined by '+'.")
+        if (kind, int(k)) not in parts:
+            parts.append((kind, int(k)))
+    return parts
+
+def format_shingle_strategy(strategy:str) -> str:
+    """Canonical spelling of a shingling strategy, the one saved in caches and index files"""
+    return "+".join(f"{kind}:{k}" for kind, k in parse_shingle_strategy(strategy))
+
+def mix_codes(codes:np.array, tag:int, bits:int = SHINGLE_BITS) -> np.array:
+    # Scramble 64-bit codes (with a tag for the kind of shingle) and keep the top bits
+    x = codes.astype(np.uint64) ^ np.uint64(tag * 0x9E3779B97F4A7C15 % (1 << 64))
+    x ^= x >> np.uint64(33)
+    x *= HASH_MIX1
+    x ^= x >> np.uint64(33)
+    x *= HASH_MIX2
+    x ^= x >> np.uint64(33)
+    return (x >> np.uint64(64 - bits)).astype(np.int64)
+
+def rolling_codes(values:np.array, k:int) -> np.array:
+    # Polynomial hash of each run of k values, wrapping around at 2^64
+    n = max(len(values) - k + 1, 0)
+    codes = np.zeros(n, dtype=np.uint64)
+    for i in range(k):
+        codes = codes * HASH_MULT + values[i:i+n]
+    return codes
+
+def word_tokens(texts:list) -> tuple[np.array, np.array]:
+    """
+    Normalise texts to a stream of word tokens: lowercased, split on anything that isn't part of a word or a symbol.
+
+    Parameters:
+    - texts (list): List of strings
+
+    Returns:
+    - tuple: Number of tokens in each text (np.array) and a 64-bit hash of every token of every text (np.array)
+    """
+
+    token_lists = [WORD_TOKENS.findall(text.lower()) for text in texts]
+    lens = np.fromiter(map(len, token_lists), dtype=np.int64, count=len(texts))
+
+    # Hash each distinct token once, with a hash that's the same in every process and run
+    ids = {}
+    token_ids = np.fromiter((ids.setdefault(token, len(ids)) for tokens in token_lists for token in tokens),
+                            dtype=np.int64, count=int(lens.sum()))
+    token_hashes = np.fromiter((int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                                for token in ids), dtype=np.uint64, count=len(ids))
+    return lens, token_hashes[token_ids]
+
+def shingle_texts(texts:list, strategy:str = DEFAULT_SHINGLES, bits:int = SHINGLE_BITS) -> tuple[np.array, np.array]:
+    """
+    Shingle a batch of texts with a shingling strategy: character k-grams, word k-grams over the normalised
+    words of the text, or several of them combined. Every shingle is hashed to a code of a fixed number of bits,
+    and the code also depends on the kind and length of the shingle so different kinds don't collide on purpose.
+
+    Parameters:
+    - texts (list): List of strings
+    - strategy (str): Shingling strategy like "char:3", "word:2" or "word:2+char:5" (default: DEFAULT_SHINGLES)
+    - bits (int): Number of bits of each shingle code, at most 62 (default: SHINGLE_BITS)
+
+    Returns:
+    - tuple: Pointers (np.array) of length len(texts)+1 and shingle codes (np.array), text i's unique shingles in
+             ascending order are codes[ptr[i]:ptr[i+1]]
+    """
+
+    if not 1 <= bits <= 62:
+        raise ValueError(f"Shingle codes must have between 1 and 62 bits, not {bits}.")
+
+    parts = parse_shingle_strategy(strategy)
+    streams = {}
+    if any(kind == "char" for kind, _ in parts):
+        streams["char"] = (np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)),
+                           np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64))
+    if any(kind == "word" for kind, _ in parts):
+        streams["word"] = word_tokens(texts)
+
+    all_ids, all_codes = [], []
+    for kind, k in parts:
+        lens, values = streams[kind]
+        text_ids, codes = shingles_within(rolling_codes(values, k), lens, k)
+        all_ids.append(text_ids)
+        all_codes.append(mix_codes(codes, SHINGLE_KINDS.index(kind) << 16 | k, bits))
+
+    return unique_per_text(np.concatenate(all_ids), np.concatenate(all_codes), len(texts))
+
+
 # Add some value to a dict if it isn't already there, otherwise increment it
 def add_to_dict(key_name:str, dictionary:dict, on_creation:int=1) -> None:
     if (key_name not in dictionary):
@@ -17,59 +220,144 @@ def add_to_dict(key_name:str, dictionary:dict, on_creation:int=1) -> None:
         dictionary[key_name] += 1
 
 
-# Input raw oracle-cards file, returns list of 
-def clean_cards(fname:str) -> list:
-    if(not os.path.isfile(fname)):
-        print(f"\"{fname}\" is not a file or cannot be found.", file=sys.stderr)
-        sys.exit()
-    
+# Keys kept from each card of the oracle-cards file
+USEFUL_KEYS = ["name","released_at","uri","scryfall_uri","image_uris","mana_cost","cmc","type_line","oracle_text","colors","color_identity","set_name","collector_number","rarity","flavor_text","artist","multifaced",]
+CARD_KEYS = ["oracle_id"] + USEFUL_KEYS
+
+# Whitespace and commas between the values of a JSON array
+ARRAY_SEPARATORS = re.compile(r"[\s,]*")
+# Characters that can follow a complete value of a JSON array
+VALUE_ENDS = frozenset(" \t\n\r,]")
+
+def iter_json_array(fname:str, chunk_size:int = 1 << 16):
+    """
+    Parse the values of a file's top-level JSON array one at a time, only holding a few chunks of the file in memory.
+
+    Parameters:
+    - fname (str): JSON file containing an array
+    - chunk_size (int): Number of characters to read from the file at once (default: 65536)
+
+    Returns:
+    - generator: The values of the array
+    """
+
+    decoder = json.JSONDecoder()
     with open(fname, encoding='utf-8') as fd:
-        data = json.load(fd)
-    
-    results = []
-    for x in data:
+        buf = fd.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f"\"{fname}\" does not contain a JSON array.")
+        pos = 1
+        eof = False
 
-        # Skip cards that are not legal in commander
-        if x['legalities']["commander"] != 'legal':
-            continue
-        
-        # Combine multi-faced cards into one oracle text
-        if x.get('card_faces'):
-            colors = set()
-            for face in x['card_faces']:
-                # Check if colors is missing, if so update colors if the 'colors' list exists for the card face
-                if x.get('colors') == None and face.get('colors') != None:
-                    colors.update(face.get('colors'))
-                
-                # Remove reminder text
-                face["oracle_text"] = sub(r"\(.*\)", '', face["oracle_text"])
-                # Escape special characters from the name
-                name = sub(r"[\-\.\/\[\]\\\*\+\?\)\{\}\|]", "\\\1", face['name'])
-                # Replace instances of own name with ~
-                face["oracle_text"] = sub(rf"{name}", '~', face["oracle_text"])
+        while True:
+            pos = ARRAY_SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+
+            # Only trust a value that's followed by a separator, a cut off value may still parse, like "3." as 3
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            if end is not None and (buf[end:end+1] in VALUE_ENDS or eof):
+                yield value
+                pos = end
+                continue
+
+            if eof:
+                raise ValueError(f"\"{fname}\" ended before the JSON array was closed.")
+
+            # Drop the parsed values and read the next chunk
+            chunk = fd.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+# Reminder text is removed from the oracle text
+REMINDER_TEXT = re.compile(r"\(.*\)")
+# Characters of card names and face names that used to be escaped before the name was replaced with ~
+NAME_SPECIAL = re.compile(r"[\-\.\/\[\]\\\*\+\?\{\}\|]")
+FACE_NAME_SPECIAL = re.compile(r"[\-\.\/\[\]\\\*\+\?\)\{\}\|]")
+# Regex characters that were never escaped
+REGEX_SPECIAL = re.compile(r"[()^$]")
+
+# Replace instances of a card's own name in its oracle text with ~
+def replace_name(text:str, name:str, special:re.Pattern) -> str:
+    # The old escaping turned each special character into "\\\x01", an escaped \x01 character, so names with one
+    #  only match text with a \x01 in its place
+    target = special.sub("\x01", name)
+    # Fall back to the old regex for the names that still have regex characters, to keep the same output
+    if REGEX_SPECIAL.search(target):
+        name = special.sub("\\\1", name)
+        return sub(rf"{name}", '~', text)
+    return text.replace(target, '~')
+
+# Combine a card's faces into one oracle text and clean it
+def clean_card(x:dict) -> dict:
+    # Combine multi-faced cards into one oracle text
+    if x.get('card_faces'):
+        colors = set()
+        for face in x['card_faces']:
+            # Check if colors is missing, if so update colors if the 'colors' list exists for the card face
+            if x.get('colors') == None and face.get('colors') != None:
+                colors.update(face.get('colors'))
             
-            x['oracle_text'] = '\n//\n'.join([face["oracle_text"] for face in x['card_faces']])
-
-            # Some cards are multi-faced and missing an overall color value, so it needs to be set
-            if x.get('colors') == None:
-                x['colors'] = list(colors)
-
-            # Some multi-faced cards have multiple faces, i.e. transform and modal dual-faced cards
-            if x.get('image_uris') == None:
-                x['image_uris'] = [face['image_uris'] for face in x['card_faces']]
-                x['multifaced'] = True
-            else:
-                x['multifaced'] = False
-        
-        # Clean normal card's text
-        elif x.get('oracle_text'):
             # Remove reminder text
-            x["oracle_text"] = sub(r"\(.*\)", '', x["oracle_text"])
-            # Escape special characters from the name
-            name = sub(r"[\-\.\/\[\]\\\*\+\?\{\}\|]", "\\\1", x['name'])
+            face["oracle_text"] = REMINDER_TEXT.sub('', face["oracle_text"])
             # Replace instances of own name with ~
-            x["oracle_text"] = sub(rf"{name}", '~', x["oracle_text"])
+            face["oracle_text"] = replace_name(face["oracle_text"], face['name'], FACE_NAME_SPECIAL)
+        
+        x['oracle_text'] = '\n//\n'.join([face["oracle_text"] for face in x['card_faces']])
+
+        # Some cards are multi-faced and missing an overall color value, so it needs to be set
+        if x.get('colors') == None:
+            x['colors'] = list(colors)
+
+        # Some multi-faced cards have multiple faces, i.e. transform and modal dual-faced cards
+        if x.get('image_uris') == None:
+            x['image_uris'] = [face['image_uris'] for face in x['card_faces']]
+            x['multifaced'] = True
+        else:
+            x['multifaced'] = False
+    
+    # Clean normal card's text
+    elif x.get('oracle_text'):
+        # Remove reminder text
+        x["oracle_text"] = REMINDER_TEXT.sub('', x["oracle_text"])
+        # Replace instances of own name with ~
+        x["oracle_text"] = replace_name(x["oracle_text"], x['name'], NAME_SPECIAL)
+
+    return {key: x[key] for key in CARD_KEYS if key in x}
+
+# Clean a chunk of cards, used by the worker processes of iter_clean_cards
+def clean_card_chunk(chunk:list) -> list:
+    return [clean_card(x) for x in chunk]
+
+# Input raw oracle-cards file, yields each commander legal card with only the CARD_KEYS
+#  With more than one worker, chunks of cards are cleaned in parallel by a process pool
+def iter_clean_cards(fname:str, workers:int = 1, chunk_size:int = 512):
+    if(not os.path.isfile(fname)):
+        print(f"\"{fname}\" is not a file or cannot be found.", file=sys.stderr)
+        sys.exit()
+
+    # Skip cards that are not legal in commander, and only send the keys that are used to the workers
+    legal = ({key: x[key] for key in CARD_KEYS + ['card_faces'] if key in x}
+             for x in iter_json_array(fname) if x['legalities']["commander"] == 'legal')
+
+    if workers <= 1:
+        yield from map(clean_card, legal)
+        return
 
-        results.append(x)
+    # Keep a few chunks per worker in flight, yielding the results in order
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in batched(legal, chunk_size):
+            pending.append(executor.submit(clean_card_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
-    return results
+# Input raw oracle-cards file, returns list of cleaned commander legal cards
+def clean_cards(fname:str, workers:int = 1) -> list:
+    return list(iter_clean_cards(fname, workers))
@@ -1,11 +1,21 @@
 import tkinter as tk
-from threading import Thread, Event
-from urllib.request import urlopen, Request
-from PIL import ImageTk
-from time import sleep
-import operator
-
-PROGRAM_VERSION = "MTGCardSimilarity/0.1"
+from image_loader import ImageFetcher, DiskImageCache, LRUCache
+from card_search import SearchIndex
+from PIL import Image, ImageTk
+from io import BytesIO
+import os
+import sys
+import queue
+
+IMAGE_WORKERS = 4       # Number of images downloaded at the same time
+IMAGE_POLL_MS = 30      # How often downloaded images are put on the labels
+IMAGE_CACHE_DIR = os.path.join("card_data", "image-cache")
+MEMORY_CACHE_BYTES = 256 << 20      # Decoded images kept in memory, a normal card image is about 1 MB decoded
+CARD_WIDTH, CARD_HEIGHT = 488, 680  # Size of Scryfall's normal images
+CARD_BORDER = 4                     # Border around each card, coloured by its similarity ID
+MARGIN_ROWS = 1                     # Rows bound above and below the viewport
+PREFETCH_ROWS = 3                   # Queued downloads further than this many rows from the viewport are dropped
+MISSING_IMAGE = "https://cards.scryfall.io/normal/front/a/3/a3da3387-454c-4c09-b78f-6fcc36c426ce.jpg"
 
 class App(tk.Tk):
     def __init__(self, cards:list):
@@ -20,159 +30,222 @@ class App(tk.Tk):
 
 
 class CardDisplay(tk.Frame):
+    """
+    Scrollable grid of cards. Only a fixed pool of SingleCard widgets exists, enough for the rows on screen plus
+    MARGIN_ROWS above and below, and the widgets are moved and rebound to other cards as the canvas scrolls.
+    """
+
     def __init__(self, parent:tk.Tk, card_dicts:list, cards_per_row:int):
         super().__init__(parent)
 
-        self.image_limit = cards_per_row * 4
-        self.image_count = 0
-        self.load_thread = None
-        self.stop_event = Event()
-        self.pause_event = Event()
-        self.pause_event.set()
-
-        self.canvas = tk.Canvas(self, border=5)
-        self.scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
-
         self.cards_per_row = cards_per_row
-        self.cardlab_frame = tk.Frame(self.canvas, border=1)
-        self.cardlab_frame.pack()
-        self.cardlabs = []
+        self.col_width = CARD_WIDTH + 2 * CARD_BORDER
+        self.row_height = CARD_HEIGHT + 2 * CARD_BORDER
+
+        self.fetcher = ImageFetcher(workers=IMAGE_WORKERS, cache=DiskImageCache(IMAGE_CACHE_DIR))
+        self.image_cache = LRUCache(MEMORY_CACHE_BYTES)  # {key= URL, value= ImageTk.PhotoImage}, only used from the main thread
+        self.generation = 0             # Images downloaded for an older result set are ignored
+        self.loaded = queue.Queue()     # Decoded images waiting to be shown, filled by the fetcher's threads
+        self.cards = []
+        self.urls = []
+        self.requested = set()          # Indices of the cards whose images are queued or downloading
+
+        self.pool = []                  # SingleCard widgets, card i is shown by pool[i % len(pool)]
+        self.windows = []               # Canvas window of each widget in the pool
+        self.first_row = None           # First row bound to the pool
+        self.placeholder = tk.PhotoImage(width=CARD_WIDTH, height=CARD_HEIGHT)
+
+        self.canvas = tk.Canvas(self, border=5, width=cards_per_row * self.col_width, yscrollincrement=self.row_height // 4)
+        self.scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.on_yview)
 
         self.canvas.bind_all("<MouseWheel>", self.on_scroll)    # Windows and Linux
         self.canvas.bind_all("<Button-4>", self.on_scroll)      # Linux scrolling up
         self.canvas.bind_all("<Button-5>", self.on_scroll)      # Linux scrolling down
-        self.cardlab_frame.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
-
-        self.canvas.create_window((0,0), window=self.cardlab_frame, anchor="nw")
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.bind("<Configure>", self.on_resize)
 
         self.canvas.pack(side="left", fill="both", expand=True)
         self.scrollbar.pack(side="right", fill="y")
 
-        self.canvas.bind("<Configure>", self.on_scroll)
         self.set_cards(card_dicts)
+        self.after(IMAGE_POLL_MS, self.show_loaded_images)
 
-    def remove_all_images(self):
-        for lab in self.cardlabs:
-            lab.grid_forget()
-            lab.destroy()
-        self.cardlabs = []
+    def build_pool(self, rows:int):
+        # Replace the pool with enough widgets for the given number of rows
+        for card in self.pool:
+            card.destroy()
+        self.canvas.delete("card")
 
-    def gen_card_labels(self):
-        # Generate up to image_limit labels
-        print(f" image_count = {self.image_count}\n image limit = {self.image_limit}\n len(cards) = {len(self.cards)}")
-        for i in range(self.image_count, min(self.image_limit, len(self.cards))):
-            label = SingleCard(self.cardlab_frame, self.cards[i])
-            label.grid(row = i // self.cards_per_row, column= i % self.cards_per_row)
-            self.cardlabs.append(label)
+        self.pool = [SingleCard(self.canvas, self.placeholder) for _ in range(rows * self.cards_per_row)]
+        self.windows = [self.canvas.create_window(0, 0, window=card, anchor="nw", state="hidden", tags="card") for card in self.pool]
+        self.first_row = None
 
     def set_cards(self, cards:list):
-        print("setting cards")
-        # Stop current thread
-        if self.load_thread and self.load_thread.is_alive():
-            print("Stopping current thread...")
-            self.stop_event.set()   # signal stop
-            self.pause_event.set()   # set pause event, so we can exit the loop
-            self.load_thread.join() # wait for it to finish
-            print("Thread stopped")
-
-        print("resetting state")
-        # Reset state
-        self.stop_event.clear()
-        self.image_limit = self.cards_per_row * 4
-        self.image_count = 0
+        # Drop the previous cards' downloads, images still in flight are ignored
+        self.generation = self.fetcher.cancel()
         self.cards = cards
-
-        print("removing images and generating new labels")
-        # Clear old images and Generate labels
-        self.remove_all_images()
-        self.gen_card_labels()
-
-        # Retrieve the links
-        missing_link = "https://cards.scryfall.io/normal/front/a/3/a3da3387-454c-4c09-b78f-6fcc36c426ce.jpg"
-        urls = []
-        for card in self.cards:
-            uris = card.get("image_uris")
-            url = None
-
-            # Just use front face on double sided cards
-            if card.get("multifaced") and uris:
-                url = uris[0].get("normal")
-            # Single faced cards
-            elif uris:
-                url = uris.get("normal")
-
-            urls.append(url if url != None else missing_link)
-
-        print("setting up thread")
-        # Set up the thread
-        self.pause_event.set()  # Ensure the thread is active
-        self.load_thread = Thread(target=self.getImageFromURLs, args=(urls,))
-        self.load_thread.daemon = True  # Allow thread to close with the app
-        self.load_thread.start()
-
-    # Fetches a list of card images from URLs
-    def getImageFromURLs(self, urls: list):
-        for index in range(len(urls)):
-            # Wait if the thread is paused
-            self.pause_event.wait()
-
-            # Pause if at limit
-            if index >= self.image_limit:
-                print("Reached image limit, pausing thread")
-                self.pause_event.clear()
-                self.pause_event.wait()
-            
-            # Stop loading images if images were changed
-            if self.stop_event.is_set():
-                print("Thread stopped before completing")
+        self.urls = [card_image_url(card) for card in cards]
+        self.requested = set()
+        for card in self.pool:
+            card.index = None
+
+        n_rows = -(-len(cards) // self.cards_per_row)
+        self.canvas.configure(scrollregion=(0, 0, self.cards_per_row * self.col_width, n_rows * self.row_height))
+        self.canvas.yview_moveto(0)
+        self.first_row = None
+        self.update_visible()
+
+    def viewport_rows(self) -> tuple[int, int]:
+        # First and last rows on screen
+        top = int(self.canvas.canvasy(0))
+        bottom = top + self.canvas.winfo_height()
+        return top // self.row_height, bottom // self.row_height
+
+    def update_visible(self):
+        # Bind the pool to the rows on screen and the margin around them
+        if not self.pool:
+            return
+        viewport = self.viewport_rows()
+        first_row = max(viewport[0] - MARGIN_ROWS, 0)
+        if first_row == self.first_row:
+            return
+        self.first_row = first_row
+
+        first = first_row * self.cards_per_row
+        for index in range(first, first + len(self.pool)):
+            slot = index % len(self.pool)
+            card, window = self.pool[slot], self.windows[slot]
+            if index >= len(self.cards):
+                self.canvas.itemconfigure(window, state="hidden")
+                card.index = None
+                continue
+            if card.index == index:
+                continue
+
+            row, col = divmod(index, self.cards_per_row)
+            self.canvas.coords(window, col * self.col_width, row * self.row_height)
+            self.canvas.itemconfigure(window, state="normal")
+
+            # Images shown before don't need to be downloaded or decoded again
+            image = self.image_cache.get(self.urls[index])
+            card.show(index, self.cards[index], image)
+            if image is None and index not in self.requested:
+                key = (self.generation, index)
+                self.requested.add(index)
+                self.fetcher.submit(key, self.urls[index], self.on_image_fetched, self.image_priority(key, viewport))
+
+        # Load the images on screen first, and forget the ones scrolled far away
+        dropped = self.fetcher.reprioritize(lambda key: self.image_priority(key, viewport))
+        self.requested.difference_update(index for _, index in dropped)
+
+    def image_priority(self, key:tuple, viewport:tuple[int, int]) -> int | None:
+        # Rows in the viewport first, then the closest rows to it, None for rows too far to keep downloading
+        row = key[1] // self.cards_per_row
+        distance = max(viewport[0] - row, row - viewport[1], 0)
+        return distance if distance <= PREFETCH_ROWS else None
+
+    # Called from the fetcher's threads, decodes the image so the main thread only has to show it. Failed images are
+    #  passed on as None so the main thread forgets the request and can try again later.
+    def on_image_fetched(self, key:tuple, data:bytes | None, error:Exception | None):
+        image = None
+        if error is None:
+            try:
+                image = Image.open(BytesIO(data))
+                image.load()
+            except (OSError, Image.DecompressionBombError) as e:
+                image, error = None, e
+        if error is not None:
+            print(f"Error loading image at index {key[1]}: {error}")
+        self.loaded.put((key, image))
+
+    # Tk isn't thread-safe, so the downloaded images are put on the labels from the main thread
+    def show_loaded_images(self):
+        while True:
+            try:
+                (generation, index), image = self.loaded.get_nowait()
+            except queue.Empty:
                 break
+            if generation != self.generation:
+                continue
+            self.requested.discard(index)
+            if image is None:       # Download or decoding failed, it's requested again when the card is shown again
+                continue
+
+            photo = ImageTk.PhotoImage(image)
+            self.image_cache.put(self.urls[index], photo, photo.width() * photo.height() * 4)
+            card = self.pool[index % len(self.pool)] if self.pool else None
+            if card is not None and card.index == index:
+                card.img = photo
+                card.event_generate("<<ImageLoaded>>")
+        self.after(IMAGE_POLL_MS, self.show_loaded_images)
+
+    def on_yview(self, first:str, last:str):
+        # Every way of scrolling moves the canvas through here
+        self.scrollbar.set(first, last)
+        self.update_visible()
+
+    def on_scroll(self, event):
+        if event.num == 4:
+            steps = -1
+        elif event.num == 5:
+            steps = 1
+        else:
+            steps = -(event.delta // 120) if abs(event.delta) >= 120 else -event.delta   # macOS reports small deltas
+        self.canvas.yview_scroll(steps, "units")
 
-            try:
-                url = urls[index]
-                print(f"Loading image {index + 1}/{len(urls)} from {url}")
+    def on_resize(self, event):
+        # Keep enough widgets for the rows that fit on screen
+        rows = -(-event.height // self.row_height) + 1 + 2 * MARGIN_ROWS
+        if rows * self.cards_per_row != len(self.pool):
+            self.build_pool(rows)
+        self.update_visible()
 
-                req = Request(url, headers={"User-Agent": PROGRAM_VERSION})
-                image = ImageTk.PhotoImage(file=urlopen(req))
 
-                # Assign image to the corresponding label
-                self.cardlabs[index].img = image
-                self.cardlabs[index].event_generate("<<ImageLoaded>>")
+class SingleCard(tk.Frame):
+    def __init__(self, parent:tk.Widget, placeholder:tk.PhotoImage):
+        super().__init__(parent)
 
-                self.image_count += 1
+        self.card:dict = None
+        self.index:int = None       # Index of the card in the display's list
+        self.placeholder = placeholder
+        self.lab = tk.Label(self, image=placeholder, text="Loading...", compound="center", border=CARD_BORDER, highlightthickness=0)
+        self.lab.pack()
+        self.img = None
+        self.bind("<<ImageLoaded>>", self.on_image_loaded)
 
-            except Exception as e:
-                print(f"Error loading image at index {index}: {e}")
+    def show(self, index:int, card:dict, image:ImageTk.PhotoImage | None = None):
+        # Rebind the widget to another card, showing the placeholder until its image is loaded
+        self.index = index
+        self.card = card
+        self.img = image
+        self.lab.config(bg=hash_to_color(card.get('similarity_id')), image=image or self.placeholder,
+                        text="" if image else "Loading...")
 
-            # 50ms delay for Scryfall's request
-            sleep(0.05)
+    def on_image_loaded(self, event=None):
+        self.lab.config(image=self.img, text="")
 
 
-    def on_scroll(self, event=None):
-        # Calculate scrollbar position
-        pos = self.canvas.yview()[1]  # Position is a tuple (start, end) -> end
+def card_image_url(card:dict) -> str:
+    """
+    Returns the URL of a card's normal sized image, the front face's for double sided cards.
 
-        # Unpause thread at 90% scroll and limit < number of cards in display's list
-        if pos > 0.9 and self.image_limit < len(self.cards):
-            print("setting unpause")
-            self.image_limit += self.cards_per_row * 4
-            print("image limit:", self.image_limit)
-            self.gen_card_labels()
-            self.pause_event.set()  # Unpause the thread if paused
+    Parameters:
+    - card (dict): Card dictionary
 
+    Returns:
+    - str: Image URL, MISSING_IMAGE if the card has none
+    """
+    uris = card.get("image_uris")
+    url = None
 
-class SingleCard(tk.Frame):
-    def __init__(self, parent:tk.Frame, card:dict):
-        super().__init__(parent)
+    # Just use front face on double sided cards
+    if card.get("multifaced") and uris:
+        url = uris[0].get("normal")
+    # Single faced cards
+    elif uris:
+        url = uris.get("normal")
 
-        self.card:dict = card
-        self.lab = tk.Label(self, text="Loading...", width=66, height=42, border=4, bg=hash_to_color(card.get('similarity_id')))
-        self.lab.pack()
-        self.img = None
-        self.bind("<<ImageLoaded>>", self.on_image_loaded)
-    
-    def on_image_loaded(self, event):
-        self.lab.config(image=self.img, text="", width=self.img.width(), height=self.img.height())
+    return url if url != None else MISSING_IMAGE
 
 
 def hash_to_color(num:int) -> str:
@@ -197,6 +270,7 @@ class SearchWidget(tk.Frame):
     def __init__(self, parent:tk.Tk, card_dicts:list, card_display:CardDisplay):
         super().__init__(parent)
         self.cards = card_dicts
+        self.index = SearchIndex(card_dicts)
         self.row_index = 0
         self.patterns = []          # List of search to match to
         self.pattern_frames = []    # List of tk.Frames used for displaying patterns
@@ -232,48 +306,13 @@ class SearchWidget(tk.Frame):
             self.remove_pattern_widget(self.patterns[0], self.pattern_frames[0])
 
     def search_cards(self) -> list:
-        matches = []
-
-        for card in self.cards:
-            skip : bool = False
-            for pattern in self.patterns:
-                search_param = pattern["parameter"]
-
-                # Patterns that have a comparison operator:
-                if pattern.get("compare_op"):
-                    # Call the comparison operator function on the card's value for the given parameter and the search pattern value
-                    result : bool = compare(pattern["compare_op"], int(card[search_param]), int(pattern["value"]))
-                
-                # Color fields:
-                elif "color" in search_param:
-                    search_colors = parse_colors(pattern["value"])
-                    if search_colors:
-                        result = all(color in card[search_param] for color in search_colors)
-                    # Colorless search must use an empty list
-                    else:
-                        result = (search_colors == card[search_param])
-
-                # Similarity ID
-                elif "similarity_id" in search_param:
-                    result = int(card[search_param]) == int(pattern["value"])
-
-                # Text-based fields
-                else:
-                    result = pattern["value"].lower() in card[search_param].lower()
-
-                # Flip result if there's a logical not
-                if (pattern["logic_op"] == "not"):
-                    result = not result
-                
-                # Filter out if the result is False
-                if (not result):
-                    skip = True
-            
-            if not skip:
-                matches.append(card)
-
-
-        print([match["name"] for match in matches])
+        # Patterns are applied in order: "and" keeps the matching cards, "or" adds them and "not" removes them
+        try:
+            matches = self.index.matches(self.patterns)
+        except ValueError as e:
+            print(f"Invalid search: {e}", file=sys.stderr)
+            return []
+
         self.card_display.set_cards(matches)
         return matches
 
@@ -354,43 +393,6 @@ class SearchWidget(tk.Frame):
             self.pattern_frames[i].grid(row=i+2)    # +2 offset to match because row 1 is [Clear Search] button
 
 
-def compare(comparison_op:str, a:int, b:int) -> bool:
-    comparison_ops = {
-        "==": operator.eq,
-        "!=": operator.ne,
-        ">=": operator.ge,
-        "<=": operator.le,
-        ">": operator.gt,
-        "<": operator.lt,
-    }
-    if not comparison_ops.get(comparison_op):
-        raise ValueError(f"Invalid operator: '{comparison_op}'")
-    return comparison_ops[comparison_op](a, b)
-
-# Parse color-based search terms, returns a list of color abbreviations
-def parse_colors(color_pattern : str) -> list:
-    colors = {"white":"W", "blue":"U", "red":"R", "black":"B", "green":"G", "colorless":"C"}
-    search_colors = set()
-    split_pattern = color_pattern.split()
-
-    # Parse colors for searching
-    for search_color in split_pattern:
-        # Turn "red white" into {"R", "W"}
-        if search_color.lower() in colors.keys():
-            search_colors.add(colors[search_color.lower()])
-        # Turn "UBG" into {"U", "B", "G"}
-        else:
-            for char in search_color:
-                if char in "WUBRGC":
-                    search_colors.add(char)
-    
-
-    # Colorless can only be searched with an empty color list
-    if "C" in search_colors:
-        return []
-    
-    return list(search_colors)
-
 if __name__ == "__main__":
     from cardsim import get_custom_cards
     print("Getting custom card data...")
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# Downloads card images on a few threads, reusing keep-alive connections and keeping under Scryfall's rate limit.
+# Downloaded images are kept in a disk cache, and the GUI keeps the decoded images in a memory cache.
+
+import os
+import heapq
+import hashlib
+import itertools
+import http.client
+from time import monotonic, sleep, time
+from threading import Thread, Condition, Lock, local
+from urllib.parse import urlsplit
+from collections import OrderedDict
+
+PROGRAM_VERSION = "MTGCardSimilarity/0.1"
+
+# Scryfall asks for no more than 10 requests per second on average
+REQUESTS_PER_SECOND = 10.0
+REQUEST_BURST = 10
+
+DISK_CACHE_BYTES = 512 << 20
+DISK_CACHE_MAX_AGE = 30 * 24 * 60 * 60      # Seconds, Scryfall updates images rarely
+
+
+class LRUCache:
+    """Thread-safe least recently used cache bounded by the total size of its values."""
+
+    def __init__(self, max_bytes:int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()      # {key= Key, value= (Value, size)}, least recently used first
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size:int) -> None:
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self.items.popitem(last=False)
+                self.size -= old_size
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class DiskImageCache:
+    """
+    Thread-safe cache of downloaded files in a directory, named by the SHA-256 of their URL. Files older than
+    max_age are dropped, and the least recently used files are removed once the cache is larger than max_bytes.
+    A file's modification time is when it was downloaded and its access time when it was last used.
+    """
+
+    def __init__(self, directory:str, max_bytes:int = DISK_CACHE_BYTES, max_age:float = DISK_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Find the cache's size, dropping expired files and partial writes
+        self.size = 0
+        for entry in self.entries():
+            if entry.name.endswith(".part") or time() - entry.stat().st_mtime > max_age:
+                self.remove(entry.path)
+            else:
+                self.size += entry.stat().st_size
+        self.evict()
+
+    def path(self, url:str) -> str:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def entries(self) -> list:
+        entries = []
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                entries += [entry for entry in os.scandir(shard.path) if entry.is_file()]
+        return entries
+
+    def remove(self, fname:str) -> int:
+        try:
+            size = os.path.getsize(fname)
+            os.remove(fname)
+            return size
+        except OSError:
+            return 0
+
+    def get(self, url:str) -> bytes | None:
+        fname = self.path(url)
+        try:
+            stat = os.stat(fname)
+            if time() - stat.st_mtime > self.max_age:
+                with self.lock:
+                    self.size -= self.remove(fname)
+                return None
+            with open(fname, "rb") as f:
+                data = f.read()
+            os.utime(fname, (time(), stat.st_mtime))    # Mark it as used, whatever the file system's atime setting
+            return data
+        except OSError:
+            return None
+
+    def put(self, url:str, data:bytes) -> None:
+        fname = self.path(url)
+        tmp_file = f"{fname}.{os.getpid()}.{id(data)}.part"
+        try:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            with self.lock:
+                old_size = os.path.getsize(fname) if os.path.exists(fname) else 0
+                os.replace(tmp_file, fname)
+                self.size += len(data) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+        except OSError as e:
+            self.remove(tmp_file)
+            print(f"Error caching '{url}': {e}")
+
+    def evict(self) -> None:
+        # Remove the least recently used files until the cache is back under 90% of max_bytes
+        with self.lock:
+            if self.size <= self.max_bytes:
+                return
+            entries = sorted(self.entries(), key=lambda entry: entry.stat().st_atime)
+            for entry in entries:
+                if self.size <= self.max_bytes * 0.9:
+                    break
+                self.size -= self.remove(entry.path)
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing rate requests per second on average, and bursts of up to capacity."""
+
+    def __init__(self, rate:float, capacity:int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def acquire(self, cancelled=None) -> bool:
+        """
+        Wait for a token.
+
+        Parameters:
+        - cancelled (function|None): Checked while waiting, stop waiting once it returns True (default: None)
+
+        Returns:
+        - bool: True if a token was taken, False if cancelled
+        """
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+
+            if cancelled is not None and cancelled():
+                return False
+            sleep(min(wait, 0.05))
+
+
+class ImageFetcher:
+    """
+    Pool of threads downloading URLs in priority order, lowest priority value first. Each thread keeps one
+    keep-alive connection per host. URLs found in the disk cache are read from it without a request.
+    cancel() drops every queued download, and downloads that were already running when it was called don't call back.
+    """
+
+    def __init__(self, workers:int = 4, rate:float = REQUESTS_PER_SECOND, burst:int = REQUEST_BURST,
+                 user_agent:str = PROGRAM_VERSION, timeout:float = 30, cache:DiskImageCache | None = None):
+        self.cache = cache
+        self.bucket = TokenBucket(rate, burst)
+        self.user_agent = user_agent
+        self.timeout = timeout
+
+        self.cond = Condition()
+        self.queue = []                 # Heap of [priority, order, generation, key, url, callback]
+        self.order = itertools.count()  # Keeps downloads of the same priority in submission order
+        self.generation = 0
+        self.closed = False
+        self.local = local()            # Each thread's connections, {key= (scheme, host), value= HTTPConnection}
+
+        self.threads = [Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, url:str, callback, priority:float = 0) -> None:
+        """
+        Queue a download. callback(key, data, error) is called from a worker thread with the downloaded bytes,
+        or with None and the exception if the download failed.
+        """
+
+        with self.cond:
+            heapq.heappush(self.queue, [priority, next(self.order), self.generation, key, url, callback])
+            self.cond.notify()
+
+    def reprioritize(self, priority) -> list:
+        """
+        Recompute the priority of every queued download with priority(key), e.g. after the viewport moved.
+        Downloads whose new priority is None are dropped.
+
+        Returns:
+        - list: Keys of the dropped downloads
+        """
+
+        with self.cond:
+            dropped = []
+            for item in self.queue:
+                item[0] = priority(item[3])
+                if item[0] is None:
+                    dropped.append(item[3])
+            self.queue = [item for item in self.queue if item[0] is not None]
+            heapq.heapify(self.queue)
+            return dropped
+
+    def cancel(self) -> int:
+        """
+        Drop every queued download and ignore the ones in progress.
+
+        Returns:
+        - int: The new generation, downloads submitted from now on belong to it
+        """
+
+        with self.cond:
+            self.generation += 1
+            self.queue.clear()
+            return self.generation
+
+    def close(self) -> None:
+        """Stop the worker threads once they finish their current download."""
+
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+
+    def work(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                _, _, generation, key, url, callback = heapq.heappop(self.queue)
+
+            data, error = self.cache.get(url) if self.cache else None, None
+            if data is None:
+                if not self.bucket.acquire(lambda: generation != self.generation or self.closed):
+                    continue
+
+                try:
+                    data = self.fetch(url)
+                except (OSError, http.client.HTTPException, ValueError) as e:
+                    error = e
+                if self.cache and error is None:
+                    self.cache.put(url, data)
+
+            if generation == self.generation and not self.closed:
+                # A failing callback mustn't end the thread, the pool would quietly shrink
+                try:
+                    callback(key, data, error)
+                except Exception as e:
+                    print(f"Error in the callback of '{url}': {e!r}")
+
+    def fetch(self, url:str) -> bytes:
+        """
+        Download a URL on this thread's keep-alive connection to its host, reconnecting once if the server
+        closed the connection since the last request.
+
+        Parameters:
+        - url (str): http or https URL
+
+        Returns:
+        - bytes: Response body
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL '{url}'")
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        conns = self.local.__dict__.setdefault("conns", {})
+        host = (parts.scheme, parts.netloc)
+
+        for attempt in range(2):
+            conn = conns.get(host)
+            if conn is None:
+                conn_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+                conn = conns[host] = conn_class(parts.netloc, timeout=self.timeout)
+
+            try:
+                conn.request("GET", path, headers={"User-Agent": self.user_agent, "Accept": "image/*"})
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                del conns[host]
+                if attempt:
+                    raise
+                continue
+
+            if response.will_close:
+                conn.close()
+                del conns[host]
+            if response.status != 200:
+                raise http.client.HTTPException(f"HTTP {response.status} {response.reason} for '{url}'")
+            return data
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Records the wall time, CPU time, peak memory and item counts of each stage of the similarity pipeline.
+# Example:
+#   instrument = Instrumentation(JsonLinesSink("card_data/stages.jsonl"), PrometheusSink("card_data/cardsim.prom"))
+#   card_similarity(cards, 144, 24, 6, 6, instrument=instrument)
+
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:     # Not available on Windows
+    resource = None
+
+
+def peak_rss() -> int | None:
+    """
+    Peak resident set size of the process so far, in bytes.
+
+    Returns:
+    - int|None: Peak RSS, None where the resource module isn't available
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024        # Linux reports kilobytes, macOS bytes
+
+
+class Instrumentation:
+    """Times pipeline stages and sends a record of each finished stage to every sink."""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks      # Callables taking a stage record, like JsonLinesSink or any function
+
+    @contextmanager
+    def stage(self, name:str):
+        """
+        Context manager timing the stage. It yields a dictionary the stage adds its item counts to,
+        e.g. counts["edges"] = len(edges).
+        """
+
+        counts = {}
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield counts
+        record = {
+            "stage": name,
+            "time": time.time(),
+            "wall_seconds": time.perf_counter() - wall,
+            "cpu_seconds": time.process_time() - cpu,
+            "peak_rss_bytes": peak_rss(),
+            "counts": {key: int(value) for key, value in counts.items()},
+        }
+        for sink in self.sinks:
+            sink(record)
+
+
+def stage(instrument:Instrumentation | None, name:str):
+    """
+    Time a stage with instrument, or do nothing when it's None. Either way the context manager yields a
+    dictionary for the stage's item counts.
+
+    Parameters:
+    - instrument (Instrumentation|None): Instrumentation of the run
+    - name (str): Name of the stage
+
+    Returns:
+    - Context manager yielding a dictionary
+    """
+
+    if instrument is None:
+        return nullcontext({})
+    return instrument.stage(name)
+
+
+class JsonLinesSink:
+    """Appends each stage record to a file as a line of JSON."""
+
+    def __init__(self, fname:str):
+        self.fname = fname
+
+    def __call__(self, record:dict) -> None:
+        with open(self.fname, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class PrometheusSink:
+    """
+    Keeps the latest record of every stage in a file in the Prometheus text format, e.g. for the node exporter's
+    textfile collector. The file is rewritten after each stage and replaced atomically.
+    """
+
+    def __init__(self, fname:str, prefix:str = "cardsim"):
+        self.fname = fname
+        self.prefix = prefix
+        self.records = {}       # {key= Stage name, value= Latest record}
+
+    def __call__(self, record:dict) -> None:
+        self.records[record["stage"]] = record
+
+        metrics = [
+            ("stage_wall_seconds", "Wall time of the stage's last run", lambda r: r["wall_seconds"]),
+            ("stage_cpu_seconds", "CPU time of the main process during the stage's last run", lambda r: r["cpu_seconds"]),
+            ("stage_peak_rss_bytes", "Peak resident set size of the process at the end of the stage", lambda r: r["peak_rss_bytes"]),
+            ("stage_last_run_timestamp_seconds", "Unix time the stage last finished", lambda r: r["time"]),
+        ]
+        lines = []
+        for metric, help_text, value in metrics:
+            lines += [f"# HELP {self.prefix}_{metric} {help_text}.", f"# TYPE {self.prefix}_{metric} gauge"]
+            for name, r in self.records.items():
+                if value(r) is not None:
+                    lines.append(f'{self.prefix}_{metric}{{stage="{name}"}} {value(r)}')
+
+        lines += [f"# HELP {self.prefix}_stage_items Number of items the stage produced.", f"# TYPE {self.prefix}_stage_items gauge"]
+        for name, r in self.records.items():
+            for item, count in r["counts"].items():
+                lines.append(f'{self.prefix}_stage_items{{stage="{name}",item="{item}"}} {count}')
+
+        tmp_file = self.fname + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.fname)
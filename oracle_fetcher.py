@@ -4,9 +4,11 @@ import json
 import glob
 import datetime
 import os
+import shutil
 
 PROGRAM_VERSION = "MTGCardSimilarity/0.1"
 CARD_DATASET = "https://api.scryfall.com/bulk-data/oracle-cards"
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 def get_oracle_json(dir:str | None = 'card_data') -> str:
     """
@@ -49,15 +51,21 @@ def get_oracle_json(dir:str | None = 'card_data') -> str:
         # JSON file Request
         json_req = urllib.request.Request(json_url, headers=headers)
         with urllib.request.urlopen(json_req) as response:
-            data = response.read().decode("utf-8")
-            json_object = json.loads(data)
-
             # Save cards to local json file, file name format: 'oracle-cards-2024-12-26T22_04_29.json'
             new_file_name = f"oracle-cards-{update_time.replace(":","_")[:19]}.json"
             if dir:
                 new_file_name = os.path.join(dir, new_file_name)
-            with open(new_file_name, "w", encoding="utf-8") as json_file:
-                json.dump(json_object, json_file)
+
+            # Stream the response to disk in chunks, only renaming it once the download is complete
+            part_file_name = f"{new_file_name}.part"
+            try:
+                with open(part_file_name, "wb") as json_file:
+                    shutil.copyfileobj(response, json_file, DOWNLOAD_CHUNK_SIZE)
+                os.replace(part_file_name, new_file_name)
+            finally:
+                # Don't leave a partial download behind when the request fails
+                if os.path.exists(part_file_name):
+                    os.remove(part_file_name)
 
     
     except urllib.error.HTTPError as e:
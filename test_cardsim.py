@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Tests of the incremental similarity update on a small synthetic card pool.
+# Run with: python -m unittest test_cardsim
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import contextlib
+import numpy as np
+
+import cardsim as cs
+
+WORDS = ("target creature gets +1/+1 until end of turn draw a card destroy enchantment artifact you control flying "
+         "trample haste when enters the battlefield each opponent loses life gain sacrifice counter spell").split()
+
+
+def synthetic_cards(n:int, seed:int = 1) -> list:
+    # Cards made from a few templates with a couple of words swapped, so there are many small groups
+    rng = random.Random(seed)
+    templates = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25))) for _ in range(n // 8)]
+    cards = []
+    for i in range(n):
+        words = rng.choice(templates).split()
+        for _ in range(rng.randint(0, 2)):
+            words[rng.randrange(len(words))] = rng.choice(WORDS)
+        cards.append({"oracle_id": f"oracle-{i}", "name": f"Card {i}", "oracle_text": " ".join(words)})
+    return cards
+
+
+class UpdateSimilarityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, "similarity-state.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def update(self, cards:list) -> dict:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return cs.update_similarity(cards, self.state_file, 144, 24, 6, 6, seed=1, cache_dir=self.tmp_dir)
+
+    def signatures(self) -> np.array:
+        with np.load(self.state_file) as state:
+            return state["signatures"]
+
+    def test_unchanged_groups_keep_their_ids(self):
+        # Three cards of their own share a word that's one use short of being an important shingle
+        cards = synthetic_cards(2000)
+        rng = random.Random(2)
+        for card in cards[1:4]:
+            card["oracle_text"] = " ".join(rng.choice(WORDS) for _ in range(20)) + " quux"
+        before = self.update(cards)
+        old_signatures = self.signatures()
+
+        # Using it in a fourth card changes the signatures of the other three, though their text is the same
+        edited = [dict(card) for card in cards]
+        edited[0]["oracle_text"] += " quux"
+        after = self.update(edited)
+        resigned = np.flatnonzero(np.any(self.signatures() != old_signatures, axis=0))
+        self.assertGreater(len(resigned), 1)
+
+        old_groups = {tuple(sorted(members)): sim_id for sim_id, members in before.items()}
+        kept = [(old_groups[key], sim_id) for sim_id, members in after.items()
+                if (key := tuple(sorted(members))) in old_groups]
+        self.assertGreater(len(kept), len(after) // 2)
+        for old_id, sim_id in kept:
+            self.assertEqual(old_id, sim_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
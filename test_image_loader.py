@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Tests of the image fetcher and disk cache against a local HTTP server standing in for Scryfall.
+# Run with: python -m unittest test_image_loader
+
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+import http.client
+from threading import Thread
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from image_loader import ImageFetcher, DiskImageCache
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    # Serves the files of the server's directory and counts the requests it gets
+    def do_GET(self):
+        self.server.requests += 1
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files_dir = os.path.join(self.tmp_dir, "files")
+        os.makedirs(self.files_dir)
+        for i in range(5):
+            with open(os.path.join(self.files_dir, f"{i}.jpg"), "wb") as f:
+                f.write(bytes([i]) * 1000)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(CountingHandler, directory=self.files_dir))
+        self.server.requests = 0
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch_all(self, fetcher:ImageFetcher, names:list) -> dict:
+        # Download every name and wait for all the callbacks, {key= Name, value= (data, error)}
+        results = queue.Queue()
+        for name in names:
+            fetcher.submit(name, f"{self.base_url}/{name}", lambda key, data, error: results.put((key, data, error)))
+        done = {}
+        for _ in names:
+            key, data, error = results.get(timeout=10)
+            done[key] = (data, error)
+        return done
+
+    def test_cache_hits_skip_the_server(self):
+        cache = DiskImageCache(os.path.join(self.tmp_dir, "cache"))
+        fetcher = ImageFetcher(workers=2, rate=1000, burst=100, cache=cache)
+        try:
+            first = self.fetch_all(fetcher, ["0.jpg", "1.jpg"])
+            self.assertEqual(self.server.requests, 2)
+            second = self.fetch_all(fetcher, ["0.jpg", "1.jpg"])
+        finally:
+            fetcher.close()
+
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(first, second)
+        self.assertEqual(second["1.jpg"], (bytes([1]) * 1000, None))
+
+    def test_missing_images_report_an_error(self):
+        cache = DiskImageCache(os.path.join(self.tmp_dir, "cache"))
+        fetcher = ImageFetcher(workers=1, rate=1000, burst=100, cache=cache)
+        try:
+            data, error = self.fetch_all(fetcher, ["missing.jpg"])["missing.jpg"]
+        finally:
+            fetcher.close()
+
+        self.assertIsNone(data)
+        self.assertIsInstance(error, http.client.HTTPException)
+        self.assertIn("404", str(error))
+        self.assertIsNone(cache.get(f"{self.base_url}/missing.jpg"))
+
+    def test_disk_cache_stays_under_its_size_limit(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        cache = DiskImageCache(cache_dir, max_bytes=2500)
+        fetcher = ImageFetcher(workers=1, rate=1000, burst=100, cache=cache)
+        try:
+            self.fetch_all(fetcher, [f"{i}.jpg" for i in range(5)])
+        finally:
+            fetcher.close()
+
+        on_disk = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache_dir) for name in names)
+        self.assertLessEqual(cache.size, 2500)
+        self.assertEqual(cache.size, on_disk)
+        self.assertIsNotNone(cache.get(f"{self.base_url}/4.jpg"))     # The newest file is kept
+
+    def test_failing_callback_keeps_the_worker(self):
+        fetcher = ImageFetcher(workers=1, rate=1000, burst=100)
+        results = queue.Queue()
+
+        def callback(key, data, error):
+            if key == "0.jpg":
+                raise ValueError("broken image")
+            results.put((key, data))
+
+        try:
+            fetcher.submit("0.jpg", f"{self.base_url}/0.jpg", callback, priority=0)
+            fetcher.submit("1.jpg", f"{self.base_url}/1.jpg", callback, priority=1)
+            self.assertEqual(results.get(timeout=10), ("1.jpg", bytes([1]) * 1000))
+        finally:
+            fetcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()